@@ -11,8 +11,8 @@ import os
 
 # Created : S.Sénési - 2014
 
-__all__ = ["site_settings", "cache", "classes", "clogging", "dataloc", "driver", "netcdfbasics",
-           "operators", "period", "standard_operators", "cmacro", "html", "functions", "plot",
+__all__ = ["site_settings", "cache", "cache_index", "filemeta", "classes", "clogging", "dataloc", "driver",
+           "netcdfbasics", "operators", "period", "standard_operators", "cmacro", "html", "functions", "plot",
            "projects", "derived_variables"]
 
 version = "1.2.12"
@@ -113,7 +113,18 @@ if not already_inited and not onrtd:
     else:
         default_cache = "~/tmp/climaf_cache"
     cachedir = os.getenv("CLIMAF_CACHE", default_cache)
+    cache.index_backend = os.getenv("CLIMAF_CACHE_INDEX", cache.index_backend)
+    cache.set_size_limits(os.getenv("CLIMAF_CACHE_MAX_SIZE", "0"), os.getenv("CLIMAF_CACHE_QUOTAS", ""))
+    cache.memory_budget = cache.size_in_bytes(os.getenv("CLIMAF_CACHE_MEMORY", "512M"))
+    cache.set_compression(os.getenv("CLIMAF_CACHE_COMPRESSION", "0"))
+    import driver
+    driver.max_workers = int(os.getenv("CLIMAF_MAX_WORKERS", driver.max_workers))
+    driver.page_compositor = os.getenv("CLIMAF_PAGE_COMPOSITOR", driver.page_compositor)
+    driver.time_chunks = os.getenv("CLIMAF_TIME_CHUNKS", driver.time_chunks)
+    driver.tile_size = cache.size_in_bytes(os.getenv("CLIMAF_TILE_SIZE", "0"))
     cache.setNewUniqueCache(cachedir, raz=False)
+    cache.set_shared_caches(os.getenv("CLIMAF_SHARED_CACHE", ""),
+                            promote=os.getenv("CLIMAF_SHARED_CACHE_PROMOTE", "no").lower() in ["1", "yes", "true"])
     print("Cache directory set to : " + cachedir + " (use $CLIMAF_CACHE if set) ", file=sys.stderr)
     tim("set cache")
     # Decide for cache location for remote data
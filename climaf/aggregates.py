@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+
+Assembling time means, annual cycles and time standard deviations from partial aggregates
+
+For an object which operators commute with time concatenation (e.g. a dataset), operator
+``time_partials`` computes, for each year, the sum of the values, the sum of their squared
+deviations from their mean and the number of valid values (for each calendar month in the case
+of annual cycles). These partial aggregates are cached as any CliMAF object, so that the mean,
+annual cycle or standard deviation for any period made of whole years is computed by combining
+those for its years (using operator ``combine_partials``, in one script call), and only the
+partial aggregates of years not yet processed read the data.
+
+This is worth when statistics are computed for many overlapping periods, but a first computation
+reads the data once per year : it is thus only done if :py:data:`use_partials` is True.
+
+The objects concerned are ``time_average(obj)`` and ``ccdo(obj, operator=...)`` for operators
+listed in :py:data:`statistics` (e.g. ``annual_cycle(obj)``); a period must cover at least
+:py:data:`min_years` years for being processed this way
+
+"""
+
+import copy
+
+from period import init_period
+from clogging import clogger
+import classes
+import cache
+import operators
+
+#: Whether time means, annual cycles and standard deviations are assembled from yearly
+# partial aggregates (see :py:func:`assembled`)
+use_partials = False
+#: The minimal number of years of a period for using partial aggregates
+min_years = 2
+#: The statistics which can be assembled from partial aggregates, as a dict of tuples
+# (statistics, cycle) by (operator, CDO operator); the statistics is either 'mean' or 'std',
+# and the cycle is either 'tim' (whole period) or 'ymon' (each calendar month)
+statistics = {
+    ("time_average", None): ("mean", "tim"),
+    ("time_average_fast", None): ("mean", "tim"),
+    ("ccdo", "timmean"): ("mean", "tim"),
+    ("ccdo", "timavg"): ("mean", "tim"),
+    ("ccdo", "timstd"): ("std", "tim"),
+    ("ccdo", "ymonmean"): ("mean", "ymon"),
+    ("ccdo", "ymonavg"): ("mean", "ymon"),
+    ("ccdo", "ymonstd"): ("std", "ymon"),
+}
+#: The operators used for assembling partial aggregates
+needed_operators = ["time_partials", "combine_partials"]
+
+
+def years_of(cobject):
+    """
+    Returns the list of years covered by the period of COBJECT, if it is made of whole years
+    and shared by all its datasets (see :py:func:`~climaf.cache.shape`), and None otherwise
+    """
+    signature, period = cache.shape(cobject)
+    if period is None:
+        return None
+    start, end = period.start, period.end
+    if (start.month, start.day, start.hour, start.minute) != (1, 1, 0, 0) or \
+            (end.month, end.day, end.hour, end.minute) != (1, 1, 0, 0):
+        return None
+    return range(start.year, end.year)
+
+
+def assembled(cobject):
+    """
+    Returns an object which computes the same as COBJECT by combining yearly partial
+    aggregates, if COBJECT is a time mean, annual cycle or standard deviation (see
+    :py:data:`statistics`) of an object which operators commute with time concatenation
+    over at least :py:data:`min_years` whole years; returns None otherwise
+    """
+    if not use_partials or not isinstance(cobject, classes.ctree) or len(cobject.operands) != 1:
+        return None
+    key = (cobject.operator, cobject.parameters.get("operator"))
+    if key not in statistics or any([op not in operators.scripts for op in needed_operators]):
+        return None
+    if [p for p in cobject.parameters if p != "operator"]:
+        return None
+    operand = cobject.operands[0]
+    if not cache.operators_commute(operand, "period"):
+        return None
+    years = years_of(operand)
+    if years is None or len(years) < min_years:
+        return None
+    stat, cycle = statistics[key]
+    clogger.debug("Assembling %s from partial aggregates for years %d-%d" % (cobject.crs, years[0], years[-1]))
+    import driver
+    # The partial aggregates of each year, in time order : sum, sum of squared deviations and count
+    members, order = dict(), []
+    for year in years:
+        part = copy.deepcopy(operand)
+        part.setperiod(init_period("%04d" % year))
+        partials = driver.capply("time_partials", part, cycle=cycle)
+        for name, partial in [("sum", partials), ("sqdev", partials.outputs["sqdev"]),
+                              ("count", partials.outputs["count"])]:
+            label = "%04d_%s" % (year, name)
+            members[label] = partial
+            order.append(label)
+    return driver.capply("combine_partials", classes.cens(members, order), stat=stat, cycle=cycle)
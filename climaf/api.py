@@ -53,6 +53,16 @@ Main functions are :
 
  - ``cprotect`` : protect the cached file for an object from deletion
 
+ - ``cevict``   : evict cached objects for enforcing cache size limits
+
+ - ``cstats``   : statistics on cache hits and misses
+
+ - ``cinvalidate``: drop the cached objects computed from some data or object
+
+ - ``cforget_failures``: retry evaluations which failed, or datasets which had no file
+
+ - ``cpack``, ``cunpack`` : transfer cached objects between caches, in one archive
+
  - ``craz``     : reset cache
 
  - ``csync``    : save cache index to disk
@@ -86,7 +96,8 @@ from cmacro import macro, cmacros
 from driver import ceval, cfile, cshow, cMA, cvalue, cimport, cexport, calias, efile
 from dataloc import dataloc
 from operators import cscript, scripts as cscripts, operators, fixed_fields, derive
-from cache import craz, csync, cdump, cdrop, clist, cls, crm, cdu, cwc, cprotect
+from cache import craz, csync, cdump, cdrop, clist, cls, crm, cdu, cwc, cprotect, cevict, cstats, cinvalidate, \
+    cforget_failures, cpack, cunpack
 from clogging import clogger, clog, clog_file, logdir
 from site_settings import atCNRM, onCiclad, atTGCC, atIDRIS, atIPSL, onSpip
 from plot.plot_params import plot_params, hovm_params
@@ -13,17 +13,33 @@ import sys
 import os
 import os.path
 import re
+import stat
 import time
 import glob
-import pickle
-import uuid
 import hashlib
-from operator import itemgetter
-
-from climaf import version
-from classes import compare_trees, cobject, cdataset, cprojects, guess_projects, allow_error_on_ds
-from cmacro import crewrite
+import bisect
+import heapq
+import json
+import threading
+import fcntl
+import errno
+import copy
+import datetime
+import StringIO
+import tarfile
+import shutil
+import subprocess
+from operator import itemgetter, gt, lt, eq
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from classes import compare_trees, cobject, cdataset, ctree, scriptChild, cprojects, guess_projects, \
+    allow_error_on_ds
+from period import cperiod
+from cmacro import crewrite, cmacros
 from clogging import clogger, dedent
+from cache_index import open_index, index_backend_of, file_stats
+from filemeta import write_crs, read_crs
 import operators
 
 currentCache = None
@@ -36,32 +52,219 @@ safe = False
 directoryNameLength = 5
 #: Define whether we stamps the data files with their CRS
 stamping = True
-#: The index associating filenames to CRS expressions
+#: The backend used for the cache index, among 'sqlite' and 'pickle' (see :py:mod:`~climaf.cache_index`)
+index_backend = "sqlite"
+#: The index associating filenames to CRS expressions (a dict-like object, see
+# :py:class:`~climaf.cache_index.cindex`)
 crs2filename = dict()
-#: The dictionary associating CRS expressions to their evaluation
-crs2eval = dict()
-#: The list of crs which file has been dropped since last synchronisation between in-memory index and file index
-#  (or at least since the beginning of the session)
-dropped_crs = []
+#: Read-only cache directories, e.g. shared by a team, which are searched after the current
+# cache (see :py:func:`set_shared_caches`)
+shared_caches = []
+#: The indexes of shared caches
+shared_indexes = []
+#: Whether objects found in a shared cache are promoted to the current cache, using a hard link
+promote_shared = False
+#: The CRS which objects found in shared caches under their legacy (non canonical) CRS are
+# recorded with, by canonical CRS (see :py:func:`adopt_legacy`)
+legacy_crs = dict()
+#: Maximum size (in bytes) of the values kept in memory : data read from cache files and
+# objects evaluated from CRS expressions (see :py:class:`memory_tier`)
+memory_budget = 2 ** 29
+#: The CRS of index entries which shape could not be computed during this session
+unshapable = set()
+#: Whether the shape of legacy index entries was computed during this session
+shapes_updated = False
+#: Whether the cached chunks (or tiles) which a result is concatenated from are kept in the cache
+# (see :py:func:`mosaic` and :py:func:`collage`)
+keep_chunks = True
+#: The CRS of index entries which datasets have a domain box or a group of variables, which may
+# include requested objects (see :py:func:`hasIncludingObject`); None until computed
+subsettable = None
+#: The deflate level (1 to 9) of NetCDF cache files, which are then stored as NetCDF4 files;
+# 0 means that files are stored as produced (see :py:func:`set_compression`)
+compression = 0
+#: The deflate level of NetCDF cache files by operator, overriding :py:data:`compression`
+operator_compression = dict()
+#: Maximum size of the cache, in bytes; 0 means no limit (see :py:func:`cevict`)
+max_size = 0
+#: Maximum size of cached objects per project, in bytes (a dict project -> size)
+project_quotas = dict()
+#: When a limit is exceeded, files are evicted until this fraction of the limit is reached
+eviction_target = 0.9
+#: Computation time (in s) assumed for cached objects which have none recorded
+default_cost = 10.
+#: Time without access (in s) after which the retention value of a cached object is halved
+eviction_age_scale = 86400.
+#: Whether the project of legacy index entries was computed during this session
+projects_updated = False
+
+#: Maximum time (in s) a session waits for another one computing the same object, before
+# computing it by itself (see :py:class:`computation_lock`)
+lock_timeout = 3600.
+#: Period (in s) at which a waiting session checks if the other one is done
+lock_poll = 0.5
+
+#: Number of threads reading the CRS of cache files when rebuilding the index (see :py:func:`rebuild`)
+rebuild_workers = 8
+#: Age (in s) beyond which a temporary output left in the cache by a process which is
+# not running anymore is removed by :py:func:`rebuild`
+orphan_age = 86400.
+
+#: Time (in s) during which a failed script evaluation, or a dataset lookup which found
+# no file, is not attempted again (see :py:func:`cforget_failures`); 0 disables this memory
+failure_ttl = 3600.
+#: The failures recorded in current cache (file <cache>/failures.json), by key : a dict
+# key -> dict(time, error, fingerprint), or None before it is read
+failures = None
+failures_lock = threading.Lock()
+
+#: Counters and timers of cache usage during the session (see :py:func:`cstats`)
+stats = dict()
+#: The computation time (in s) of objects computed during the session, by CRS
+computations = dict()
+stats_lock = threading.Lock()
 
 #: A dict containing cache index entries (as listed in index file), which
 # were up to now not interpretable, given the set of defined projects
 crs_not_yet_evaluable = dict()
 
 
+class memory_tier(object):
+    """
+    A store of values by key, in memory, which discards the least recently used values when
+    their total size exceeds 'memory_budget'
+    """
+
+    def __init__(self):
+        self.values = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.values:
+                return default
+            value, size = self.values.pop(key)
+            self.values[key] = (value, size)
+            return value
+
+    def put(self, key, value, size):
+        """
+        Stores VALUE for KEY, assuming it uses SIZE bytes; values larger than the budget are not stored
+        """
+        with self.lock:
+            self.discard(key)
+            if size > memory_budget:
+                return
+            self.values[key] = (value, size)
+            self.size += size
+            while self.size > memory_budget:
+                old, (value, size) = self.values.popitem(last=False)
+                self.size -= size
+
+    def discard(self, key):
+        entry = self.values.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+
+#: Values kept in memory : arrays read from cache files (by filename, variable, and file
+# inode, size and date) and the evaluation of CRS expressions
+memory = memory_tier()
+
+
 def setNewUniqueCache(path, raz=True):
     """ Define PATH as the sole cache to use from now. And clear it
 
     """
     global currentCache
     global cachedirs
-    global cacheIndexFileName
 
-    cachedirs = [path]  # The list of cache directories
-    cacheIndexFileName = cachedirs[0] + "/index"  # The place to write the index
+    cachedirs = [path] + shared_caches  # The list of cache directories
     currentCache = cachedirs[0]
     if raz:
         craz(hideError=True)
+    else:
+        open_cache_index()
+
+
+def open_cache_index():
+    """
+    (Re-)open the index of current cache, using the backend set by variable 'index_backend'
+    """
+    global crs2filename, shapes_updated, projects_updated, failures, subsettable
+    if hasattr(crs2filename, "close"):
+        crs2filename.close()
+    crs2filename = open_index(currentCache, index_backend)
+    memory.clear()
+    failures = None
+    subsettable = None
+    unshapable.clear()
+    shapes_updated = False
+    projects_updated = False
+
+
+def set_shared_caches(paths, promote=None):
+    """
+    Declares the read-only caches which are searched for objects after the current
+    cache, e.g. a cache shared by a team; each one is consulted using its own index
+
+    Args:
+     paths (list or string) : list of cache directories, or a string of
+      directories separated by ':'; an empty list removes shared caches
+
+     promote (bool) : if True, an object found in a shared cache is made available in
+      the current cache as a hard link (which needs both caches to be on the same
+      file system); otherwise, the shared cache file is used directly
+
+    Defaults for CliMAF sessions are taken from environment variables $CLIMAF_SHARED_CACHE
+    and $CLIMAF_SHARED_CACHE_PROMOTE
+    """
+    global shared_caches, cachedirs, promote_shared
+    if isinstance(paths, str):
+        paths = [p for p in paths.split(":") if p]
+    for index in shared_indexes:
+        index.close()
+    del shared_indexes[:]
+    shared_caches = []
+    for path in paths:
+        path = os.path.expanduser(path)
+        if currentCache is not None and os.path.realpath(path) == os.path.realpath(os.path.expanduser(currentCache)):
+            continue
+        try:
+            index = open_index(path, None, readonly=True)
+            index.load()
+        except Exception, e:
+            clogger.warning("Cannot use shared cache %s : %s" % (path, e))
+            continue
+        clogger.info("Using shared cache %s (%s index)" % (path, index_backend_of(path)))
+        shared_caches.append(path)
+        shared_indexes.append(index)
+    if currentCache is not None:
+        cachedirs = [currentCache] + shared_caches
+    if promote is not None:
+        promote_shared = promote
+
+
+def cached_file(crs):
+    """
+    Returns the cache file for CRS, either in the current cache or in a shared cache, or None
+    """
+    for index in [crs2filename] + shared_indexes:
+        filename = index.get(crs, legacy_crs.get(crs) and index.get(legacy_crs[crs]))
+        if filename:
+            return filename
 
 
 def generateUniqueFileName(expression, operator=None, format="nc"):
@@ -124,9 +327,9 @@ def generateUniqueFileName_safe(expression, operator=None, format="nc"):
     if existing:
         readCRS = getCRS(existing)
         # Update index if needed
-        if readCRS not in crs2filename:
+        if readCRS not in crs2filename and existing.startswith(os.path.expanduser(currentCache)):
             clogger.warning("existing data %s in file %s was not yet registered in cache index" % (readCRS, existing))
-            crs2filename[readCRS] = existing
+            index_file(readCRS, existing)
     while (existing is not None) and (readCRS != expression):
         clogger.debug("must skip %s which CRS is %s" % (existing, getCRS(existing)))
         number += 2
@@ -174,103 +377,138 @@ def searchFile(path):
             return candidate
 
 
-def register(filename, crs, outfilename=None):
+def register(filename, crs, outfilename=None, cost=None):
     """
     Adds in FILE a metadata named 'CRS_def' and with value CRS, and a
     metadata 'CLiMAF' with CliMAF version and ref URL
 
-    Records this FILE in dict crs2filename
+    Records this FILE in dict crs2filename, with its computation time COST (in s)
 
     If OUTFILENAME is not None, FILENAME is a temporary file and
     it's OUTFILENAME which is recorded in dict crs2filename
 
+    Then enforces cache size limits (see :py:func:`cevict`)
+
     Silently skip non-existing files
     """
     # First read index from file if it is yet empty - No : done at startup
     # if len(crs2filename.keys()) == 0 : cload()
     # It appears that we have to let some time to the file system  for updating its inode tables
-    global dropped_crs
-    if not stamping:
-        clogger.debug('No stamping')
-        crs2filename[crs] = filename
-        return True
     waited = 0
     while waited < 50 and not os.path.exists(filename):
         time.sleep(0.1)
         waited += 1
-    # time.sleep(0.5)
-    if os.path.exists(filename):
-        # while time.time() < os.path.getmtime(filename) + 0.2 : time.sleep(0.2)
-        if re.findall(".nc$", filename):
-            command = "ncatted -h -a CRS_def,global,o,c,\"%s\" -a CliMAF,global,o,c,\"CLImate Model Assessment " \
-                      "Framework version %s (http://climaf.rtfd.org)\" %s" % (crs, version, filename)
-        if re.findall(".png$", filename):
-            crs2 = crs.replace("%", "\%")
-            command = "convert -set \"CRS_def\" \"%s\" -set \"CliMAF\" \"CLImate Model Assessment Framework version " \
-                      "%s (http://climaf.rtfd.org)\" %s %s.png && mv -f %s.png %s" % \
-                      (crs2, version, filename, filename, filename, filename)
-        if re.findall(".pdf$", filename):
-            tmpfile = str(uuid.uuid4())
-            command = "pdftk %s dump_data output %s && echo -e \"InfoBegin\nInfoKey: Keywords\nInfoValue: %s\" >> %s " \
-                      "&& pdftk %s update_info %s output %s.pdf && mv -f %s.pdf %s && rm -f %s" % \
-                      (filename, tmpfile, crs, tmpfile, filename, tmpfile, filename, filename, filename, tmpfile)
-        if re.findall(".eps$", filename):
-            command = 'exiv2 -M"add Xmp.dc.CliMAF CLImate Model Assessment Framework version %s ' \
-                      '(http://climaf.rtfd.org)" -M"add Xmp.dc.CRS_def %s" %s' % \
-                      (version, crs, filename)
-        clogger.debug("trying stamping by %s" % command)
-        if os.system(command) == 0:
-            if outfilename:
-                cmd = 'mv -f %s %s ' % (filename, outfilename)
-                if os.system(cmd) == 0:
-                    clogger.info("move %s as %s " % (filename, outfilename))
-                    clogger.info("%s registered as %s" % (crs, outfilename))
-                    crs2filename[crs] = outfilename
-                    if crs in dropped_crs:
-                        dropped_crs.remove(crs)
-                    return True
-                else:
-                    clogger.critical("cannot move by" % cmd)
-                    exit()
-                    return None
-            else:
-                clogger.info("%s registered as %s" % (crs, filename))
-                crs2filename[crs] = filename
-                if crs in dropped_crs:
-                    dropped_crs.remove(crs)
-                return True
-        else:
-            clogger.critical("cannot stamp by %s" % command)
-            exit()
-            return None
-    else:
+    if not os.path.exists(filename):
         clogger.error("file %s does not exist (for crs %s)" % (filename, crs))
+        return None
+    level = compression_level(crs[:crs.find("(")])
+    if level and filename.endswith(".nc"):
+        compress(filename, level)
+    if not stamping:
+        clogger.debug('No stamping')
+    elif not write_crs(filename, crs):
+        clogger.critical("cannot stamp %s" % filename)
+        exit()
+        return None
+    if outfilename:
+        # Stamped file is published in one step, so that other processes never see it partially written
+        try:
+            os.rename(filename, outfilename)
+        except OSError:
+            cmd = 'mv -f %s %s ' % (filename, outfilename)
+            if os.system(cmd) != 0:
+                clogger.critical("cannot move by" % cmd)
+                exit()
+                return None
+        clogger.info("move %s as %s " % (filename, outfilename))
+        filename = outfilename
+    clogger.info("%s registered as %s" % (crs, filename))
+    count("bytes_written", os.path.getsize(filename))
+    index_file(crs, filename, cost)
+    enforce_limits(crs)
+    return True
+
+
+def published(crs, filename):
+    """
+    Returns FILENAME if it is the cache file for CRS (e.g. as published by another process), and
+    ensures that it is indexed; returns None otherwise
+    """
+    if not os.path.exists(filename):
+        return None
+    if crs not in crs2filename:
+        if stamping and getCRS(filename) != crs:
+            return None
+        index_file(crs, filename)
+    return filename
+
+
+class computation_lock(object):
+    """
+    An exclusive lock on the computation of cache file FILENAME, shared by all CliMAF
+    processes (and threads) using the cache; it uses fcntl.flock on file FILENAME.lock
+
+    A process which has to wait for the lock can then use the result published meanwhile
+    by its holder (see :py:func:`published`)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename + ".lock"
+        self.fd = None
+        #: Whether another holder of the lock had to be waited for
+        self.waited = False
+
+    def acquire(self, timeout=None):
+        """
+        Waits for the lock at most TIMEOUT seconds (default : 'lock_timeout'); returns True
+        if the lock is acquired
+        """
+        if timeout is None:
+            timeout = lock_timeout
+        deadline = time.time() + timeout
+        while True:
+            fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                os.close(fd)
+                if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                    raise
+                if not self.waited:
+                    clogger.info("Waiting for another process computing %s" % self.filename[:-5])
+                self.waited = True
+                if time.time() > deadline:
+                    return False
+                time.sleep(lock_poll)
+                continue
+            # The former holder removes the lock file; check that we locked the current one
+            try:
+                current = os.fstat(fd).st_ino == os.stat(self.filename).st_ino
+            except OSError:
+                current = False
+            if current:
+                self.fd = fd
+                return True
+            os.close(fd)
+
+    def release(self):
+        if self.fd is not None:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
 
 
 def getCRS(filename):
     """ Returns the CRS expression found in FILENAME's meta-data"""
-    import subprocess
-    if re.findall(".nc$", filename):
-        form = 'ncdump -h %s | grep -E "CRS_def *=" | ' + \
-               'sed -r -e "s/.*:CRS_def *= *\\\"(.*)\\\" *;$/\\1/" '
-    elif re.findall(".png$", filename):
-        form = 'identify -verbose %s | grep -E " *CRS_def: " | sed -r -e "s/.*CRS_def: *//"'
-    elif re.findall(".pdf$", filename):
-        form = 'pdfinfo %s | grep "Keywords" | awk -F ":" \'{print $2}\' | sed "s/^ *//g"'
-    elif re.findall(".eps$", filename):
-        form = 'exiv2 -p x %s | grep "CRS_def" | awk \'{for (i=4;i<=NF;i++) {print $i " "} }\' '
-    else:
-        clogger.error("unknown filetype for %s" % filename)
+    rep = read_crs(filename)
+    if rep is None:
         return None
-    command = form % filename
-    try:
-        rep = subprocess.check_output(command, shell=True).replace('\n', '')
-        if (rep == "") and ('Empty.png' not in filename):
-            clogger.error("file %s is not well formed (no CRS)" % filename)
-        if re.findall(".nc$", filename):
-            rep = rep.replace(r"\'", r"'")
-    except:
-        rep = "failed"
+    if (rep == "") and ('Empty.png' not in filename):
+        clogger.error("file %s is not well formed (no CRS)" % filename)
     clogger.debug("CRS expression read in %s is %s" % (filename, rep))
     return rep
 
@@ -280,15 +518,154 @@ def rename(filename, crs):
     crs2filename """
     newfile = generateUniqueFileName(crs, format="nc")
     if newfile:
-        l = [c for c in crs2filename if crs2filename[c] == filename]
+        l = crs2filename.crs_of(filename)
+        dependencies = []
         for c in l:
+            dependencies.extend(crs2filename.dependencies(c))
             crs2filename.pop(c)
-        os.rename(filename, newfile)
-        register(newfile, crs)
-        return newfile
+        if register(filename, crs, newfile):
+            crs2filename.set_dependencies(crs, set(dependencies))
+            return newfile
+
+
+def index_file(crs, filename, cost=None):
+    """
+    Records FILENAME as the cache file for CRS in the cache index, together with its shape,
+    its project and its computation time COST
+    """
+    crs2filename.record(crs, filename, cost=cost, project=project_of(crs), **shape_fields(crs))
+    if subsettable is not None and is_subsettable(crs):
+        subsettable.add(crs)
+
+
+def project_of(crs):
+    """
+    Returns the project which cached object for CRS is accounted to : the project of its first dataset
+    """
+    projects = guess_projects(crs)
+    if projects:
+        return projects[0]
+
+
+def crs_object(crs):
+    """
+    Returns the CliMAF object for expression CRS (evaluated once per session), or None
+    """
+    co = memory.get(("eval", crs))
+    if co is None:
+        try:
+            co = eval(crs, sys.modules['__main__'].__dict__)
+            if co:
+                # A rough estimate of the size of the object tree
+                memory.put(("eval", crs), co, 10 * len(crs))
+        except:
+            pass  # usually case of a CRS which project is not currently defined
+    return co
+
+
+def datestring(date):
+    """
+    Returns a string for DATE which sorts as dates do
+    """
+    return "%04d%02d%02d%02d%02d" % (date.year, date.month, date.day, date.hour, date.minute)
+
+
+def shape(cobj):
+    """
+    Returns the structural signature of COBJ and the period shared by all its datasets
+
+    The signature is COBJ's CRS where all datasets periods are blanked; the
+    period is None if datasets do not share a same period, or if the object
+    has no time period
+    """
+    periods = dict()
+
+    def collect_periods(obj):
+        if isinstance(obj, cdataset):
+            if not isinstance(obj.period, cperiod) or obj.period.fx:
+                return False
+            periods[repr(obj.period)] = obj.period
+            return True
+        elif isinstance(obj, ctree):
+            return all([collect_periods(op) for op in obj.operands if op])
+        elif isinstance(obj, scriptChild):
+            return collect_periods(obj.father)
+        return False
+
+    if not collect_periods(cobj) or len(periods) != 1:
+        return "", None
+    return cobj.buildcrs(period=""), periods.values()[0]
+
+
+def shape_fields(crs):
+    """
+    Returns the shape of the object for CRS as a dict of cache index fields (empty if
+    the CRS cannot be evaluated)
+    """
+    co = crs_object(crs)
+    if co is None:
+        return dict()
+    signature, period = shape(co)
+    if period is None:
+        return dict(signature=signature)
+    return dict(signature=signature, pstart=datestring(period.start), pend=datestring(period.end))
+
+
+def update_shapes():
+    """
+    Computes the shape of index entries which were registered without one (e.g.
+    by a former CliMAF version); this is done once per session
+    """
+    shapes = []
+    for crs in crs2filename.unshaped():
+        if crs in unshapable:
+            continue
+        fields = shape_fields(crs)
+        if fields:
+            shapes.append((crs, fields["signature"], fields.get("pstart"), fields.get("pend")))
+        else:
+            unshapable.add(crs)
+    if shapes:
+        clogger.debug("Recording shape for %d cache index entries" % len(shapes))
+        crs2filename.set_shapes(shapes)
 
 
-def hasMatchingObject(cobject, ds_func):
+def shaped_candidates(cobject, relation):
+    """
+    Returns the list of CRS of cached objects which have the same shape as COBJECT
+    and which period, depending on RELATION, either includes COBJECT's one
+    ('including') or begins it ('begin'), in order of preference
+    """
+    signature, period = shape(cobject)
+    if period is None:
+        return []
+    global shapes_updated
+    if not shapes_updated:
+        update_shapes()
+        shapes_updated = True
+    start, end = datestring(period.start), datestring(period.end)
+    entries = set(crs2filename.shapes(signature))
+    for index in shared_indexes:
+        entries.update(index.shapes(signature))
+    entries = sorted(entries)
+    starts = [pstart for pstart, pend, crs in entries]
+    if relation == "including":
+        # Entries are sorted on period start; prefer the shortest including periods
+        found = [(pstart, pend, crs) for pstart, pend, crs in entries[:bisect.bisect_right(starts, start)]
+                 if pend >= end]
+        found.sort(key=itemgetter(0), reverse=True)
+        found.sort(key=itemgetter(1))
+    elif relation == "begin":
+        # Prefer the longest beginning periods
+        found = [(pstart, pend, crs) for pstart, pend, crs in
+                 entries[bisect.bisect_left(starts, start):bisect.bisect_right(starts, start)] if pend < end]
+        found.sort(key=itemgetter(1), reverse=True)
+    else:
+        raise Climaf_Cache_Error("Unknown relation %s" % relation)
+    return [crs for pstart, pend, crs in found]
+
+
+def hasMatchingObject(cobject, ds_func, candidates=None, accept=None):
     """
     If the cache holds a file which represents an object with the
     same nodes as COBJECT and which leaves/datasets, when paired with
@@ -298,6 +675,12 @@ def hasMatchingObject(cobject, ds_func):
 
     Can be applied for finding same object with included or including
     time-period
+
+    The search is restricted to the list of CRS CANDIDATES if provided
+    (see :py:func:`shaped_candidates`); otherwise, all objects of the current cache are tested
+
+    If function ACCEPT is provided, it tells, given a cached object and the value, if the
+    object is relevant; otherwise, objects must not include operators which squeeze time
     """
 
     # First read index from file if it is yet empty - No : done at startup
@@ -306,37 +689,157 @@ def hasMatchingObject(cobject, ds_func):
         return not operators.scripts[operator].flags.commuteWithTimeConcatenation
 
     #
-    global crs2eval
     key_to_rm = list()
-    for crs in crs2filename:
-        co = crs2eval.get(crs, None)
-        if co is None:
-            try:
-                co = eval(crs, sys.modules['__main__'].__dict__)
-                if co:
-                    crs2eval[crs] = co
-            except:
-                pass  # usually case of a CRS which project is not currently defined
+    if candidates is None:
+        candidates = crs2filename.keys()
+    for crs in candidates:
+        co = crs_object(crs)
         if co:
-            altperiod = compare_trees(co, cobject, ds_func, op_squeezes_time)
+            if accept is None:
+                altperiod = compare_trees(co, cobject, ds_func, op_squeezes_time)
+            else:
+                altperiod = compare_trees(co, cobject, ds_func)
+                if altperiod and not accept(co, altperiod):
+                    altperiod = None
             if altperiod:
-                if os.path.exists(crs2filename[crs]):
+                filename = cached_file(crs)
+                if filename and os.path.exists(filename):
+                    if co.crs != crs:
+                        adopt_legacy(crs, co.crs)
                     return co, altperiod
                 else:
                     clogger.debug("Removing %s from cache index, because file is missing", crs)
                     key_to_rm.append(crs)
     for el in key_to_rm:
-        crs2filename.pop(el)
+        crs2filename.pop(el, None)
     return None, None
 
 
+def domain_includes(includer, included):
+    """
+    Tells if domain INCLUDER (either 'global' or a list [latmin, latmax, lonmin, lonmax]) includes domain INCLUDED
+    """
+    if includer == "global":
+        return True
+    if isinstance(includer, list) and isinstance(included, list) and len(includer) == len(included) == 4:
+        return includer[0] <= included[0] and included[1] <= includer[1] and \
+            includer[2] <= included[2] and included[3] <= includer[3]
+    return False
+
+
+def ds_inclusion(includer, included):
+    """
+    Tells how dataset INCLUDER includes dataset INCLUDED : returns the '+'-separated list of
+    the dimensions among 'period', 'domain' and 'variable' for which it is larger, or None
+    """
+    if includer.project != included.project:
+        return None
+    others = [k for k in includer.kvp if k not in ["period", "domain", "variable"]]
+    if [includer.kvp[k] for k in others] != [included.kvp.get(k) for k in others]:
+        return None
+    dimensions = []
+    if repr(includer.period) != repr(included.period):
+        if includer.period.fx or included.period.fx or not includer.period.includes(included.period):
+            return None
+        dimensions.append("period")
+    if includer.domain != included.domain:
+        if not domain_includes(includer.domain, included.domain):
+            return None
+        dimensions.append("domain")
+    if includer.variable != included.variable:
+        # Variables extracted from a group are not aliased
+        if included.alias or not set(included.variable.split(",")) < set(includer.variable.split(",")):
+            return None
+        dimensions.append("variable")
+    return "+".join(dimensions) or None
+
+
+def operators_commute(cobj, dimensions):
+    """
+    Tells if the operators of COBJ commute with the selection on DIMENSIONS (as returned
+    by :py:func:`ds_inclusion`) : selecting a sub-period (resp. a sub-domain) requires
+    operators which commute with time (resp. space) concatenation, and selecting a
+    variable is only allowed on the plain extraction of a dataset
+    """
+    if isinstance(cobj, scriptChild):
+        return operators_commute(cobj.father, dimensions)
+    if not isinstance(cobj, ctree):
+        return isinstance(cobj, cdataset)
+    if "variable" in dimensions and cobj.operator != "select":
+        return False
+    flags = operators.scripts[cobj.operator].flags
+    if "period" in dimensions and not flags.commuteWithTimeConcatenation:
+        return False
+    if "domain" in dimensions and not flags.commuteWithSpaceConcatenation:
+        return False
+    return all([operators_commute(op, dimensions) for op in cobj.operands if op])
+
+
+def datasets_of(cobj):
+    """
+    Returns the list of datasets in object COBJ
+    """
+    if isinstance(cobj, cdataset):
+        return [cobj]
+    if isinstance(cobj, ctree):
+        return sum([datasets_of(op) for op in cobj.operands if op], [])
+    if isinstance(cobj, scriptChild):
+        return datasets_of(cobj.father)
+    return []
+
+
+def is_subsettable(crs):
+    """
+    Tells if CRS may include datasets with a domain box or a group of variables
+    """
+    return re.search(r"ds\('[^']*,", crs) is not None
+
+
+def subset_candidates(cobject):
+    """
+    Returns the list of CRS of cached objects which may include COBJECT on the domain or
+    the variable dimension : the object with a global domain, and the objects which
+    datasets have a domain box or a group of variables
+    """
+    global subsettable
+    datasets = datasets_of(cobject)
+    if not datasets:
+        return []
+    candidates = []
+    if any([ds.domain != "global" for ds in datasets]):
+        # A global field may have been cached
+        larger = copy.deepcopy(cobject)
+        for ds in datasets_of(larger):
+            ds.kvp["domain"] = ds.domain = "global"
+        larger.crs = larger.buildcrs()
+        if cached_file(larger.crs):
+            candidates.append(larger.crs)
+        candidates.extend(shaped_candidates(larger, "including"))
+    if subsettable is None:
+        subsettable = set([crs for crs in crs2filename if is_subsettable(crs)])
+        for index in shared_indexes:
+            subsettable.update([crs for crs in index if is_subsettable(crs)])
+    operator = cobject.crs[:cobject.crs.find("(") + 1]
+    candidates.extend([crs for crs in subsettable if crs.startswith(operator) and crs != cobject.crs])
+    return candidates
+
+
 def hasIncludingObject(cobject):
-    def ds_period_difference(includer, included):
-        if includer.buildcrs(period="") == included.buildcrs(period=""):
-            return includer.period.includes(included.period)
+    """
+    Searches the cache for an object which includes COBJECT : the same object for a
+    larger period, a larger domain (a global one or a larger box), or a group of variables
+    including COBJECT's ones, provided its operators allow for selecting COBJECT out of it
+    (see :py:func:`operators_commute`)
 
+    Returns the cached object and the dimensions for which it is larger (see :py:func:`ds_inclusion`),
+    or (None, None)
+    """
     clogger.debug("search for including object for " + repr(cobject))
-    return hasMatchingObject(cobject, ds_period_difference)
+    candidates = shaped_candidates(cobject, "including")
+    for crs in subset_candidates(cobject):
+        if crs not in candidates:
+            candidates.append(crs)
+    return hasMatchingObject(cobject, ds_inclusion, candidates, operators_commute)
 
 
 def hasBeginObject(cobject):
@@ -344,7 +847,83 @@ def hasBeginObject(cobject):
         if longer.buildcrs(period="") == begin.buildcrs(period=""):
             return longer.period.start_with(begin.period)
 
-    return hasMatchingObject(cobject, ds_period_begins)
+    return hasMatchingObject(cobject, ds_period_begins, shaped_candidates(cobject, "begin"))
+
+
+def plan_chunks(period, chunks):
+    """
+    Plans the coverage of PERIOD using some of the CHUNKS, a list of pairs (chunk period, CRS)
+    of chunk periods included in PERIOD, which may overlap each other
+
+    Returns the list of pairs (period, CRS) which tile PERIOD in time order, where CRS is None
+    for the gaps which must be computed; chunks are selected so that the duration of gaps
+    is minimal, and then the number of pieces
+    """
+    bounds = set([period.start, period.end])
+    starting = dict()
+    for chunk, crs in chunks:
+        bounds.update([chunk.start, chunk.end])
+        starting.setdefault(chunk.start, []).append((chunk, crs))
+    bounds = sorted(bounds)
+    # For each bound, the best (gaps duration, number of pieces, pieces) covering the period up to it
+    best = {period.start: (0., 0, [])}
+    for i, bound in enumerate(bounds):
+        if bound not in best:
+            continue
+        gaps, npieces, pieces = best[bound]
+        moves = [(chunk.end, 0., (chunk, crs)) for chunk, crs in starting.get(bound, [])]
+        moves.extend([(end, (end - bound).total_seconds(), (cperiod(bound, end), None)) for end in bounds[i + 1:]])
+        for end, gap, piece in moves:
+            candidate = (gaps + gap, npieces + 1, pieces + [piece])
+            if end not in best or candidate[:2] < best[end][:2]:
+                best[end] = candidate
+    return best[period.end][2]
+
+
+def hasChunkedObject(cobject):
+    """
+    Searches the cache for objects which are the same as COBJECT for sub-periods of its period
+    (chunks), provided its operators commute with time concatenation
+
+    Returns the list of pairs (period, CRS) which tile COBJECT's period using the minimal set of
+    cached chunks (see :py:func:`plan_chunks`), where CRS is None for the gaps to compute; returns
+    None if no chunk is cached
+    """
+    if not isinstance(cobject, ctree):
+        return None
+    signature, period = shape(cobject)
+    if period is None:
+        return None
+
+    def op_squeezes_time(operator):
+        return not operators.scripts[operator].flags.commuteWithTimeConcatenation
+
+    def ds_chunk(chunk, whole):
+        if chunk.buildcrs(period="") == whole.buildcrs(period="") and whole.period.includes(chunk.period):
+            return chunk.period
+
+    start, end = datestring(period.start), datestring(period.end)
+    entries = set(crs2filename.shapes(signature))
+    for index in shared_indexes:
+        entries.update(index.shapes(signature))
+    chunks = []
+    for pstart, pend, crs in sorted(entries):
+        if pstart < start or pend > end or (pstart, pend) == (start, end):
+            continue
+        co = crs_object(crs)
+        if co is None or not isinstance(co, ctree):
+            continue
+        chunk = compare_trees(co, cobject, ds_chunk, op_squeezes_time)
+        if chunk and cached_file(crs):
+            if co.crs != crs:
+                adopt_legacy(crs, co.crs)
+            chunks.append((chunk, co.crs))
+    if not chunks:
+        return None
+    pieces = plan_chunks(period, chunks)
+    if all([piece_crs is None for piece_period, piece_crs in pieces]):
+        return None
+    return pieces
 
 
 def hasExactObject(cobject):
@@ -353,10 +932,61 @@ def hasExactObject(cobject):
     f = crs2filename.get(cobject.crs, None)
     if f:
         if os.path.exists(f):
+            crs2filename.touch(cobject.crs)
             return f
         else:
             clogger.debug("Dropping cobject.crs from cache index, because file si missing")
             crs2filename.pop(cobject.crs)
+    for index in shared_indexes:
+        f = index.get(cobject.crs, None)
+        if f and os.path.exists(f):
+            clogger.debug("Object %s found in shared cache %s" % (cobject.crs, index.cachedir))
+            if promote_shared:
+                return promote(cobject.crs, f)
+            return f
+    # The object may have been cached under its CRS as built by a former CliMAF version
+    legacy = cobject.buildcrs(canonical=False)
+    if legacy != cobject.crs and cached_file(legacy):
+        f = adopt_legacy(legacy, cobject.crs)
+        if f and os.path.exists(f):
+            return f
+
+
+def adopt_legacy(legacy, crs):
+    """
+    Makes the cache file of an object, recorded under its LEGACY CRS (i.e. not in canonical
+    form, see :py:func:`~climaf.classes.canonical_repr`), available under its canonical CRS.
+    In the current cache, its index entry is renamed; returns the file
+    """
+    filename = crs2filename.get(legacy)
+    if filename:
+        clogger.debug("Renaming cache index entry %s as %s" % (legacy, crs))
+        entry = crs2filename.entry(legacy)
+        dependencies = crs2filename.dependencies(legacy)
+        index_file(crs, filename, entry.get("cost"))
+        del crs2filename[legacy]
+        crs2filename.set_dependencies(crs, dependencies)
+        return filename
+    legacy_crs[crs] = legacy
+    return cached_file(crs)
+
+
+def promote(crs, filename):
+    """
+    Makes shared cache file FILENAME for CRS available in the current cache, using a hard link,
+    and returns the new filename (or FILENAME if the link cannot be created)
+    """
+    link = generateUniqueFileName(crs, format=os.path.splitext(filename)[1][1:])
+    try:
+        if os.path.exists(link):
+            os.remove(link)
+        os.link(filename, link)
+    except OSError, e:
+        clogger.debug("Cannot promote %s to current cache : %s" % (filename, e))
+        return filename
+    clogger.info("Promoted %s from shared cache as %s" % (crs, link))
+    index_file(crs, link)
+    return link
 
 
 def complement(crsb, crse, crs):
@@ -365,17 +995,128 @@ def complement(crsb, crse, crs):
     CRS. Assumes that everything is OK with args compatibility and
     file contents
     """
-    fileb = crs2filename[crsb]
-    filee = crs2filename[crse]
+    return mosaic([crsb, crse], crs)
+
+
+def mosaic(chunks, crs, keep=None):
+    """
+    Concatenates in time the cached files of objects for the list of CRS CHUNKS, in time order,
+    for creating the file object of CRS, and returns its filename (or None on failure).
+    Assumes that everything is OK with args compatibility and file contents
+
+    The chunks are kept in the cache, for being re-used, unless KEEP (which defaults
+    to :py:data:`keep_chunks`) is False
+    """
+    if keep is None:
+        keep = keep_chunks
+    files = [cached_file(chunk) for chunk in chunks]
+    filet = generateUniqueFileName(crs)
+    tmpfile, tmpfile_fmt = os.path.splitext(filet)
+    tmpfile = "%s_%i%s" % (tmpfile, os.getpid(), tmpfile_fmt)
+    command = "ncrcat -O %s %s" % (" ".join(files), tmpfile)
+    if None in files or os.system(command) != 0:
+        clogger.error("Issue when merging %s in %s (using command:%s)" % (" and ".join(chunks), crs, command))
+        return None
+    else:
+        dependencies = set(sum([crs2filename.dependencies(chunk) for chunk in chunks], []))
+        if not keep:
+            for chunk in chunks:
+                cdrop(chunk)
+        register(tmpfile, crs, filet)
+        crs2filename.set_dependencies(crs, dependencies)
+        return filet
+
+
+def collage(tiles, crs, keep=None):
+    """
+    Assembles the cached files of objects for the list of CRS TILES, which are bands of grid rows
+    in increasing row order, for creating the file object of CRS, and returns its filename (or None
+    on failure). Assumes that everything is OK with args compatibility and file contents
+
+    The tiles are kept in the cache, for being re-used, unless KEEP (which defaults
+    to :py:data:`keep_chunks`) is False
+    """
+    if keep is None:
+        keep = keep_chunks
+    files = [cached_file(tile) for tile in tiles]
+    filet = generateUniqueFileName(crs)
+    tmpfile, tmpfile_fmt = os.path.splitext(filet)
+    tmpfile = "%s_%i%s" % (tmpfile, os.getpid(), tmpfile_fmt)
+    command = "cdo -O collgrid,1 %s %s" % (" ".join(files), tmpfile)
+    if None in files or os.system(command) != 0:
+        clogger.error("Issue when assembling %s in %s (using command:%s)" % (" and ".join(tiles), crs, command))
+        return None
+    else:
+        dependencies = set(sum([crs2filename.dependencies(tile) for tile in tiles], []))
+        if not keep:
+            for tile in tiles:
+                cdrop(tile)
+        register(tmpfile, crs, filet)
+        crs2filename.set_dependencies(crs, dependencies)
+        return filet
+
+
+def record_count(filename):
+    """
+    Returns the name and length of the record dimension of NetCDF file FILENAME, or (None, None)
+    """
+    header = subprocess.Popen(["ncdump", "-h", filename], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE).communicate()[0]
+    match = re.search(r"(\S+) = UNLIMITED ; // \((\d+) currently\)", header)
+    if match is None:
+        return None, None
+    return match.group(1), int(match.group(2))
+
+
+def extend(crsb, crse, crs):
+    """
+    Extends the file object of CRSB (B for 'begin'), which must be in the current cache, in place
+    with the records of file object of CRSE (E for 'end'), appended along the record (time)
+    dimension, for creating file object of CRS; once done, the objects for CRSB and CRSE are
+    dropped. A file shared with another cache (see :py:data:`promote_shared`) or protected
+    is extended on a copy. Returns the filename, or None on failure (then, both objects are
+    left unchanged, the records appended being removed). Must be called by the holder of the
+    computation lock for CRS; assumes that everything is OK with args compatibility and file contents
+    """
+    fileb = crs2filename.get(crsb)
+    filee = cached_file(crse)
+    if not fileb or not filee:
+        return None
+    dependencies = set(crs2filename.dependencies(crsb) + crs2filename.dependencies(crse))
     filet = generateUniqueFileName(crs)
-    command = "ncrcat -O %s %s %s" % (fileb, filee, filet)
-    if os.system(command) != 0:
-        clogger.error("Issue when merging %s and %s in %s (using command:%s)" % (crsb, crse, crs, command))
+    in_place = os.stat(fileb).st_nlink == 1 and not is_protected(fileb)
+    if in_place:
+        target = fileb
+        dimension, length = record_count(fileb)
+        if dimension is None:
+            clogger.error("Cannot extend %s : no record dimension in %s" % (crsb, fileb))
+            return None
+    else:
+        target, target_fmt = os.path.splitext(filet)
+        target = "%s_%i%s" % (target, os.getpid(), target_fmt)
+    command = "ncrcat --rec_apn %s %s" % (filee, target)
+    try:
+        if not in_place:
+            shutil.copyfile(fileb, target)
+        if os.system(command) != 0:
+            raise Climaf_Cache_Error("command failed : %s" % command)
+    except (IOError, OSError, Climaf_Cache_Error), e:
+        clogger.error("Issue when extending %s with %s : %s" % (crsb, crse, e))
+        if not in_place:
+            if os.path.exists(target):
+                os.remove(target)
+        elif os.system("ncks -O -d %s,0,%d %s %s" % (dimension, length - 1, fileb, fileb)) != 0:
+            clogger.error("Cannot restore %s : dropping it" % crsb)
+            cdrop(crsb)
         return None
+    cdrop(crse)
+    if in_place:
+        # The file of CRSB becomes the one of CRS
+        crs2filename.pop(crsb)
     else:
         cdrop(crsb)
-        cdrop(crse)
-        register(filet, crs)
+    if register(target, crs, filet):
+        crs2filename.set_dependencies(crs, dependencies)
         return filet
 
 
@@ -401,9 +1142,6 @@ def cdrop(obj, rm=True, force=False):
     >>> cdrop(dg)
 
     """
-    global crs2filename
-    global dropped_crs
-
     if isinstance(obj, cobject):
         crs = repr(obj)
         if isinstance(obj, cdataset):
@@ -426,7 +1164,6 @@ def cdrop(obj, rm=True, force=False):
                 path_file = os.path.dirname(fil)
                 os.remove(fil)
                 crs2filename.pop(crs)
-                dropped_crs.append(crs)
                 try:
                     os.rmdir(path_file)
                 except OSError as ex:
@@ -441,6 +1178,299 @@ def cdrop(obj, rm=True, force=False):
         return None
 
 
+def size_in_bytes(size):
+    """
+    Returns the number of bytes for SIZE, which is either a number or a string with
+    an optional unit among c (bytes), k, M, G and T (e.g. '500G')
+    """
+    if not isinstance(size, str):
+        return int(size or 0)
+    size = size.strip()
+    if size == "":
+        return 0
+    units = dict(c=1, k=2 ** 10, K=2 ** 10, M=2 ** 20, G=2 ** 30, T=2 ** 40)
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+
+def set_size_limits(size=None, quotas=None):
+    """
+    Sets the maximum cache size and per-project quotas, which are enforced after
+    each new cache file (see :py:func:`cevict`)
+
+    Args:
+     size (number or string) : maximum size of the cache, e.g. '500G' (see :py:func:`size_in_bytes`);
+     0 means no limit
+
+     quotas (dict or string) : maximum size of the cached objects of some projects, either as a
+     dict project -> size, or as a string such as 'CMIP6:200G,EM:20G'
+
+    Defaults for CliMAF sessions are taken from environment variables $CLIMAF_CACHE_MAX_SIZE
+    and $CLIMAF_CACHE_QUOTAS
+    """
+    global max_size, project_quotas
+    if size is not None:
+        max_size = size_in_bytes(size)
+    if quotas is not None:
+        if isinstance(quotas, str):
+            quotas = dict([q.rsplit(":", 1) for q in quotas.replace(" ", "").split(",") if q])
+        project_quotas = dict([(project, size_in_bytes(q)) for project, q in quotas.items()])
+
+
+def set_compression(policy):
+    """
+    Sets the storage policy for NetCDF cache files : their deflate level, globally and per
+    operator; with a non-zero level, files are written as NetCDF4 with zlib deflate and
+    shuffle filters, either directly by CDO (for operators using script mcdo.sh, through
+    environment variable $CLIMAF_CDO_OPTIONS) or by compressing them with nccopy when
+    they are cached (see :py:func:`compress`). Reading them is unchanged
+
+    Args:
+     policy (int, dict or string) : either a global level, or a dict operator -> level, where
+      operator None stands for the global level, or a string such as '4,select:6,plot:0'
+
+    The default for CliMAF sessions is taken from environment variable $CLIMAF_CACHE_COMPRESSION
+    """
+    global compression, operator_compression
+    if isinstance(policy, str):
+        policy = dict([(p.split(":")[0] if ":" in p else None, p.split(":")[-1])
+                       for p in policy.replace(" ", "").split(",") if p])
+    if not isinstance(policy, dict):
+        policy = {None: policy}
+    policy = dict([(operator, int(level or 0)) for operator, level in policy.items()])
+    if any([not 0 <= level <= 9 for level in policy.values()]):
+        raise Climaf_Cache_Error("Deflate levels must be between 0 and 9 : %s" % policy)
+    compression = policy.pop(None, 0)
+    operator_compression = policy
+
+
+def compression_level(operator):
+    """
+    Returns the deflate level for the NetCDF outputs of OPERATOR (see :py:func:`set_compression`)
+    """
+    return operator_compression.get(operator, compression)
+
+
+def compress(filename, level):
+    """
+    Converts NetCDF file FILENAME, if it is in a classic (uncompressed) format, to NetCDF4
+    with deflate LEVEL and shuffle filter, using nccopy (in place); NetCDF4 files are left
+    as is. Returns False if compression failed
+    """
+    with open(filename, "rb") as f:
+        if not f.read(4).startswith("CDF"):
+            return True
+    tmpfile = filename + ".deflate"
+    command = "nccopy -k nc4 -d %d -s %s %s" % (level, filename, tmpfile)
+    if os.system(command + " >/dev/null 2>&1") != 0:
+        clogger.warning("Cannot compress %s (using command:%s)" % (filename, command))
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        return False
+    os.rename(tmpfile, filename)
+    return True
+
+
+def is_protected(filename):
+    """
+    Tells if FILENAME is protected (see :py:func:`cprotect`), i.e. is not writable
+    """
+    try:
+        return os.stat(filename).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH) == 0
+    except OSError:
+        return False
+
+
+def retention_value(entry, now):
+    """
+    Returns the value of keeping the cached object for index ENTRY : its computation time
+    per byte, divided by a factor increasing with the time since its last access
+    """
+    cost = entry.get("cost")
+    if cost is None:
+        cost = default_cost
+    last = entry.get("accessed") or entry.get("created") or now
+    return float(cost) / max(entry.get("size") or 0, 1) / (1. + max(now - last, 0) / eviction_age_scale)
+
+
+def update_projects():
+    """
+    Records the project of index entries which were registered without one; this is done once per session
+    """
+    global projects_updated
+    if not projects_updated:
+        projects = [(e["crs"], project_of(e["crs"])) for e in crs2filename.usage() if e.get("project") is None]
+        projects = [(crs, project) for crs, project in projects if project is not None]
+        if projects:
+            crs2filename.set_projects(projects)
+        projects_updated = True
+
+
+def cevict(size=None, quotas=None, keep=()):
+    """
+    Evicts cached objects in order that the cache size does not exceed SIZE (in bytes),
+    and that the size of the cached objects of each project does not exceed its quota
+    in dict QUOTAS. Defaults are the limits set by :py:func:`set_size_limits`, which are
+    enforced each time an object is cached
+
+    When a limit is exceeded, objects are evicted until the size goes under a fraction
+    'eviction_target' of the limit, by increasing order of their retention value (see
+    :py:func:`retention_value`) : large objects which are cheap to recompute (such as
+    data extractions) are evicted first, while costly diagnostics are kept. Objects which
+    were not accessed for long are evicted earlier. Protected objects (see
+    :py:func:`cprotect`) and objects which CRS are in list KEEP are never evicted
+
+    Returns the number of bytes freed
+    """
+    if size is None:
+        size = max_size
+    if quotas is None:
+        quotas = project_quotas
+    limits = []
+    if size:
+        limits.append((None, size))
+    if quotas:
+        update_projects()
+        limits.extend(quotas.items())
+    freed = 0
+    for project, limit in limits:
+        used = crs2filename.total_size(project)
+        if used <= limit:
+            continue
+        target = eviction_target * limit
+        now = time.time()
+        entries = [e for e in crs2filename.usage(project) if e["crs"] not in keep]
+        entries.sort(key=lambda e: retention_value(e, now))
+        for entry in entries:
+            if used <= target:
+                break
+            filename = entry["filename"]
+            if os.path.exists(filename):
+                if is_protected(filename):
+                    continue
+                clogger.info("Evicting %s from cache (%s)" % (entry["crs"], filename))
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+                try:
+                    os.rmdir(os.path.dirname(filename))
+                except OSError:
+                    pass
+                freed += entry["size"] or 0
+            crs2filename.pop(entry["crs"], None)
+            used -= entry["size"] or 0
+        if used > limit:
+            if project is None:
+                clogger.warning("Cache size (%d bytes) remains above its limit (%d) after eviction" % (used, limit))
+            else:
+                clogger.warning("Cache size for project %s (%d bytes) remains above its quota (%d) after eviction" %
+                                (project, used, limit))
+    return freed
+
+
+def enforce_limits(crs):
+    """
+    Evicts cached objects if the cache exceeds its size limits, except object CRS
+    """
+    if max_size or project_quotas:
+        cevict(keep=[crs])
+
+
+def record_provenance(crs, input_files=(), parents=()):
+    """
+    Records in the cache index the inputs which the object for CRS was computed from :
+    the list of files INPUT_FILES, and the list of CRS PARENTS
+
+    Input files which are cache files are recorded as the CRS of the cached object; for
+    other files, their size and modification time are recorded too (see :py:func:`cinvalidate`)
+    """
+    dependencies = [("crs", parent, None, None) for parent in parents]
+    for filename in input_files:
+        if not filename:
+            continue
+        cached = []
+        for index in [crs2filename] + shared_indexes:
+            cached = index.crs_of(filename)
+            if cached:
+                break
+        if cached:
+            dependencies.extend([("crs", parent, None, None) for parent in cached])
+        else:
+            if os.path.exists(filename):
+                filename = os.path.abspath(filename)
+            size, mtime = file_stats(filename)
+            dependencies.append(("file", filename, size, mtime))
+    unique = []
+    for dep in dependencies:
+        if dep not in unique:
+            unique.append(dep)
+    crs2filename.set_dependencies(crs, unique)
+
+
+def cinvalidate(obj=None, drop=True):
+    """
+    Drops the cached objects which depend on OBJ, i.e. which were computed from it,
+    directly or through other cached objects, and OBJ itself if it is a cached object;
+    objects which do not depend on OBJ are kept, so that only the stale parts of a
+    diagnostic are re-computed
+
+    This relies on the inputs recorded for each cached object (see :py:func:`record_provenance`)
+
+    Args:
+     obj : either a CliMAF object (for a dataset, its data files are considered), a CRS, or
+      the path of a data file or of a directory (for all the data files it contains); if None,
+      the data files which size or modification time changed since they were used are considered
+
+     drop (bool) : if False, just returns the list of affected CRS, without dropping anything
+
+    Returns:
+     the list of CRS of affected objects
+
+    Example ::
+
+    >>> # Some files of a dataset were re-published
+    >>> cinvalidate('/data/CMIP6/CMIP/CNRM-CERFACS/CNRM-CM6-1/historical')
+    >>> # Or, without knowing which ones
+    >>> cinvalidate()
+
+    """
+    affected = set()
+    if obj is None:
+        for crs, path, size, mtime in crs2filename.file_dependencies():
+            if file_stats(path) != (size, mtime):
+                clogger.info("Data file %s changed since %s was computed" % (path, crs))
+                affected.add(crs)
+    elif isinstance(obj, cdataset):
+        for path in (obj.baseFiles() or "").split():
+            affected.update(crs2filename.dependents(os.path.abspath(path)))
+    elif isinstance(obj, str) and obj not in crs2filename and \
+            (obj.startswith("/") or obj.startswith("~") or os.path.exists(obj)):
+        path = os.path.abspath(os.path.expanduser(obj))
+        affected.update(crs2filename.dependents(path))
+        affected.update(crs2filename.dependents(path.rstrip("/") + "/", prefix=True))
+    elif isinstance(obj, cobject) or isinstance(obj, str):
+        affected.add(obj if isinstance(obj, str) else obj.crs)
+    else:
+        clogger.error("%s is not a CliMAF object, a CRS nor a path" % repr(obj))
+        return []
+    # Add all descendants
+    todo = list(affected)
+    while todo:
+        for child in crs2filename.dependents(todo.pop()):
+            if child not in affected:
+                affected.add(child)
+                todo.append(child)
+    affected = sorted(affected)
+    if drop:
+        for crs in affected:
+            if crs in crs2filename and cdrop(crs) is False:
+                # The file was already missing
+                crs2filename.pop(crs, None)
+    return affected
+
+
 def cprotect(obj, stop=False):
     """
     Protects the cache file for a given object (or stops protection with arg 'stop=True').
@@ -470,10 +1500,341 @@ def cprotect(obj, stop=False):
         clogger.info("%s is not (yet) cached; use cfile() to cache it" % crs)
 
 
+def failures_file():
+    return os.path.join(os.path.expanduser(currentCache), "failures.json")
+
+
+def read_failures():
+    """
+    Returns the dict of failures stored in current cache (an empty dict if there is none)
+    """
+    try:
+        with open(failures_file(), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return dict()
+
+
+def update_failures(update):
+    """
+    Applies function UPDATE to the dict of failures stored in current cache (as updated by
+    concurrent sessions), and stores the result
+    """
+    global failures
+    with failures_lock:
+        failures = read_failures()
+        now = time.time()
+        for key in [key for key in failures if failures[key]["time"] + failure_ttl < now]:
+            del failures[key]
+        update(failures)
+        filename = failures_file()
+        try:
+            with open(filename + "_%d" % os.getpid(), "w") as f:
+                json.dump(failures, f, indent=1)
+            os.rename(filename + "_%d" % os.getpid(), filename)
+        except (IOError, OSError), e:
+            clogger.warning("Cannot store failures in %s : %s" % (filename, e))
+
+
+def record_failure(key, error, fingerprint=None):
+    """
+    Records that the evaluation of KEY (the CRS of a script call or a dataset) failed with message
+    ERROR; FINGERPRINT summarizes the context which the failure depends on, if any
+    """
+    if failure_ttl <= 0:
+        return
+    clogger.debug("Recording failure for %s : %s" % (key, error))
+
+    def add(failures):
+        failures[key] = dict(time=time.time(), error=error, fingerprint=fingerprint)
+
+    update_failures(add)
+
+
+def known_failure(key, fingerprint=None):
+    """
+    Returns the error message of a failure recorded for KEY (with the same FINGERPRINT) less
+    than 'failure_ttl' seconds ago, or None
+    """
+    global failures
+    if failure_ttl <= 0:
+        return None
+    with failures_lock:
+        if failures is None:
+            failures = read_failures()
+        failure = failures.get(key)
+    if failure is None or failure["fingerprint"] != fingerprint or failure["time"] + failure_ttl < time.time():
+        return None
+    return "%s (%d s ago)" % (failure["error"], time.time() - failure["time"])
+
+
+def cforget_failures(obj=None):
+    """
+    Forgets the failures recorded for an object (a CliMAF object or a CRS), and for its
+    named outputs, or all failures if OBJ is None; returns the number of failures forgotten
+
+    The evaluation of a script which failed, or the search for the files of a dataset for
+    which none was found, is not attempted again during 'cache.failure_ttl' seconds
+    (default : one hour), in any session using the same cache; the recorded error is
+    raised instead. Use this function once the problem is fixed, or evaluate the object
+    with argument ``deep=True`` (or the dataset files with ``baseFiles(force=True)``).
+
+    Example ::
+
+    >>> cforget_failures(ds(project='CMIP6', model='CNRM-CM6-1', variable='tas', period='1850'))
+    """
+    if obj is None:
+        keys = None
+    else:
+        if isinstance(obj, cobject):
+            obj = obj.crs
+        keys = [obj, "select(" + obj + ")"]
+    forgotten = []
+
+    def forget(failures):
+        for key in list(failures):
+            if keys is None or key in keys or any([key.startswith(k + ".") for k in keys]):
+                forgotten.append(key)
+                del failures[key]
+
+    if keys is not None:
+        # Avoid rewriting the file in the frequent case where there is nothing to forget
+        with failures_lock:
+            candidates = failures if failures is not None else read_failures()
+            if not any([key in keys or any([key.startswith(k + ".") for k in keys]) for key in candidates]):
+                return 0
+    update_failures(forget)
+    for key in forgotten:
+        clogger.info("Forgetting failure of %s" % key)
+    return len(forgotten)
+
+
+#: The name of the archive member which holds the index entries of packed cache files
+pack_index_name = "climaf_index.json"
+
+
+def cpack(archive, pattern="", since=None, compress="gz"):
+    """
+    Packs cached objects of the current cache in a single (tar) archive, together with their
+    index entries and provenance, for transferring them to another cache, where
+    :py:func:`cunpack` makes them available at once
+
+    Args:
+     archive (string) : the archive filename, or '-' for standard output
+
+     pattern (string, optional) : a regular expression which selects objects by CRS or filename,
+      as for :py:func:`clist`
+
+     since (optional) : selects objects cached since that date, either a datetime, or a string
+      'YYYYMMDD' (or 'YYYY-MM-DD'), or a number of days before now
+
+     compress (string, optional) : the compression of the archive, either 'gz', 'bz2' or None
+
+    Returns:
+     the number of objects packed
+
+    Example ::
+
+    >>> cpack('~/results_2020.tar.gz', pattern='CNRM-CM6-1', since='2020-01-01')
+
+    """
+    if since is None:
+        since = 0.
+    elif isinstance(since, (int, float)):
+        since = time.time() - since * 86400.
+    else:
+        if isinstance(since, str):
+            since = datetime.datetime.strptime(since.replace("-", ""), "%Y%m%d")
+        since = time.mktime(since.timetuple())
+    cachedir = os.path.expanduser(currentCache)
+    selected = crs2filename.copy()
+    if pattern:
+        match = crs_matcher(pattern)
+        selected = dict([(crs, filename) for crs, filename in selected.items() if match(crs, filename)])
+    entries = []
+    for crs in sorted(selected):
+        entry = crs2filename.entry(crs)
+        if entry is None or not os.path.exists(entry["filename"]) or (entry["created"] or 0.) < since:
+            continue
+        entries.append(dict(crs=crs, path=os.path.relpath(entry["filename"], cachedir),
+                            cost=entry.get("cost"), dependencies=crs2filename.dependencies(crs)))
+    mode = "w|" + (compress or "")
+    if archive == "-":
+        tar = tarfile.open(fileobj=sys.stdout, mode=mode)
+    else:
+        # The archive is written under a temporary name, so that a failure does not leave a truncated one
+        archive = os.path.expanduser(archive)
+        tmpfile = "%s_%i.tmp" % (archive, os.getpid())
+        tar = tarfile.open(tmpfile, mode=mode)
+    try:
+        # The index comes first, so that the archive is unpacked in one pass
+        index = json.dumps(dict(entries=entries))
+        info = tarfile.TarInfo(pack_index_name)
+        info.size, info.mtime = len(index), time.time()
+        tar.addfile(info, StringIO.StringIO(index))
+        for entry in entries:
+            tar.add(os.path.join(cachedir, entry["path"]), arcname=entry["path"])
+        tar.close()
+    except:
+        tar.close()
+        if archive != "-":
+            os.remove(tmpfile)
+        raise
+    if archive != "-":
+        os.rename(tmpfile, archive)
+    clogger.info("Packed %d cached objects in %s" % (len(entries), archive))
+    return len(entries)
+
+
+def cunpack(archive, overwrite=False):
+    """
+    Merges in the current cache the cached objects packed in ARCHIVE by :py:func:`cpack` (or
+    read from standard input if ARCHIVE is '-'), in one pass, and records them in the cache
+    index using the packed index entries and provenance; objects already cached are kept,
+    unless OVERWRITE is True
+
+    Provenance on data files is kept only for those files which are present, unchanged,
+    at the same location (see :py:func:`cinvalidate`)
+
+    Returns:
+     the list of CRS of the objects unpacked
+
+    Example ::
+
+    >>> cunpack('~/results_2020.tar.gz')
+
+    """
+    if archive == "-":
+        tar = tarfile.open(fileobj=sys.stdin, mode="r|*")
+    else:
+        tar = tarfile.open(os.path.expanduser(archive), mode="r|*")
+    unpacked = []
+    try:
+        entries = None
+        for member in tar:
+            if entries is None:
+                if member.name != pack_index_name:
+                    raise Climaf_Cache_Error("%s is not a CliMAF cache archive" % archive)
+                entries = dict([(entry["path"], entry) for entry in json.load(tar.extractfile(member))["entries"]])
+                continue
+            entry = entries.get(member.name)
+            if entry is None or not member.isfile():
+                continue
+            crs = str(entry["crs"])
+            if crs in crs2filename and not overwrite:
+                clogger.debug("Keeping cached object %s" % crs)
+                continue
+            filename = generateUniqueFileName(crs, format=os.path.splitext(member.name)[1][1:])
+            tmpfile, tmpfile_fmt = os.path.splitext(filename)
+            tmpfile = "%s_%i%s" % (tmpfile, os.getpid(), tmpfile_fmt)
+            with open(tmpfile, "wb") as f:
+                shutil.copyfileobj(tar.extractfile(member), f)
+            os.utime(tmpfile, (member.mtime, member.mtime))
+            os.rename(tmpfile, filename)
+            index_file(crs, filename, entry.get("cost"))
+            dependencies = []
+            for kind, parent, size, mtime in entry.get("dependencies", []):
+                if kind == "crs" or (os.path.exists(parent) and file_stats(parent) == (size, mtime)):
+                    dependencies.append((str(kind), str(parent), size, mtime))
+            crs2filename.set_dependencies(crs, dependencies)
+            unpacked.append(crs)
+    finally:
+        tar.close()
+    if entries is None:
+        raise Climaf_Cache_Error("%s is not a CliMAF cache archive" % archive)
+    clogger.info("Unpacked %d cached objects from %s" % (len(unpacked), archive))
+    return unpacked
+
+
+def reset_stats():
+    """
+    Resets the statistics on cache usage (see :py:func:`cstats`)
+    """
+    with stats_lock:
+        stats.clear()
+        stats.update(exact_hits=0, including_hits=0, begin_hits=0, misses=0, lookup_time=0., compute_time=0.,
+                     bytes_read=0, bytes_written=0, memory_hits=0)
+        computations.clear()
+
+
+def count(name, value=1):
+    """
+    Increments by VALUE the counter or timer NAME of cache usage statistics
+    """
+    with stats_lock:
+        stats[name] = stats.get(name, 0) + value
+
+
+def count_hit(kind, *filenames):
+    """
+    Records a cache hit of KIND ('exact', 'including' or 'begin', for chunks) which delivers cache files FILENAMES
+    """
+    count(kind + "_hits")
+    for filename in filenames:
+        if filename and os.path.exists(filename):
+            count("bytes_read", os.path.getsize(filename))
+
+
+def count_computation(crs, duration):
+    """
+    Records that the object for CRS was computed in DURATION seconds
+    """
+    count("compute_time", duration)
+    with stats_lock:
+        computations[crs] = computations.get(crs, 0.) + duration
+
+
+def cstats(top=10, dump=None, reset=False):
+    """
+    Returns statistics on the cache usage by CliMAF evaluations during the session, as a dict :
+
+     - 'exact_hits', 'including_hits', 'begin_hits' : numbers of evaluations served by
+       the cache, using a cached object either identical to the requested one, or for
+       a period which includes the requested one, or which covers part of it (in which case
+       the rest is computed)
+     - 'misses' : number of evaluations which found nothing relevant in cache
+     - 'hit_ratio' : ratio of evaluations served (even partially) by the cache
+     - 'lookup_time', 'compute_time' : time (in s) spent searching the cache and
+       computing objects (by scripts)
+     - 'bytes_read', 'bytes_written' : size of cache files delivered by cache hits,
+       and of cache files created
+     - 'memory_hits' : number of data arrays served from memory rather than read from a file
+     - 'most_expensive' : the list of the TOP most expensive CRS computed during the session,
+       as (crs, seconds) pairs, by decreasing computation time
+
+    Args:
+     top (int) : number of CRS listed in 'most_expensive'
+     dump (str) : if not None, the statistics are also written in JSON format in this
+      file, or on standard output if dump is '-'
+     reset (bool) : if True, statistics are reset after being returned
+
+    Example ::
+
+    >>> cstats(dump='cache_stats.json')
+    """
+    with stats_lock:
+        rep = dict(stats)
+        rep["most_expensive"] = heapq.nlargest(top, computations.items(), key=itemgetter(1))
+    hits = rep["exact_hits"] + rep["including_hits"] + rep["begin_hits"]
+    if hits + rep["misses"] > 0:
+        rep["hit_ratio"] = float(hits) / (hits + rep["misses"])
+    else:
+        rep["hit_ratio"] = None
+    if dump == "-":
+        print json.dumps(rep, indent=2, sort_keys=True)
+    elif dump is not None:
+        with open(os.path.expanduser(dump), "w") as f:
+            json.dump(rep, f, indent=2, sort_keys=True)
+    if reset:
+        reset_stats()
+    return rep
+
+
 def csync(update=False):
     """
     Merges current in-memory cache index and current on-file cache index
-    for updating both
+    for updating both. With the 'sqlite' and 'journal' index backends, entries are written
+    as soon as they are created or dropped, and there is nothing to merge
 
     If arg `update` is True, additionally ensures consistency between files
     set and index content, either :
@@ -484,20 +1845,10 @@ def csync(update=False):
       instance of CliMAF
     """
     #
-    import pickle
-    global cacheIndexFileName
-    global dropped_crs
-
-    # Merge index on file and index in memory
-    file_index = cload(True)
-    for crs in dropped_crs:
-        file_index.pop(crs, None)
-    crs2filename.update(file_index)
-
     # check if cache index is up to date; if not enforce consistency
     if update:
         clogger.info("Listing crs from files present in cache")
-        files_in_cache = list_cache()
+        files_in_cache = list_cache([currentCache])
         files_in_cache.sort()
         files_in_index = crs2filename.values()
         files_in_index.sort()
@@ -515,36 +1866,29 @@ def csync(update=False):
                 # else :
                 # Should also remove empty files, as soon as
                 # file creation will be atomic enough
-    # Save index to disk
-    fn = os.path.expanduser(cacheIndexFileName)
+    # Merge index on file and index in memory, and save index to disk
     try:
-        with open(fn, "w") as cacheIndexFile:
-            pickle.dump(crs2filename, cacheIndexFile)
-        dropped_crs = []
+        crs2filename.sync()
     except:
         if update:
-            if os.path.isfile(fn) and len(files_in_cache>0):
-                clogger.error("Issue when writing cache index %s" % fn)
+            clogger.error("Issue when writing cache index %s" % crs2filename)
 
 
 def cload(alt=None):
-    global crs2filename
+    """
+    Load the cache index from disk. If arg alt is True, rather return the index
+    as found on disk, as a dict
+    """
     global crs_not_yet_evaluable
-    rep = dict()
 
-    if len(crs2filename) != 0 and not alt:
+    if alt:
+        if hasattr(crs2filename, "read"):
+            return crs2filename.read()
+        return crs2filename.copy()
+    if len(crs2filename) != 0 and not crs2filename.persistent:
         Climaf_Cache_Error(
             "attempt to reset file index - would lead to inconsistency !")
-    try:
-        cacheIndexFile = file(os.path.expanduser(cacheIndexFileName), "r")
-        if alt:
-            rep = pickle.load(cacheIndexFile)
-        else:
-            crs2filename = pickle.load(cacheIndexFile)
-        cacheIndexFile.close()
-    except:
-        pass
-        # clogger.debug("no index file yet")
+    crs2filename.load()
     #
     must_check_index_entries = False
     if must_check_index_entries:
@@ -576,8 +1920,6 @@ def cload(alt=None):
                         "Or you can erase corresponding data by 'crm(pattern=...project name...)'" %
                         (len(crs_not_yet_evaluable), repr(list(projects))))
         allow_error_on_ds(False)
-    if alt:
-        return rep
 
 
 def cload_for_project(project):
@@ -605,16 +1947,17 @@ def craz(force=False, hideError=False):
       hideError (bool): if True, will not warn for non existing cache
 
     """
-    global crs2filename
     cc = os.path.expanduser(currentCache)
+    if hasattr(crs2filename, "close"):
+        # The index files are erased too
+        crs2filename.close()
     if os.path.exists(currentCache) or hideError is False:
         if force:
             os.system("chmod -R +w  " + cc)
         os.system("rm -fR " + cc + "/*")
         os.system("ls  " + cc)
     # for f in crs2filename : os.remove(crs2filename[f])
-    # if os.path.exists(cacheIndexFileName) : os.remove(cacheIndexFileName)
-    crs2filename = dict()
+    open_cache_index()
 
 
 def cdump(use_macro=True):
@@ -633,20 +1976,94 @@ def cdump(use_macro=True):
             print "%s : %s" % (crs2filename[crs], crewrite(crs))
 
 
-def list_cache():
+#: The extensions of cache files
+cache_file_extensions = (".png", ".nc", ".pdf", ".eps")
+
+
+#: The name of temporary outputs, which are renamed as cache files once complete : <cache file>_<pid>.<ext>
+temporary_file = re.compile(r"^[0-9a-f]+_(\d+)\.\w+$")
+
+
+def scan_cache(dirs=None):
+    """
+    Yields the files of directories DIRS (default : all cache directories) which have a cache file extension
+    """
+    for dir_cache in dirs or cachedirs:
+        for dirpath, dirnames, filenames in os.walk(os.path.expanduser(dir_cache)):
+            for f in filenames:
+                if f.endswith(cache_file_extensions):
+                    yield os.path.join(dirpath, f)
+
+
+def list_cache(dirs=None):
+    """
+    Return the list of files in cache directories (or in directories DIRS)
+
+    """
+    return list(scan_cache(dirs))
+
+
+def is_orphan(filename, st, now):
+    """
+    Tells if FILENAME, which os.stat() result is ST, is a temporary output older than
+    'orphan_age' and which process is not running anymore
+    """
+    match = temporary_file.match(os.path.basename(filename))
+    if match is None or now - st.st_mtime < orphan_age:
+        return False
+    try:
+        os.kill(int(match.group(1)), 0)
+    except OSError, e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+def find_criteria(size="", age="", access=0):
+    """
+    Returns a function which tells if the os.stat() result of a file meets criteria
+    SIZE, AGE and ACCESS, with the same meaning as for the 'find' command (see :py:func:`clist`)
+    """
+    now = time.time()
+    tests = []
+    if size:
+        units = dict(c=1, k=2 ** 10, M=2 ** 20, G=2 ** 30)
+        if size[-1] in units:
+            unit, limit = units[size[-1]], int(size[:-1])
+        else:
+            unit, limit = 1, int(size)
+        # Sizes are rounded up to units
+        tests.append(lambda st: (st.st_size + unit - 1) // unit > limit)
+    if age:
+        days = int(age.lstrip("+-"))
+        compare = {"+": gt, "-": lt}.get(age[0], eq)
+        tests.append(lambda st: compare(int((now - st.st_ctime) // 86400), days))
+    if access != 0:
+        tests.append(lambda st: int((now - st.st_atime) // 86400) > int(access))
+    return lambda st: all([test(st) for test in tests])
+
+
+def crs_matcher(pattern):
+    """
+    Returns a function of (crs, filename) which tells if regular expression PATTERN matches
+    the filename or the crs as rewritten with macros (which is computed only if needed)
     """
-    Return the list of files in cache directories, using `find`
+    regexp = re.compile(pattern)
 
+    def match(crs, filename):
+        if regexp.search(filename):
+            return True
+        return regexp.search(rewritten([crs])[0]) is not None
+
+    return match
+
+
+def rewritten(crs_list):
+    """
+    Returns the list of CRS in CRS_LIST, rewritten with macros if any is defined
     """
-    files_in_cache = []
-    find_return = ""
-    for dir_cache in cachedirs:
-        rep = os.path.expanduser(dir_cache)
-        find_return += os.popen(
-            "find %s -type f \( -name '*.png' -o -name '*.nc' -o -name '*.pdf' -o -name '*.eps' \) -print" % rep).read()
-    files_in_cache = find_return.split('\n')
-    files_in_cache.pop(-1)
-    return files_in_cache
+    if not cmacros:
+        return list(crs_list)
+    return map(crewrite, crs_list)
 
 
 def clist(size="", age="", access=0, pattern="", not_pattern="", usage=False, count=False,
@@ -658,8 +2075,10 @@ def clist(size="", age="", access=0, pattern="", not_pattern="", usage=False, co
     List the content of CliMAF cache according to some search criteria
     and operate possibly an action (usage, count or remove) on this list.
 
-    Please consider the cost and benefit of first updating CliMAF cache index (by scanning
-    files on disk) using :py:func:`csync()`
+    Objects are selected from the cache index : please consider the cost and benefit of first
+    updating CliMAF cache index (by scanning files on disk) using :py:func:`csync()`. Criteria
+    on size, age and access are checked on the status of indexed files only, and CRS are
+    rewritten with macros only when no match is found otherwise, or for displaying them
 
     Args:
      size (string, optional): n[ckMG]
@@ -719,128 +2138,48 @@ def clist(size="", age="", access=0, pattern="", not_pattern="", usage=False, co
 
     """
 
-    # cache directories
-    rep = os.path.expanduser(
-        cachedirs[0])  # TBD: le cache ne contient qu un rep pr le moment => voir pour boucler sur tous les caches
-
-    # command for research on size/age/access
-    command = ""
-    opt_find = ""
-    if size:
-        if re.search('[kMG]', size) is None:
-            opt_find += "-size +%sc " % size
-        else:
-            opt_find += "-size +%s " % size
-    if age:
-        opt_find += "-ctime %s " % age
-    if access != 0:
-        opt_find += "-atime +%s" % str(int(access))
-
-    var_find = False
-    if size or age or access != 0:
-        var_find = True
-        command = "find %s -type f \( -name '*.png' -o -name '*.nc' -o -name '*.pdf' -o -name '*.eps' \) %s -print" % \
-                  (rep, opt_find)
-        clogger.debug("Find command is :" + command)
-
-        # construction of the new dictionary after research on size/age/access
-        new_dict = dict()
-        find_return = ""
-        list_search_files_after_find = []
-
-        find_return = os.popen(command).read()
-        list_search_files_after_find = find_return.split('\n')
-        list_search_files_after_find.pop(-1)
-        clogger.debug("List of search files: " + repr(list_search_files_after_find))
-
-        # Search CRS for each found file
-        for filen in list_search_files_after_find:
-            for crs in crs2filename:
-                if crs2filename[crs] == filen:
-                    new_dict[crs] = filen
-
-        if len(new_dict) != 0:
-            if new_dict != crs2filename:
-                clogger.debug("Dictionary after find for size/age/access: " + repr(new_dict))
-            else:
-                clogger.debug("Size/age/access criteria do not lead to any filtering")
-        else:
-            clogger.debug("No file meet the size/age/access criteria")
-    else:
-        new_dict = crs2filename.copy()
-
-    # size of new dictionary
-    len_new_dict = len(new_dict)
-
-    # filter on pattern
-    find_pattern = False
-    if pattern:
-        list_crs_to_rm = []
-        for crs in new_dict:
-            if re.search(pattern, crewrite(crs)) or re.search(pattern, new_dict[crs]):
-                clogger.debug("Pattern found in %s: %s" % (crs, new_dict[crs]))
-                find_pattern = True
-            else:
-                # Do not remove now from new_dict, because we loop on it
-                list_crs_to_rm.append(crs)
-        for crs in list_crs_to_rm:
+    # Files are selected from the index of current cache
+    var_find = size or age or access != 0
+    filtering = var_find or pattern != "" or not_pattern != ""
+    new_dict = crs2filename.copy()
+    if var_find:
+        meets = find_criteria(size, age, access)
+        for crs, filename in new_dict.items():
+            try:
+                if filename.endswith(cache_file_extensions) and meets(os.stat(filename)):
+                    continue
+            except OSError:
+                pass
             del new_dict[crs]
+        clogger.debug("%d files meet the size/age/access criteria" % len(new_dict))
 
-        if find_pattern:
-            clogger.debug("Dictionary after search for pattern: " + repr(new_dict))
-        elif len_new_dict != 0:
-            clogger.debug("No string found for pattern => no result")
-
-    # update size new dictionary
-    len_new_dict = len(new_dict)
-
-    # research on not_pattern
-    find_not_pattern = False
+    # filter on pattern, then on not_pattern
+    if pattern:
+        match = crs_matcher(pattern)
+        for crs, filename in new_dict.items():
+            if not match(crs, filename):
+                del new_dict[crs]
+        clogger.debug("%d files after search for pattern" % len(new_dict))
     if not_pattern:
-        list_crs_to_rm = []
-        for crs in new_dict:
-            if re.search(not_pattern, crewrite(crs)) is None and \
-                    re.search(not_pattern, new_dict[crs]) is None:
-                clogger.debug("Pattern not found in %s: %s" % (crs, new_dict[crs]))
-                find_not_pattern = True
-            else:
-                list_crs_to_rm.append(crs)
-        for crs in list_crs_to_rm:
-            del new_dict[crs]
-
-        if find_not_pattern:
-            clogger.debug("Dictionary after search for not_pattern: " + repr(new_dict))
-        elif len_new_dict != 0:
-            clogger.debug("All strings contain not_pattern => no result")
-
-    # update size new dictionary
-    len_new_dict = len(new_dict)
+        match = crs_matcher(not_pattern)
+        for crs, filename in new_dict.items():
+            if match(crs, filename):
+                del new_dict[crs]
+        clogger.debug("%d files after search for not_pattern" % len(new_dict))
 
     # request on new dictionary through usage, count and remove
-    work_dic = new_dict if (var_find or pattern is not "" or not_pattern is not "") else crs2filename
+    len_new_dict = len(new_dict)
+    work_dic = new_dict
 
     if usage is True and len_new_dict != 0:
-        # construction of a dictionary containing crs and disk-usage associated
+        # disk usage of each file, in kilobytes, as reported by du
         dic_usage = dict()
-        tmp = ""
         for crs in work_dic:
-            tmp += work_dic[crs] + " "
-        res = os.popen("du -sc %s" % tmp).read()
-
-        regex = re.compile('([0-9]+)\t')
-        list_size = re.findall(regex, res)
-        regex2 = re.compile('([0-9]+\t)')
-        str_path = regex2.sub('', res)
-        list_fig = str_path.split('\n')
-        list_fig.pop(-1)
-
-        for fig, size in zip(list_fig, list_size):
-            if fig != "total":
-                for crs in work_dic:
-                    if fig == work_dic[crs]:
-                        dic_usage[crs] = size
-            else:
-                dic_usage[fig] = size
+            try:
+                dic_usage[crs] = os.stat(work_dic[crs]).st_blocks // 2
+            except OSError:
+                pass
+        dic_usage["total"] = sum(dic_usage.values())
 
         # sort of usage dictionary and units conversion
         du_list_sort = dic_usage.items()
@@ -872,34 +2211,29 @@ def clist(size="", age="", access=0, pattern="", not_pattern="", usage=False, co
 
     elif remove is True and len_new_dict != 0:
         print "Removed files:"
-        list_tmp_crs = []
-        list_tmp_crs = new_dict.keys() if (
-                    var_find or pattern is not "" or not_pattern is not "") else crs2filename.keys()
+        list_tmp_crs = new_dict.keys()
         for crs in list_tmp_crs:
             cdrop(crs, rm=True)
-        return map(crewrite, list_tmp_crs)
+        return rewritten(list_tmp_crs)
 
     else:  # usage, count and remove are False
-        if var_find or pattern is not "" or not_pattern is not "":
+        if filtering:
             if len(new_dict) != 0:
-                if new_dict != crs2filename:
+                if len(new_dict) != len(crs2filename):
                     print "Filtered objects :"
                 else:
                     print "Filtered objects = cache content"
-                return map(crewrite, new_dict.keys())
+                return rewritten(new_dict.keys())
             # else : print "No matching file "
         else:
             print "Content of CliMAF cache"
-            return map(crewrite, crs2filename.keys())
+            return rewritten(new_dict.keys())
 
     # TBD
     if special is True:
         global dic_special
         dic_special = dict()
-        if var_find is True or pattern is not "" or not_pattern is not "":
-            dic_special = new_dict.copy()
-        else:
-            dic_special = crs2filename.copy()
+        dic_special = new_dict.copy()
         print "List of marked figures as 'special'", dic_special.values()
         return dic_special  # TBD: declarer comme var globale et enlever son effacement dans creset
 
@@ -970,25 +2304,83 @@ def cwc(**kwargs):
     return clist(**kwargs)
 
 
-def rebuild():
+def rebuild(workers=None):
     """
-    Rebuild the in-memory content of CliMAF cache index
+    Rebuild the content of CliMAF cache index, from the CRS stamped in the files of current cache
 
-    """
-    global crs2filename
+    Files which are already indexed, and were not changed since, are not read again; the
+    other ones are read by WORKERS threads (default : cache.rebuild_workers), and those
+    which have no CRS are removed (only when the in-process and the external readers of
+    :py:func:`~climaf.filemeta.read_crs` both find none; files which CRS cannot be read are
+    kept, and not indexed). Index entries which file is missing are dropped, and
+    temporary outputs left by interrupted computations (see :py:data:`orphan_age`) are
+    removed. Progress is reported at log level 'info'
 
+    Returns the index
+    """
     if not stamping:
         clogger.warning("Cannot rebuild cache index, because we are not in 'stamping' mode")
         return None
-    files_in_cache = list_cache()
-    crs2filename.clear()
-    for files in files_in_cache:
-        filecrs = getCRS(files)
-        if filecrs:
-            crs2filename[filecrs] = files
-        else:
-            os.system('rm -f ' + files)
-            clogger.warning("File %s is removed" % files)
+    known = dict()
+    for crs in crs2filename.keys():
+        entry = crs2filename.entry(crs)
+        if entry is not None:
+            known[entry["filename"]] = (crs, entry["size"], entry["created"])
+    now = time.time()
+    found = set()
+    counts = dict(scanned=0, read=0, indexed=0, removed=0, orphans=0)
+
+    def to_read():
+        # Stream cache files, yielding only those which content must be read
+        for filename in scan_cache([currentCache]):
+            counts["scanned"] += 1
+            if counts["scanned"] % 1000 == 0:
+                clogger.info("Rebuilding cache index : %(scanned)d files scanned, %(read)d read" % counts)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            if is_orphan(filename, st, now):
+                clogger.warning("Removing %s, left by an interrupted computation" % filename)
+                os.remove(filename)
+                counts["orphans"] += 1
+                continue
+            found.add(filename)
+            if filename in known:
+                crs, size, indexed = known[filename]
+                if size == st.st_size and st.st_mtime <= indexed:
+                    # Not changed since it was indexed
+                    continue
+            if temporary_file.match(os.path.basename(filename)):
+                continue
+            yield filename
+
+    def read(filename):
+        return filename, getCRS(filename)
+
+    pool = ThreadPool(workers or rebuild_workers)
+    try:
+        for filename, filecrs in pool.imap_unordered(read, to_read()):
+            counts["read"] += 1
+            if filecrs:
+                index_file(filecrs, filename)
+                counts["indexed"] += 1
+            elif filecrs is None:
+                clogger.warning("Cannot read the CRS of %s, which is kept but not indexed" % filename)
+            else:
+                os.remove(filename)
+                found.discard(filename)
+                counts["removed"] += 1
+                clogger.warning("File %s is removed" % filename)
+    finally:
+        pool.close()
+        pool.join()
+    for filename in set(known) - found:
+        crs = known[filename][0]
+        if crs2filename.get(crs) == filename:
+            del crs2filename[crs]
+    clogger.info("Cache index rebuilt : %(scanned)d files scanned, %(read)d read, %(indexed)d indexed, %(removed)d "
+                 "files without CRS and %(orphans)d temporary files removed" % counts)
     return crs2filename
 
 
@@ -1000,3 +2392,6 @@ class Climaf_Cache_Error(Exception):
 
     def __str__(self):
         return repr(self.valeur)
+
+
+reset_stats()
@@ -0,0 +1,903 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+
+CliMAF cache index backends : the persistent association between CRS expressions
+and cache filenames.
+
+An index behaves as a dict which keys are CRS expressions and values are cache
+filenames; module :py:mod:`~climaf.cache` holds the current one in
+``cache.crs2filename``. Backends differ in how they persist entries :
+
+- ``pickle`` : the historical behaviour; the whole dict is kept in memory, loaded
+  from file ``<cache>/index`` at startup and written back at exit by ``csync()``
+
+- ``sqlite`` : one row per CRS in file ``<cache>/index.sqlite`` (SQLite in WAL mode),
+  with the filename, its size, and its creation and last access times; each
+  change is written when it happens, concurrent CliMAF sessions sharing the cache
+  see each other's entries, and there is nothing to write back at exit
+
+- ``journal`` : each change is appended as one line to file ``<cache>/index.journal``, which
+  is compacted from time to time in snapshot ``<cache>/index.snapshot``; the snapshot is
+  read only when the index is first used, and later loads only replay the journal tail;
+  this uses only file appends and ``flock``, which suits file systems where SQLite locking
+  is not reliable
+
+An index can be opened read-only, e.g. for a cache shared by a team, which CliMAF
+sessions only consult (see :py:func:`~climaf.cache.set_shared_caches`)
+
+Entries also record the computation time of the cached object ('cost') and the project
+it belongs to, which are used for bounding the cache size (see :py:func:`~climaf.cache.cevict`)
+
+Indexes also record the provenance of entries : the CRS of the cached objects and the
+data files (with their size and modification time) they were computed from, which
+allows to find the descendants of an object or a file (see :py:func:`~climaf.cache.cinvalidate`).
+The 'pickle' backend keeps provenance in memory only
+
+Each backend also maintains a structural index of entries : their 'shape', i.e. their
+CRS where all datasets periods are blanked (the 'signature'), together with the period
+shared by all their datasets. It allows to find cached objects which include or begin
+a requested one with a dictionary lookup and an interval search (see
+:py:func:`~climaf.cache.hasIncludingObject`)
+
+"""
+
+import os
+import os.path
+import time
+import pickle
+import bisect
+import threading
+import json
+import fcntl
+from collections import MutableMapping
+
+from clogging import clogger
+
+#: Seconds an sqlite index waits for a lock held by a concurrent session
+sqlite_timeout = 60.
+#: Size (in bytes) beyond which the journal of a 'journal' index is compacted in its snapshot
+journal_compaction_size = 4 * 2 ** 20
+#: Whether each record of a 'journal' index is flushed to disk (safer on power loss, but slower)
+journal_fsync = False
+
+
+def open_index(cachedir, backend="sqlite", readonly=False):
+    """
+    Returns the index of type BACKEND for cache directory CACHEDIR
+
+    With READONLY=True, BACKEND may be None : the backend is then the one
+    which index file exists in CACHEDIR (see :py:func:`index_backend_of`)
+    """
+    if backend is None:
+        backend = index_backend_of(cachedir)
+    if backend not in backends:
+        raise ValueError("Unknown cache index backend %s; choose among %s" % (backend, repr(backends.keys())))
+    return backends[backend](cachedir, readonly=readonly)
+
+
+def index_backend_of(cachedir):
+    """
+    Returns the name of the backend which index file exists in CACHEDIR
+    ('sqlite' if there are several, and if there is none)
+    """
+    for backend in ["sqlite", "journal", "pickle"]:
+        if os.path.exists(os.path.join(os.path.expanduser(cachedir), backends[backend].index_filename)):
+            return backend
+    return "sqlite"
+
+
+def file_stats(filename):
+    """
+    Returns the size and modification time of FILENAME, or (None, None) if it doesn't exist
+    """
+    try:
+        st = os.stat(filename)
+        return st.st_size, st.st_mtime
+    except OSError:
+        return None, None
+
+
+class cindex(MutableMapping):
+    """
+    Base class for cache index backends : a mutable mapping from CRS expressions
+    to cache filenames, plus some per-entry metadata
+    """
+    #: Backend name, as used by :py:func:`open_index`
+    name = None
+    #: True if changes are written on the fly, i.e. there is nothing to save at exit
+    persistent = False
+    #: Name of the index file in the cache directory
+    index_filename = None
+
+    def __init__(self, cachedir, readonly=False):
+        self.cachedir = os.path.expanduser(cachedir)
+        #: A read-only index is never written to disk
+        self.readonly = readonly
+
+    def __repr__(self):
+        return "%s index for %s (%d entries)" % (self.name, self.cachedir, len(self))
+
+    def copy(self):
+        return dict(self.items())
+
+    def record(self, crs, filename, **metadata):
+        """
+        Records FILENAME as the cache file for CRS
+        """
+        raise NotImplementedError()
+
+    def __setitem__(self, crs, filename):
+        self.record(crs, filename)
+
+    def entry(self, crs):
+        """
+        Returns a dict with the entry for CRS (keys : crs, filename, size, created,
+        accessed, cost, project), or None
+        """
+        filename = self.get(crs)
+        if filename is None:
+            return None
+        size, mtime = file_stats(filename)
+        return dict(crs=crs, filename=filename, size=size, created=mtime, accessed=None, cost=None, project=None)
+
+    def usage(self, project=None):
+        """
+        Returns the list of entries (see :py:meth:`entry`), restricted to those of PROJECT if not None
+        """
+        entries = [self.entry(crs) for crs in self.keys()]
+        return [e for e in entries if e is not None and (project is None or e["project"] == project)]
+
+    def total_size(self, project=None):
+        """
+        Returns the total size of files for entries (of PROJECT if not None)
+        """
+        return sum([e["size"] or 0 for e in self.usage(project)])
+
+    def set_projects(self, projects):
+        """
+        Records the project of some entries; PROJECTS is a list of tuples (crs, project)
+        """
+        raise NotImplementedError()
+
+    def crs_of(self, filename):
+        """
+        Returns the list of CRS which entry is FILENAME
+        """
+        return [crs for crs, fil in self.items() if fil == filename]
+
+    def touch(self, crs):
+        """
+        Records that the entry for CRS has just been used
+        """
+        pass
+
+    def set_shapes(self, shapes):
+        """
+        Records the shape of some entries; SHAPES is a list of tuples (crs, signature,
+        pstart, pend), where pstart and pend are the bounds of the period of the entry
+        as strings which sort as dates. Signature is '' for entries which have no shape
+        """
+        raise NotImplementedError()
+
+    def shapes(self, signature):
+        """
+        Returns the list of tuples (pstart, pend, crs) for entries with SIGNATURE, sorted
+        """
+        raise NotImplementedError()
+
+    def unshaped(self):
+        """
+        Returns the list of CRS for which no shape has yet been recorded
+        """
+        raise NotImplementedError()
+
+    def set_dependencies(self, crs, dependencies):
+        """
+        Records the inputs of the object for CRS; DEPENDENCIES is a list of tuples (kind, parent,
+        size, mtime) where kind is either 'crs' (parent is then the CRS of a cached object) or
+        'file' (parent is then a data file path, with its size and modification time)
+        """
+        raise NotImplementedError()
+
+    def dependencies(self, crs):
+        """
+        Returns the list of inputs of the object for CRS, as tuples (kind, parent, size, mtime)
+        """
+        raise NotImplementedError()
+
+    def dependents(self, parent, prefix=False):
+        """
+        Returns the list of CRS of the objects which were computed using PARENT (a CRS or
+        a file path), or, if PREFIX is True, using a file which path begins with PARENT
+        """
+        raise NotImplementedError()
+
+    def file_dependencies(self):
+        """
+        Returns the list of tuples (crs, path, size, mtime) for all data files used by indexed objects
+        """
+        raise NotImplementedError()
+
+    def load(self):
+        """
+        Reads the persistent state of the index, if applicable
+        """
+        pass
+
+    def sync(self):
+        """
+        Saves the in-memory state of the index, if applicable, merging it
+        with changes made meanwhile by concurrent sessions
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class pickleIndex(cindex):
+    """
+    The historical index : an in-memory dict, pickled in file <cachedir>/index
+    """
+    name = "pickle"
+    persistent = False
+    index_filename = "index"
+
+    def __init__(self, cachedir, readonly=False):
+        cindex.__init__(self, cachedir, readonly)
+        self.filename = os.path.join(self.cachedir, self.index_filename)
+        self.entries = dict()
+        #: The list of crs which file has been dropped since last synchronisation between in-memory
+        #  index and file index (or at least since the beginning of the session)
+        self.dropped = []
+        #: Shapes are not pickled : dict crs -> (signature, pstart, pend), and
+        # dict signature -> sorted list of (pstart, pend, crs)
+        self.shape_of = dict()
+        self.by_signature = dict()
+        #: Neither are other metadata : dict crs -> dict of metadata
+        self.metadata = dict()
+        #: Nor provenance : dict crs -> list of dependencies
+        self.deps = dict()
+
+    def __getitem__(self, crs):
+        return self.entries[crs]
+
+    def record(self, crs, filename, signature=None, pstart=None, pend=None, **metadata):
+        self.forget_shape(crs)
+        self.entries[crs] = filename
+        self.metadata[crs] = dict(metadata, accessed=time.time())
+        if signature is not None:
+            self.set_shapes([(crs, signature, pstart, pend)])
+        if crs in self.dropped:
+            self.dropped.remove(crs)
+
+    def __delitem__(self, crs):
+        del self.entries[crs]
+        self.forget_shape(crs)
+        self.metadata.pop(crs, None)
+        self.deps.pop(crs, None)
+        self.dropped.append(crs)
+
+    def entry(self, crs):
+        entry = cindex.entry(self, crs)
+        if entry is not None:
+            entry.update(self.metadata.get(crs, {}))
+        return entry
+
+    def touch(self, crs):
+        if crs in self.entries:
+            self.metadata.setdefault(crs, dict())["accessed"] = time.time()
+
+    def set_projects(self, projects):
+        for crs, project in projects:
+            if crs in self.entries:
+                self.metadata.setdefault(crs, dict())["project"] = project
+
+    def set_dependencies(self, crs, dependencies):
+        if crs in self.entries:
+            self.deps[crs] = list(dependencies)
+
+    def dependencies(self, crs):
+        return list(self.deps.get(crs, []))
+
+    def dependents(self, parent, prefix=False):
+        if prefix:
+            return [crs for crs, deps in self.deps.items()
+                    if any([kind == "file" and path.startswith(parent) for kind, path, size, mtime in deps])]
+        return [crs for crs, deps in self.deps.items() if any([p == parent for kind, p, size, mtime in deps])]
+
+    def file_dependencies(self):
+        return [(crs, path, size, mtime) for crs, deps in self.deps.items()
+                for kind, path, size, mtime in deps if kind == "file"]
+
+    def forget_shape(self, crs):
+        shape = self.shape_of.pop(crs, None)
+        if shape is not None:
+            signature, pstart, pend = shape
+            self.by_signature[signature].remove((pstart, pend, crs))
+
+    def set_shapes(self, shapes):
+        for crs, signature, pstart, pend in shapes:
+            if crs in self.entries:
+                self.forget_shape(crs)
+                self.shape_of[crs] = (signature, pstart, pend)
+                bisect.insort(self.by_signature.setdefault(signature, []), (pstart, pend, crs))
+
+    def shapes(self, signature):
+        return list(self.by_signature.get(signature, []))
+
+    def unshaped(self):
+        return [crs for crs in self.entries if crs not in self.shape_of]
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, crs):
+        return crs in self.entries
+
+    def clear(self):
+        self.dropped.extend(self.entries.keys())
+        self.entries.clear()
+        self.shape_of.clear()
+        self.by_signature.clear()
+        self.metadata.clear()
+        self.deps.clear()
+
+    def read(self):
+        """
+        Returns the dict stored in the index file (an empty dict if there is none)
+        """
+        try:
+            with open(self.filename, "r") as index_file:
+                return pickle.load(index_file)
+        except:
+            # clogger.debug("no index file yet")
+            return dict()
+
+    def load(self):
+        self.entries = self.read()
+        self.dropped = []
+        self.shape_of.clear()
+        self.by_signature.clear()
+
+    def sync(self):
+        if self.readonly:
+            return
+        # Merge index on file and index in memory
+        file_index = self.read()
+        for crs in self.dropped:
+            file_index.pop(crs, None)
+        file_index.update(self.entries)
+        self.entries = file_index
+        for crs in set(self.shape_of) - set(self.entries):
+            self.forget_shape(crs)
+        for crs in set(self.metadata) - set(self.entries):
+            del self.metadata[crs]
+        for crs in set(self.deps) - set(self.entries):
+            del self.deps[crs]
+        # Save index to disk
+        with open(self.filename, "w") as index_file:
+            pickle.dump(self.entries, index_file)
+        self.dropped = []
+
+
+class sqliteIndex(cindex):
+    """
+    An index stored in SQLite database <cachedir>/index.sqlite, with one row per CRS.
+
+    The database uses Write-Ahead Logging, which allows for concurrent readers and
+    one writer at a time; each change is committed on its own. WAL mode needs
+    a file system which supports shared memory mapping; on some network file systems,
+    SQLite falls back to its rollback journal (which is slower, but still safe).
+    """
+    name = "sqlite"
+    persistent = True
+    index_filename = "index.sqlite"
+    #: Columns of table 'entries', as (name, SQL type)
+    columns = [("crs", "TEXT PRIMARY KEY"),
+               ("filename", "TEXT NOT NULL"),
+               ("size", "INTEGER"),
+               ("created", "REAL"),
+               ("accessed", "REAL"),
+               ("signature", "TEXT"),
+               ("pstart", "TEXT"),
+               ("pend", "TEXT"),
+               ("cost", "REAL"),
+               ("project", "TEXT")]
+
+    def __init__(self, cachedir, readonly=False):
+        cindex.__init__(self, cachedir, readonly)
+        self.filename = os.path.join(self.cachedir, self.index_filename)
+        self.lock = threading.RLock()
+        self.db = None
+        self.connect()
+
+    def connect(self):
+        import sqlite3
+        if self.readonly:
+            if not os.path.exists(self.filename):
+                raise IOError("No cache index %s" % self.filename)
+            self.db = sqlite3.connect(self.filename, timeout=sqlite_timeout, isolation_level=None,
+                                      check_same_thread=False)
+            self.db.text_factory = str
+            self.db.execute("PRAGMA query_only=ON")
+            return
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        # isolation_level=None : each statement is committed by its own, except in explicit transactions
+        self.db = sqlite3.connect(self.filename, timeout=sqlite_timeout, isolation_level=None,
+                                  check_same_thread=False)
+        # CRS expressions are (byte) strings
+        self.db.text_factory = str
+        mode = self.db.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if mode.lower() != "wal":
+            clogger.warning("Cache index %s cannot use WAL mode (got %s); concurrent access will be slower" %
+                            (self.filename, mode))
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (%s)" %
+                        ", ".join(["%s %s" % col for col in self.columns]))
+        existing = [row[1] for row in self.db.execute("PRAGMA table_info(entries)")]
+        for col, sqltype in self.columns:
+            if col not in existing:
+                # Index created by a former CliMAF version
+                self.db.execute("ALTER TABLE entries ADD COLUMN %s %s" % (col, sqltype.replace("NOT NULL", "")))
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_filename ON entries (filename)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_signature ON entries (signature)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_project ON entries (project)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dependencies "
+                        "(crs TEXT NOT NULL, kind TEXT NOT NULL, parent TEXT NOT NULL, size INTEGER, mtime REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS dependencies_crs ON dependencies (crs)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS dependencies_parent ON dependencies (parent)")
+
+    def execute(self, statement, args=()):
+        with self.lock:
+            return self.db.execute(statement, args).fetchall()
+
+    def __getitem__(self, crs):
+        rows = self.execute("SELECT filename FROM entries WHERE crs=?", (crs,))
+        if not rows:
+            raise KeyError(crs)
+        return rows[0][0]
+
+    def __contains__(self, crs):
+        return len(self.execute("SELECT 1 FROM entries WHERE crs=?", (crs,))) > 0
+
+    def record(self, crs, filename, **metadata):
+        size, mtime = file_stats(filename)
+        values = dict(crs=crs, filename=filename, size=size, created=mtime, accessed=time.time())
+        values.update(metadata)
+        keys = values.keys()
+        self.execute("INSERT OR REPLACE INTO entries (%s) VALUES (%s)" % (", ".join(keys), ", ".join("?" * len(keys))),
+                     [values[k] for k in keys])
+
+    def __delitem__(self, crs):
+        with self.lock:
+            if self.db.execute("DELETE FROM entries WHERE crs=?", (crs,)).rowcount == 0:
+                raise KeyError(crs)
+            self.db.execute("DELETE FROM dependencies WHERE crs=?", (crs,))
+
+    def __iter__(self):
+        return iter([row[0] for row in self.execute("SELECT crs FROM entries")])
+
+    def __len__(self):
+        return self.execute("SELECT COUNT(*) FROM entries")[0][0]
+
+    def keys(self):
+        return [row[0] for row in self.execute("SELECT crs FROM entries")]
+
+    def values(self):
+        return [row[0] for row in self.execute("SELECT filename FROM entries")]
+
+    def items(self):
+        return self.execute("SELECT crs, filename FROM entries")
+
+    def clear(self):
+        self.execute("DELETE FROM entries")
+        self.execute("DELETE FROM dependencies")
+
+    def entry(self, crs):
+        with self.lock:
+            cursor = self.db.execute("SELECT * FROM entries WHERE crs=?", (crs,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([d[0] for d in cursor.description], row))
+
+    def crs_of(self, filename):
+        return [row[0] for row in self.execute("SELECT crs FROM entries WHERE filename=?", (filename,))]
+
+    def touch(self, crs):
+        if not self.readonly:
+            self.execute("UPDATE entries SET accessed=? WHERE crs=?", (time.time(), crs))
+
+    def usage(self, project=None):
+        with self.lock:
+            if project is None:
+                cursor = self.db.execute("SELECT * FROM entries")
+            else:
+                cursor = self.db.execute("SELECT * FROM entries WHERE project=?", (project,))
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def total_size(self, project=None):
+        if project is None:
+            rows = self.execute("SELECT SUM(size) FROM entries")
+        else:
+            rows = self.execute("SELECT SUM(size) FROM entries WHERE project=?", (project,))
+        return rows[0][0] or 0
+
+    def set_projects(self, projects):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("UPDATE entries SET project=? WHERE crs=?",
+                                    [(project, crs) for crs, project in projects])
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def set_shapes(self, shapes):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("UPDATE entries SET signature=?, pstart=?, pend=? WHERE crs=?",
+                                    [(signature, pstart, pend, crs) for crs, signature, pstart, pend in shapes])
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def set_dependencies(self, crs, dependencies):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("DELETE FROM dependencies WHERE crs=?", (crs,))
+                self.db.executemany("INSERT INTO dependencies (crs, kind, parent, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                                    [(crs,) + tuple(dep) for dep in dependencies])
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def dependencies(self, crs):
+        return self.execute("SELECT kind, parent, size, mtime FROM dependencies WHERE crs=?", (crs,))
+
+    def dependents(self, parent, prefix=False):
+        if prefix:
+            # Avoid LIKE, which would need escaping wildcards in paths
+            rows = self.execute("SELECT DISTINCT crs FROM dependencies WHERE kind='file' AND parent>=? AND parent<?",
+                                (parent, parent + "\xff"))
+        else:
+            rows = self.execute("SELECT DISTINCT crs FROM dependencies WHERE parent=?", (parent,))
+        return [row[0] for row in rows]
+
+    def file_dependencies(self):
+        return self.execute("SELECT crs, parent, size, mtime FROM dependencies WHERE kind='file'")
+
+    def shapes(self, signature):
+        return self.execute("SELECT pstart, pend, crs FROM entries WHERE signature=? ORDER BY pstart, pend, crs",
+                            (signature,))
+
+    def unshaped(self):
+        return [row[0] for row in self.execute("SELECT crs FROM entries WHERE signature IS NULL")]
+
+    def merge(self, entries, tag=None):
+        """
+        Inserts in a single transaction the entries of dict ENTRIES which CRS is not yet
+        indexed. If TAG is provided, it is recorded as done, see :py:meth:`merged`
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for crs, filename in entries.items():
+                    size, mtime = file_stats(filename)
+                    self.db.execute("INSERT OR IGNORE INTO entries (crs, filename, size, created, accessed) "
+                                    "VALUES (?, ?, ?, ?, ?)", (crs, filename, size, mtime, now))
+                if tag is not None:
+                    self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", tag)
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def merged(self, key):
+        """
+        Returns the value recorded for KEY by :py:meth:`merge`, or None
+        """
+        rows = self.execute("SELECT value FROM meta WHERE key=?", (key,))
+        if rows:
+            return rows[0][0]
+
+    def load(self):
+        # Import once the entries of an index written by the 'pickle' backend (e.g.
+        # by a former CliMAF version), and again each time that index file changes
+        legacy = pickleIndex(self.cachedir)
+        if not self.readonly and os.path.exists(legacy.filename):
+            stamp = repr(os.path.getmtime(legacy.filename))
+            if self.merged("pickle_index") != stamp:
+                entries = legacy.read()
+                clogger.info("Importing %d entries from legacy cache index %s" % (len(entries), legacy.filename))
+                self.merge(entries, ("pickle_index", stamp))
+
+    def close(self):
+        if self.db is not None:
+            with self.lock:
+                self.db.close()
+                self.db = None
+
+
+def _str(value):
+    """
+    Returns VALUE with unicode strings (as read in JSON) converted to (byte) strings
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(_str(k), _str(v)) for k, v in value.items()])
+    return value
+
+
+def _lazy(name):
+    """
+    Returns a property for attribute NAME of a journalIndex, which triggers reading the index on first use
+    """
+
+    def get(self):
+        if not self.loaded:
+            self.replay()
+        return self.__dict__["_" + name]
+
+    def set(self, value):
+        self.__dict__["_" + name] = value
+
+    return property(get, set)
+
+
+class journalIndex(pickleIndex):
+    """
+    An index made of a snapshot, pickled in file <cachedir>/index.snapshot, and of an append-only
+    journal of later changes, file <cachedir>/index.journal, with one JSON record per line
+
+    Each change is appended to the journal when it happens (under an exclusive ``flock``),
+    so that no entry is lost if the session is killed. The snapshot and the journal are read
+    only when the index is first used; then, only records appended by concurrent sessions are
+    read, when a lookup fails or when :py:meth:`load` is called. When the journal exceeds
+    'journal_compaction_size', it is merged in a new snapshot and replaced by an empty one.
+
+    A legacy index file <cachedir>/index (see :py:class:`pickleIndex`) is imported if there is no snapshot
+    """
+    name = "journal"
+    persistent = True
+    index_filename = "index.journal"
+
+    entries = _lazy("entries")
+    shape_of = _lazy("shape_of")
+    by_signature = _lazy("by_signature")
+    metadata = _lazy("metadata")
+    deps = _lazy("deps")
+
+    def __init__(self, cachedir, readonly=False):
+        self.loaded = True  # Avoid reading the index during initialization
+        pickleIndex.__init__(self, cachedir, readonly)
+        self.journal = os.path.join(self.cachedir, self.index_filename)
+        self.snapshot = os.path.join(self.cachedir, "index.snapshot")
+        self.lock = threading.RLock()
+        #: Inode of the journal which was read, and offset of the first record not yet read
+        self.journal_inode = None
+        self.offset = 0
+        self.loaded = False
+
+    # Journal handling
+
+    def open_journal(self, flags, lock):
+        """
+        Opens the current journal file and locks it with LOCK; returns its file descriptor,
+        or None if there is no journal
+        """
+        while True:
+            try:
+                fd = os.open(self.journal, flags)
+            except OSError:
+                return None
+            fcntl.flock(fd, lock)
+            # A compaction may have replaced the journal meanwhile
+            try:
+                current = os.fstat(fd).st_ino == os.stat(self.journal).st_ino
+            except OSError:
+                current = False
+            if current:
+                return fd
+            os.close(fd)
+
+    def append(self, *record):
+        """
+        Appends RECORD (a list of values) to the journal
+        """
+        if self.readonly:
+            return
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        with self.lock:
+            fd = self.open_journal(os.O_WRONLY | os.O_APPEND | os.O_CREAT, fcntl.LOCK_EX)
+            try:
+                os.write(fd, json.dumps(record) + "\n")
+                if journal_fsync:
+                    os.fsync(fd)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            if size > journal_compaction_size:
+                self.compact()
+
+    def apply(self, record):
+        """
+        Applies a journal RECORD to the in-memory index
+        """
+        action = record[0]
+        if action == "+":
+            crs, filename, signature, pstart, pend, metadata = record[1:]
+            pickleIndex.record(self, crs, filename)
+            self.metadata[crs] = metadata
+            if signature is not None:
+                pickleIndex.set_shapes(self, [(crs, signature, pstart, pend)])
+        elif action == "-":
+            if record[1] in self.entries:
+                pickleIndex.__delitem__(self, record[1])
+        elif action == "shapes":
+            pickleIndex.set_shapes(self, record[1])
+        elif action == "projects":
+            pickleIndex.set_projects(self, record[1])
+        elif action == "deps":
+            pickleIndex.set_dependencies(self, record[1], [tuple(dep) for dep in record[2]])
+        elif action == "clear":
+            pickleIndex.clear(self)
+
+    def replay(self, lock=True):
+        """
+        Reads the snapshot and the whole journal
+        """
+        with self.lock:
+            self.loaded = True
+            self.entries, self.metadata, self.deps = dict(), dict(), dict()
+            self.shape_of, self.by_signature = dict(), dict()
+            fd = None
+            if lock:
+                fd = self.open_journal(os.O_RDONLY, fcntl.LOCK_SH)
+            try:
+                if os.path.exists(self.snapshot):
+                    with open(self.snapshot, "rb") as f:
+                        state = pickle.load(f)
+                    self.entries = state["entries"]
+                    self.metadata = state["metadata"]
+                    self.deps = state["deps"]
+                    pickleIndex.set_shapes(self, state["shapes"])
+                else:
+                    self.entries = pickleIndex.read(self)
+                self.journal_inode, self.offset = None, 0
+                self.tail(fd)
+            finally:
+                if fd is not None:
+                    os.close(fd)
+            self.dropped = []
+
+    def tail(self, fd=None):
+        """
+        Reads the records appended to the journal since last read (using file descriptor
+        FD if provided), or the snapshot and whole journal if it was compacted meanwhile
+        """
+        with self.lock:
+            try:
+                inode = os.stat(self.journal).st_ino
+            except OSError:
+                return
+            if self.journal_inode is not None and inode != self.journal_inode:
+                self.replay()
+                return
+            if fd is None:
+                with open(self.journal, "rb") as f:
+                    self.read_records(f, inode)
+            else:
+                with os.fdopen(os.dup(fd), "rb") as f:
+                    self.read_records(f, os.fstat(fd).st_ino)
+
+    def read_records(self, f, inode):
+        f.seek(self.offset)
+        for line in f:
+            if not line.endswith("\n"):
+                # A record being written
+                break
+            try:
+                self.apply(_str(json.loads(line)))
+            except ValueError:
+                clogger.warning("Skipping corrupted record in cache index journal %s : %s" % (self.journal, line))
+            self.offset += len(line)
+        self.journal_inode = inode
+
+    def compact(self):
+        """
+        Writes the whole index in a new snapshot, and empties the journal
+        """
+        if self.readonly:
+            return
+        with self.lock:
+            fd = self.open_journal(os.O_RDONLY, fcntl.LOCK_EX)
+            if fd is None:
+                return
+            try:
+                self.replay(lock=False)
+                state = dict(entries=self.entries, metadata=self.metadata, deps=self.deps,
+                             shapes=[(crs,) + shape for crs, shape in self.shape_of.items()])
+                tmp = "%s_%d" % (self.snapshot, os.getpid())
+                with open(tmp, "wb") as f:
+                    pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp, self.snapshot)
+                tmp = "%s_%d" % (self.journal, os.getpid())
+                open(tmp, "w").close()
+                os.rename(tmp, self.journal)
+                self.journal_inode, self.offset = os.stat(self.journal).st_ino, 0
+            finally:
+                os.close(fd)
+            clogger.debug("Cache index journal %s compacted" % self.journal)
+
+    # Changes are applied in memory and journaled
+
+    def record(self, crs, filename, signature=None, pstart=None, pend=None, **metadata):
+        pickleIndex.record(self, crs, filename, **metadata)
+        if signature is not None:
+            pickleIndex.set_shapes(self, [(crs, signature, pstart, pend)])
+        self.append("+", crs, filename, signature, pstart, pend, self.metadata[crs])
+
+    def __delitem__(self, crs):
+        pickleIndex.__delitem__(self, crs)
+        self.append("-", crs)
+
+    def set_shapes(self, shapes):
+        pickleIndex.set_shapes(self, shapes)
+        self.append("shapes", shapes)
+
+    def set_projects(self, projects):
+        pickleIndex.set_projects(self, projects)
+        self.append("projects", projects)
+
+    def set_dependencies(self, crs, dependencies):
+        pickleIndex.set_dependencies(self, crs, dependencies)
+        self.append("deps", crs, list(dependencies))
+
+    def clear(self):
+        pickleIndex.clear(self)
+        self.append("clear")
+
+    # Lookups read the records of concurrent sessions before failing
+
+    def __getitem__(self, crs):
+        if crs not in self.entries:
+            self.tail()
+        return self.entries[crs]
+
+    def __contains__(self, crs):
+        if crs not in self.entries:
+            self.tail()
+        return crs in self.entries
+
+    def read(self):
+        return dict(journalIndex(self.cachedir, readonly=True).entries)
+
+    def load(self):
+        if self.loaded:
+            self.tail()
+
+    def sync(self):
+        pass
+
+
+#: Available backends, by name
+backends = dict(pickle=pickleIndex, sqlite=sqliteIndex, journal=journalIndex)
@@ -31,6 +31,41 @@ frequencies = dict()
 #: Dictionary of realms names dictionaries
 realms = dict()
 
+#: Whether CRS expressions are built in canonical form, so that semantically identical objects
+# share the same CRS (and cache entry) : see :py:func:`canonical_repr`
+canonical_crs = True
+
+#: Whether the CRS of datasets with wildcard facets uses the facet values which match data
+# files, when they are unique (this implies scanning the data files when building the CRS)
+resolve_wildcards = False
+
+#: The datasets CRS with wildcards resolved, by raw CRS
+resolved_crs = dict()
+
+
+def canonical_repr(value):
+    """
+    Returns a representation of VALUE (a parameter value) which is the same for
+    equal values, whatever their type : integral floats are written as integers
+    (e.g. 1.0 as 1), unicode strings as strings, and dicts with sorted keys
+    """
+    if isinstance(value, bool):
+        return repr(value)
+    if isinstance(value, float) and value.is_integer() and abs(value) < 2 ** 53:
+        return repr(int(value))
+    if isinstance(value, (int, long)):
+        return repr(int(value))
+    if isinstance(value, unicode):
+        return repr(value.encode("utf-8"))
+    if isinstance(value, list):
+        return "[" + ", ".join([canonical_repr(v) for v in value]) + "]"
+    if isinstance(value, tuple):
+        return "(" + ", ".join([canonical_repr(v) for v in value]) + ("," if len(value) == 1 else "") + ")"
+    if isinstance(value, dict):
+        return "{" + ", ".join(["%s: %s" % (canonical_repr(k), canonical_repr(value[k]))
+                                for k in sorted(value)]) + "}"
+    return repr(value)
+
 
 class cproject():
     def __init__(self, name, *args, **kwargs):
@@ -231,7 +266,7 @@ class cdummy(cobject):
         """
         pass
 
-    def buildcrs(self, period=None, crsrewrite=None):
+    def buildcrs(self, period=None, crsrewrite=None, canonical=None):
         return 'ARG'
 
 
@@ -419,14 +454,32 @@ class cdataset(cobject):
         self.crs = self.buildcrs()
         self.register()
 
-    def buildcrs(self, period=None, crsrewrite=None):
+    def buildcrs(self, period=None, crsrewrite=None, canonical=None):
+        """
+        Builds the CRS expression of the dataset, for PERIOD if provided; if CANONICAL
+        (default : canonical_crs), the domain is written in canonical form, and wildcard
+        facets are resolved if resolve_wildcards is True
+        """
+        if canonical is None:
+            canonical = canonical_crs
         crs_template = string.Template(cprojects[self.project].crs)
         dic = self.kvp.copy()
         if period is not None:
             dic['period'] = period
         if type(dic['domain']) is list:
-            dic['domain'] = repr(dic['domain'])
+            if canonical:
+                dic['domain'] = canonical_repr(dic['domain'])
+            else:
+                dic['domain'] = repr(dic['domain'])
         rep = "ds('%s')" % crs_template.safe_substitute(dic)
+        if canonical and resolve_wildcards and "*" in rep:
+            if rep not in resolved_crs:
+                resolved_crs[rep] = rep
+                try:
+                    resolved_crs[rep] = self.explore('resolve').buildcrs(period=period)
+                except Climaf_Classes_Error:
+                    pass
+            rep = resolved_crs[rep]
         return rep
 
     def errata(self):
@@ -741,10 +794,28 @@ class cdataset(cobject):
 
         Use cached value (i.e. attribute 'files') unless called with arg force=True
         If ensure_dataset is True, forbid ambiguous datasets
+
+        A dataset for which no file was found is not searched again, for the same data
+        locations, during cache.failure_ttl seconds, unless called with arg force=True
+        (see :py:func:`~climaf.cache.cforget_failures`)
         """
         if (force and self.project != 'file') or self.files is None:
-            if ensure_dataset:
+            import cache
+            model = getattr(self, "model", "*")
+            fingerprint = repr(dataloc.getlocs(project=self.project, model=model, simulation=self.simulation,
+                                               frequency=self.frequency))
+            failure = None
+            if not force and ensure_dataset:
+                failure = cache.known_failure(self.crs, fingerprint)
+            if failure is not None:
+                clogger.info("No file searched for %s : %s" % (self.crs, failure))
+                self.files = ""
+            elif ensure_dataset:
                 self.explore()
+                if not self.files:
+                    cache.record_failure(self.crs, "no file found", fingerprint)
+                elif force:
+                    cache.cforget_failures(self.crs)
             else:
                 self.explore(option='choices')
         return self.files
@@ -1111,10 +1182,14 @@ class cens(cobject, dict):
         if self.sortfunc:
             self.order = self.sortfunc(self.keys())
 
-    def buildcrs(self, crsrewrite=None, period=None):
+    def buildcrs(self, crsrewrite=None, period=None, canonical=None):
+        # The CRS does not tell the members order; in canonical form, they are sorted
+        if canonical is None:
+            canonical = canonical_crs
         rep = "cens({"
-        for m in self.order:
-            rep += "'" + m + "'" + ":" + self[m].buildcrs(crsrewrite=crsrewrite, period=period) + ","
+        for m in (sorted(self.order) if canonical else self.order):
+            rep += "'" + m + "'" + ":" + self[m].buildcrs(crsrewrite=crsrewrite, period=period,
+                                                          canonical=canonical) + ","
         rep = rep + "}"
         rep = rep.replace(",}", "}")
         rep = rep + ")"
@@ -1311,18 +1386,22 @@ class ctree(cobject):
         self.outputs = dict()
         self.register()
 
-    def buildcrs(self, crsrewrite=None, period=None):
+    def buildcrs(self, crsrewrite=None, period=None, canonical=None):
         """ Builds the CRS expression representing applying OPERATOR on OPERANDS with PARAMETERS.
         Forces period downtree if provided
         A function for rewriting operand's CRS may be provided
+        If CANONICAL (default : canonical_crs), parameters values are written in canonical
+        form (see :py:func:`canonical_repr`), and a 'period' parameter as a CliMAF period
         """
+        if canonical is None:
+            canonical = canonical_crs
         # Operators are listed in alphabetical order; parameters too
         rep = self.operator + "("
         #
         ops = [o for o in self.operands]
         for op in ops:
             if op:
-                opcrs = op.buildcrs(crsrewrite=crsrewrite, period=period)
+                opcrs = op.buildcrs(crsrewrite=crsrewrite, period=period, canonical=canonical)
                 if crsrewrite:
                     opcrs = crsrewrite(opcrs)
                 rep += opcrs + ","
@@ -1331,7 +1410,13 @@ class ctree(cobject):
         clefs.sort()
         for par in clefs:
             if par != 'member_label':
-                rep += par + "=" + repr(self.parameters[par]) + ","
+                value = self.parameters[par]
+                if not canonical:
+                    rep += par + "=" + repr(value) + ","
+                    continue
+                if par == 'period' and isinstance(value, str) and re.match(r"^\d{4,12}([-_]\d{4,12})?$", value):
+                    value = repr(init_period(value))
+                rep += par + "=" + canonical_repr(value) + ","
         rep += ")"
         rep = rep.replace(",)", ")")
         return rep
@@ -1363,8 +1448,8 @@ class scriptChild(cobject):
         self.crs += "." + self.varname
         self.register()
 
-    def buildcrs(self, period=None, crsrewrite=None):
-        tmp = self.father.buildcrs(period=period)
+    def buildcrs(self, period=None, crsrewrite=None, canonical=None):
+        tmp = self.father.buildcrs(period=period, canonical=canonical)
         if crsrewrite:
             tmp = crsrewrite(tmp)
         return tmp + "." + self.varname
@@ -1813,13 +1898,13 @@ class cpage(cobject):
         self.widths = [round(1. / nx, 2) for i in range(nx)]
         self.heights = [round(1. / ny, 2) for i in range(ny)]
 
-    def buildcrs(self, crsrewrite=None, period=None):
+    def buildcrs(self, crsrewrite=None, period=None, canonical=None):
         rep = "cpage(["
         for line in self.fig_lines:
             rep += "["
             for f in line:
                 if f:
-                    rep += f.buildcrs(crsrewrite=crsrewrite) + ","
+                    rep += f.buildcrs(crsrewrite=crsrewrite, canonical=canonical) + ","
                 else:
                     rep += repr(None) + ","
             rep += " ],"
@@ -1988,13 +2073,13 @@ class cpage_pdf(cobject):
         #
         self.crs = self.buildcrs()
 
-    def buildcrs(self, crsrewrite=None, period=None):
+    def buildcrs(self, crsrewrite=None, period=None, canonical=None):
         rep = "cpage_pdf(["
         for line in self.fig_lines:
             rep += "["
             for f in line:
                 if f:
-                    rep += f.buildcrs(crsrewrite=crsrewrite) + ","
+                    rep += f.buildcrs(crsrewrite=crsrewrite, canonical=canonical) + ","
                 else:
                     rep += repr(None) + ","
             rep += " ],"
@@ -19,22 +19,95 @@ import subprocess
 import time
 import shutil
 import copy
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 from string import Template
-import tempfile
 from datetime import datetime
 
 # Climaf modules
 import climaf
 import classes
 import cache
+import aggregates
 import operators
 import cmacro
 from clogging import clogger, indent as cindent, dedent as cdedent
 from climaf.netcdfbasics import varOfFile
 from climaf.period import init_period, cperiod
 from climaf import xdg_bin
+import filemeta
 
 logdir = "."
+#: Maximum number of computations which CliMAF runs concurrently (e.g. for the operands of
+# a script call, see :py:func:`schedule`, or for the chunks of a period which are missing in
+# cache, see :py:func:`parallel_map`)
+max_workers = cpu_count()
+#: How figures are composited into a cpage : either 'convert' (ImageMagick, in one call) or
+# 'pil' (in-process, if module PIL is available and the page format is 'png')
+page_compositor = "convert"
+#: How long periods are split for evaluating, by chunks, objects which operators commute with time
+# concatenation (see :py:func:`chunk_bounds`) : None (no splitting), a number of years (e.g. 10 for
+# splitting at each decade), or 'files' (for splitting at the bounds of the data files)
+time_chunks = None
+#: Maximum size (in bytes) of the data read by one script call, for objects which operators commute
+# with space concatenation; larger objects are evaluated by bands of grid rows (tiles), at most
+# :py:data:`max_workers` at a time (see :py:func:`tiles_of`); 0 means no tiling
+tile_size = 0
+#: Locks on the names of the fixed fields links made in the working directory, by name
+# (see :py:func:`fixed_fields_locks`)
+links_locks = dict()
+links_locks_guard = threading.Lock()
+
+
+def fixed_fields_locks(linknames):
+    """
+    Returns the locks on LINKNAMES, the fixed fields links of a script call, in a consistent
+    order; script calls run concurrently share the working directory, so that a script call
+    must hold these locks from the creation of its links up to their removal
+    """
+    with links_locks_guard:
+        return [links_locks.setdefault(name, threading.Lock()) for name in sorted(set(linknames))]
+
+
+def parallel_map(function, items, workers=None):
+    """
+    Returns the list of the results of FUNCTION for ITEMS, computed by at most WORKERS
+    threads (default : :py:data:`max_workers`); the first exception raised by FUNCTION
+    is raised again, once all calls are completed
+
+    In a worker thread, calls are made one after the other, so that the number of threads
+    (and of subprocesses) remains bounded by max_workers
+    """
+    items = list(items)
+    if workers is None:
+        workers = max_workers
+    if workers <= 1 or len(items) <= 1 or not in_main_thread():
+        return map(function, items)
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def in_main_thread():
+    """
+    Tells if the current thread is the main one, i.e. not a worker thread
+    """
+    return isinstance(threading.current_thread(), threading._MainThread)
+
+
+def script_logfile():
+    """
+    Returns the file which receives stdout and stderr of script calls : 'last.out' in
+    logdir or, for calls in worker threads, a file specific to the thread
+    """
+    if in_main_thread():
+        return logdir + "/last.out"
+    return logdir + "/last.%d.out" % threading.current_thread().ident
 
 
 def capply(climaf_operator, *operands, **parameters):
@@ -155,7 +228,7 @@ def capply_operator(climaf_operator, *operands, **parameters):
 
 
 def ceval(cobject, userflags=None, format="MaskedArray",
-          deep=None, derived_list=[], recurse_list=[]):
+          deep=None, derived_list=[], recurse_list=[], grow=False, max_parallel=None, found=None):
     """
     Actually evaluates a CliMAF object, either as an in-memory data structure or
     as a string of filenames (which either represent a superset or exactly includes
@@ -167,6 +240,16 @@ def ceval(cobject, userflags=None, format="MaskedArray",
 
     arg derived_list is the list of variables that have been considered as 'derived'
     (i.e. not natives) in upstream evaluations. It avoids to loop endlessly
+
+    with arg grow=True, datasets with period '*' get the period currently covered by their
+    data files, and the object cached for an earlier end of that period, if any, is extended
+    in place (see :py:func:`ceval_grow`)
+
+    the members of an ensemble are evaluated concurrently, by at most MAX_PARALLEL workers
+    (default : :py:data:`max_workers`), see :py:func:`ceval_members`
+
+    arg found, if provided, is the result of the cache lookups for a script call already made
+    by :py:func:`dag`, which are then not made again
     """
     if format != 'MaskedArray' and format != 'file' and format != 'txt':
         raise Climaf_Driver_Error("Allowed formats yet are : 'object', 'nc', 'txt', %s" % ', '.join(
@@ -174,6 +257,8 @@ def ceval(cobject, userflags=None, format="MaskedArray",
     #
     if userflags is None:
         userflags = operators.scriptFlags()
+    if grow:
+        cobject = grown(cobject)
     #
     # Next check is too crude for dealing with use of operator 'select'
     # if cobject.crs in recurse_list :
@@ -274,59 +359,101 @@ def ceval(cobject, userflags=None, format="MaskedArray",
         #################################################################
         if deep is not None:
             cache.cdrop(cobject.crs)
+            cache.cforget_failures(cobject.crs)
         #
         clogger.debug("Searching cache for exact object : " + repr(cobject))
         #################################################################
-        filename = cache.hasExactObject(cobject)
+        tim1 = time.time()
+        filename = cache.hasExactObject(cobject) if found is None else None
+        cache.count("lookup_time", time.time() - tim1)
         # filename=None
         if filename:
             clogger.info("Object found in cache: %s is at %s:  " % (cobject.crs, filename))
+            cache.count_hit("exact", filename)
             cdedent()
             if format == 'file':
                 return filename
             else:
                 return cread(filename, classes.varOf(cobject))
+        if grow and isinstance(cobject, classes.ctree):
+            filename = ceval_grow(cobject, userflags, deep, derived_list, recurse_list)
+            if filename:
+                cdedent()
+                if format == 'file':
+                    return filename
+                else:
+                    return cread(filename, classes.varOf(cobject))
         if not isinstance(cobject, classes.cpage) and not isinstance(cobject, classes.cpage_pdf) and \
                 not isinstance(cobject, classes.cens):
             clogger.debug("Searching cache for including object for : " + repr(cobject))
             ########################################################################
-            it, altperiod = cache.hasIncludingObject(cobject)
+            tim1 = time.time()
+            it = cache.hasIncludingObject(cobject)[0] if found is None else found["including"]
+            cache.count("lookup_time", time.time() - tim1)
             # clogger.debug("Finished with searching cache for including object for : " + `cobject`)
             # it=None
             if it:
                 clogger.info("Including object found in cache : %s" % it.crs)
+                clogger.info("Selecting " + repr(cobject) + " out of it")
+                cache.count_hit("including", cache.cached_file(it.crs))
+                # Just select (if necessary for the user) the portion relevant to the request
+                rep = ceval_select(it, cobject, userflags, 'file', deep, derived_list, recurse_list)
+                cdedent()
                 if format == 'file':
-                    clogger.info("Selecting " + repr(cobject) + " out of it")
-                    # Just select (if necessary for the user) the portion relevant to the request
-                    rep = ceval_select(it, cobject, userflags, format, deep, derived_list, recurse_list)
-                    cdedent()
                     return rep
                 else:
-                    clogger.debug("Because out format %s is not (yet, TBD) supported by ceval_select, cannot use "
-                                  "including object found for : " % format + repr(cobject))
+                    return cread(rep, classes.varOf(cobject))
             #
-            clogger.debug("Searching cache for begin  object for : " + repr(cobject))
+            clogger.debug("Searching cache for chunks of : " + repr(cobject))
             ########################################################################
-            it, comp_period = cache.hasBeginObject(cobject)
-            clogger.debug("Finished with searching cache for begin  object for : " + repr(cobject))
-            # it=None
-            if it:
-                clogger.info("partial result found in cache for %s : %s" % (cobject.crs, it.crs))
-                clogger.debug("comp_period=" + repr(comp_period))
-                begcrs = it.crs
-                # Build complement object for end, and eval it
-                comp = copy.deepcopy(it)
-                comp.setperiod(comp_period)
-                evalcomp = ceval(comp, userflags, format, deep, derived_list, recurse_list)
-                set_variable(evalcomp, cobject.variable, format=format)
-                rep = cache.complement(begcrs, comp.crs, cobject.crs)
+            tim1 = time.time()
+            pieces = cache.hasChunkedObject(cobject) if found is None else found["pieces"]
+            cache.count("lookup_time", time.time() - tim1)
+            clogger.debug("Finished with searching cache for chunks of : " + repr(cobject))
+            if pieces and any([crs for period, crs in pieces]):
+                clogger.info("partial results found in cache for %s : %s" %
+                             (cobject.crs, [crs for period, crs in pieces if crs]))
+                cache.count_hit("begin", *[cache.cached_file(crs) for period, crs in pieces if crs])
+            else:
+                cache.count("misses")
+            # Long periods are evaluated by chunks, which are cached and can be re-used
+            if found is None:
+                pieces = split_gaps(cobject, pieces)
+            if pieces:
+                # Build objects for the gaps, and eval them concurrently
+                gaps = []
+                for i, (period, crs) in enumerate(pieces):
+                    if crs is None:
+                        gap = copy.deepcopy(cobject)
+                        gap.setperiod(period)
+                        gaps.append(gap)
+                        pieces[i] = (period, gap.crs)
+                clogger.debug("computing gaps " + repr([obj.crs for obj in gaps]))
+                parallel_map(lambda gap: ceval(gap, copy.copy(userflags), 'file', deep, derived_list,
+                                               list(recurse_list)), gaps)
+                rep = cache.mosaic([crs for period, crs in pieces], cobject.crs)
                 cdedent()
                 if format == 'file':
                     return rep
                 else:
-                    return ceval(cobject)
+                    return cread(rep, classes.varOf(cobject))
+            #
+            # Objects with a large data are evaluated by tiles, which are cached and can be re-used
+            tiles = tiles_of(cobject) if found is None else found["tiles"]
+            if tiles:
+                clogger.info("Evaluating %s by %d tiles" % (cobject.crs, len(tiles)))
+                parallel_map(lambda tile: ceval(tile, copy.copy(userflags), 'file', deep, derived_list,
+                                                list(recurse_list)), tiles)
+                rep = cache.collage([tile.crs for tile in tiles], cobject.crs)
+                cdedent()
+                if format == 'file':
+                    return rep
+                else:
+                    return cread(rep, classes.varOf(cobject))
             #
             clogger.info("nothing relevant found in cache for %s" % cobject.crs)
+        else:
+            cache.count("misses")
         #
         if not deep:
             deep = None
@@ -335,6 +462,16 @@ def ceval(cobject, userflags=None, format="MaskedArray",
             # the cache doesn't have a similar tree, let us recursively eval subtrees
             ##########################################################################
             # TBD  : analyze if the dataset is remote and the remote place 'offers' the operator
+            equivalent = aggregates.assembled(cobject) if found is None else found["equivalent"]
+            if equivalent is not None:
+                clogger.info("Assembling %s from partial aggregates" % cobject.crs)
+                file = cache.rename(ceval(equivalent, userflags, 'file', deep, derived_list, recurse_list),
+                                    cobject.crs)
+                cdedent()
+                if format == 'file':
+                    return file
+                else:
+                    return cread(file, classes.varOf(cobject))
             if cobject.operator in operators.scripts:
                 file = ceval_script(cobject, deep,
                                     recurse_list=recurse_list)  # Does return a filename, or list of filenames
@@ -377,10 +514,8 @@ def ceval(cobject, userflags=None, format="MaskedArray",
             else:
                 return cread(file)  # !! Does it make sense ?
         elif isinstance(cobject, classes.cens):
-            d = dict()
-            for member in cobject.order:
-                # print ("evaluating member %s"%member)
-                d[member] = ceval(cobject[member], copy.copy(userflags), format, deep, recurse_list=recurse_list)
+            d = ceval_members(cobject, userflags, format, deep, recurse_list, max_parallel)
+            cdedent()
             if format == "file":
                 return reduce(lambda x, y: x + " " + y, [d[m] for m in cobject.order])
             else:
@@ -394,6 +529,392 @@ def ceval(cobject, userflags=None, format="MaskedArray",
         raise Climaf_Driver_Error("argument " + repr(cobject) + " is not (yet) managed")
 
 
+def file_periods(dataset):
+    """
+    Returns the list of periods of the data files of DATASET, as told by their names (see
+    :py:meth:`~climaf.classes.cdataset.explore`); the list is empty if they cannot be known
+    """
+    try:
+        periods = classes.cdataset(**dict(dataset.kvp, period="*")).explore('choices', operation=None).get('period')
+    except Exception, e:
+        clogger.debug("Cannot know the periods of the data files of %s : %s" % (dataset.crs, e))
+        return []
+    if isinstance(periods, dict):
+        periods = sum(periods.values(), [])
+    return [p for p in periods or [] if isinstance(p, cperiod)]
+
+
+def chunk_bounds(cobject):
+    """
+    Returns the sorted list of the dates, inside the period of COBJECT, where it is split for being
+    evaluated by chunks (see :py:data:`time_chunks`), provided COBJECT is a script call which operators
+    commute with time concatenation; returns an empty list otherwise
+    """
+    if not time_chunks or not isinstance(cobject, classes.ctree) or cobject.operator not in operators.scripts:
+        return []
+    signature, period = cache.shape(cobject)
+    if period is None or not cache.operators_commute(cobject, "period"):
+        return []
+    dates = set()
+    if time_chunks == "files":
+        for dataset in cache.datasets_of(cobject):
+            for p in file_periods(dataset):
+                dates.update([p.start, p.end])
+    else:
+        step = int(time_chunks)
+        dates.update([datetime(year, 1, 1) for year in range(period.start.year, period.end.year + 1)
+                      if year % step == 0])
+    return sorted([date for date in dates if period.start < date < period.end])
+
+
+def split_gaps(cobject, pieces=None):
+    """
+    Splits the gaps among PIECES, a list of pairs (period, CRS) which tile the period of COBJECT,
+    where CRS is None for the gaps to compute (see :py:func:`~climaf.cache.hasChunkedObject`), at
+    the chunk bounds of COBJECT (see :py:func:`chunk_bounds`)
+
+    Returns the new list of pieces; if PIECES is None, the period of COBJECT is split, and None is
+    returned if it is not to be split
+    """
+    bounds = chunk_bounds(cobject)
+    if pieces is None:
+        if not bounds:
+            return None
+        pieces = [(cache.shape(cobject)[1], None)]
+    rep = []
+    for period, crs in pieces:
+        if crs is None:
+            dates = [period.start] + [date for date in bounds if period.start < date < period.end] + [period.end]
+            rep.extend([(cperiod(start, end), None) for start, end in zip(dates[:-1], dates[1:])])
+        else:
+            rep.append((period, crs))
+    return rep
+
+
+def data_size(cobject):
+    """
+    Returns the size, in bytes, of the local data files of the datasets of COBJECT
+    """
+    size = 0
+    for dataset in cache.datasets_of(cobject):
+        try:
+            files = dataset.baseFiles()
+        except Exception, e:
+            clogger.debug("Cannot know the data files of %s : %s" % (dataset.crs, e))
+            continue
+        size += sum([os.path.getsize(f) for f in (files or "").split(" ") if os.path.isfile(f)])
+    return size
+
+
+def horizontal_dimension(fileobj, name):
+    """
+    Tells if dimension NAME of open NetCDF file FILEOBJ may be a horizontal one : it is not
+    the record dimension, nor a time or vertical one (according to its name or to the
+    attributes of its coordinate variable)
+    """
+    dimension = fileobj.dimensions.get(name)
+    if dimension is None or (hasattr(dimension, "isunlimited") and dimension.isunlimited()):
+        return False
+    if name.lower().startswith("time"):
+        return False
+    coordinate = fileobj.variables.get(name)
+    if coordinate is not None and (getattr(coordinate, "axis", "") in ["T", "Z"] or hasattr(coordinate, "positive")):
+        return False
+    return True
+
+
+def grid_shape(dataset):
+    """
+    Returns the shape (rows, columns) of the horizontal grid of DATASET, i.e. the last two dimensions
+    of its variable in its first data file, or None if it cannot be read or if these are not both
+    horizontal dimensions (e.g. for an unstructured grid, see :py:func:`horizontal_dimension`)
+    """
+    try:
+        from anynetcdf import ncf
+        filename = dataset.baseFiles().split(" ")[0]
+        variable = classes.varOf(dataset)
+        if dataset.alias:
+            variable = Template(dataset.alias[0]).safe_substitute(dataset.kvp)
+        fileobj = ncf(filename, 'r')
+        try:
+            if variable not in fileobj.variables:
+                variable = varOfFile(filename)
+            shape = fileobj.variables[variable].shape
+            dimensions = fileobj.variables[variable].dimensions
+            if len(shape) < 2 or not all([horizontal_dimension(fileobj, name) for name in dimensions[-2:]]):
+                clogger.debug("The grid of %s is not a 2D one" % dataset.crs)
+                return None
+        finally:
+            fileobj.close()
+    except Exception, e:
+        clogger.debug("Cannot read the grid of %s : %s" % (dataset.crs, e))
+        return None
+    return tuple(shape[-2:])
+
+
+def tiles_of(cobject):
+    """
+    Returns the list of the objects (tiles) which compute COBJECT for bands of grid rows, if its data
+    is larger than :py:data:`tile_size`, and if COBJECT is a script call which operators commute with
+    space concatenation, and which datasets are global and share the same grid; returns an empty list
+    otherwise
+
+    Each tile is COBJECT applied to the selection of its band out of each dataset (using CDO operator
+    selindexbox, which does not depend on the grid type), and reads at most tile_size bytes of data;
+    the tiles are assembled using :py:func:`~climaf.cache.collage`
+    """
+    if not tile_size or not isinstance(cobject, classes.ctree) or cobject.operator not in operators.scripts or \
+            "ccdo" not in operators.scripts:
+        return []
+    datasets = cache.datasets_of(cobject)
+    if not datasets or any([d.domain != "global" for d in datasets]) or \
+            not cache.operators_commute(cobject, "domain"):
+        return []
+    size = data_size(cobject)
+    if size <= tile_size:
+        return []
+    shapes = set([grid_shape(d) for d in datasets])
+    if len(shapes) != 1 or None in shapes:
+        return []
+    rows, columns = shapes.pop()
+    ntiles = min(rows, -(-size // tile_size))
+    if ntiles < 2:
+        return []
+
+    def tile(obj, operator):
+        # Returns OBJ, computed out of the selection by CDO OPERATOR of its datasets
+        if isinstance(obj, classes.cdataset):
+            return maketree("ccdo", operators.scripts["ccdo"], obj, operator=operator)
+        if isinstance(obj, classes.scriptChild):
+            return tile(obj.father, operator).outputs[obj.varname]
+        if isinstance(obj, classes.ctree):
+            return maketree(obj.operator, operators.scripts[obj.operator],
+                            *[tile(op, operator) if op else op for op in obj.operands], **obj.parameters)
+        return obj
+
+    bounds = [rows * i // ntiles for i in range(ntiles + 1)]
+    return [tile(cobject, "selindexbox,1,%d,%d,%d" % (columns, start + 1, end))
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def grown(cobject):
+    """
+    Returns a copy of COBJECT for the period currently covered by the data files of its
+    datasets which period is '*' (see :py:meth:`~climaf.classes.cdataset.explore`), i.e. the
+    period common to all these datasets, which is then set for all its datasets; returns
+    COBJECT if no dataset has period '*'
+    """
+    datasets = [d for d in cache.datasets_of(cobject) if d.kvp.get("period") == "*"]
+    if not datasets:
+        return cobject
+    period = None
+    for d in datasets:
+        available = d.explore('resolve').period
+        period = available if period is None else period.intersects(available)
+        if period is None:
+            raise Climaf_Driver_Error("Datasets of %s have no common period" % cobject.crs)
+    clogger.info("Available period for %s is %s" % (cobject.crs, period))
+    rep = copy.deepcopy(cobject)
+    rep.setperiod(period)
+    return rep
+
+
+def ceval_grow(cobject, userflags, deep, derived_list, recurse_list):
+    """
+    Evaluates COBJECT by extending in place the file of the object cached for the longest period
+    which begins COBJECT's one with the object for the rest of the period, which is the only one
+    computed (see :py:func:`~climaf.cache.extend`); this is done holding the computation lock
+    for COBJECT
+
+    Returns the filename, or None if no such object is cached (or if it is in a shared cache)
+    """
+    final = cache.generateUniqueFileName(cobject.crs)
+    lock = cache.computation_lock(final)
+    if not lock.acquire():
+        return None
+    try:
+        if lock.waited and cache.published(cobject.crs, final):
+            return final
+        tim1 = time.time()
+        it, comp_period = cache.hasBeginObject(cobject)
+        cache.count("lookup_time", time.time() - tim1)
+        if not it or it.crs not in cache.crs2filename:
+            return None
+        clogger.info("Growing %s with period %s" % (it.crs, comp_period))
+        cache.count_hit("begin", cache.cached_file(it.crs))
+        comp = copy.deepcopy(cobject)
+        comp.setperiod(comp_period)
+        ceval(comp, copy.copy(userflags), 'file', deep, derived_list, recurse_list)
+        return cache.extend(it.crs, comp.crs, cobject.crs)
+    finally:
+        lock.release()
+
+
+def script_environment(operator, script):
+    """
+    Returns the environment for launching SCRIPT for OPERATOR : for NetCDF outputs which
+    should be compressed (see :py:func:`~climaf.cache.set_compression`), $CLIMAF_CDO_OPTIONS
+    tells scripts using CDO to write compressed NetCDF4 files; returns None for the
+    current environment
+    """
+    level = cache.compression_level(operator)
+    if not level or script.outputFormat != "nc":
+        return None
+    return dict(os.environ, CLIMAF_CDO_OPTIONS="-f nc4 -z zip_%d" % level)
+
+
+def dag(objects, deep=None):
+    """
+    Returns the dependency graph of the script calls needed for evaluating OBJECTS, as an
+    ordered dict of tuples (script call, set of CRS of the script calls it depends on, result
+    of the cache lookups for the script call) by CRS; identical script calls (which have the
+    same CRS) appear once. The lookup results are a dict which :py:func:`ceval` can use instead
+    of making the lookups again
+
+    Unless DEEP is True, the graph does not go below the script calls which the cache
+    serves, either for an identical, an including, or a chunked object; it does not go below
+    the script calls which are evaluated by chunks or tiles either (see :py:func:`split_gaps`
+    and :py:func:`tiles_of`); for an
+    object assembled from partial aggregates (see :py:mod:`~climaf.aggregates`), the graph
+    includes the script calls for the aggregates
+    """
+    nodes = OrderedDict()
+
+    def visit(obj):
+        # Returns the CRS of the script calls which OBJ depends on
+        if isinstance(obj, classes.cens):
+            return sum([visit(obj[member]) for member in obj.order], [])
+        if isinstance(obj, classes.scriptChild):
+            return visit(obj.father)
+        if not isinstance(obj, classes.ctree):
+            return []
+        if obj.operator not in operators.scripts:
+            return sum([visit(op) for op in obj.operands if op], [])
+        if obj.crs in nodes:
+            return [obj.crs]
+        if not deep and cache.hasExactObject(obj):
+            return []
+        # The lookups which ceval makes, in the same order
+        found = dict(including=None, pieces=None, tiles=[], equivalent=None)
+        nodes[obj.crs] = (obj, set(), found)
+        if not deep:
+            found["including"] = cache.hasIncludingObject(obj)[0]
+            if not found["including"]:
+                found["pieces"] = cache.hasChunkedObject(obj)
+        if not found["including"]:
+            found["pieces"] = split_gaps(obj, found["pieces"])
+            if not found["pieces"]:
+                found["tiles"] = tiles_of(obj)
+                if not found["tiles"]:
+                    found["equivalent"] = aggregates.assembled(obj)
+        if found["including"] or found["pieces"] or found["tiles"]:
+            children = []
+        elif found["equivalent"] is not None:
+            children = visit(found["equivalent"])
+        else:
+            children = sum([visit(op) for op in obj.operands if op], [])
+        nodes[obj.crs] = (obj, set(children), found)
+        return [obj.crs]
+
+    for obj in objects:
+        visit(obj)
+    return nodes
+
+
+def schedule(objects, deep=None, workers=None):
+    """
+    Evaluates the script calls needed for OBJECTS (see :py:func:`dag`) as files, running at
+    most WORKERS (default : :py:data:`max_workers`) of them at a time, each one as soon as
+    those it depends on are evaluated; their results are cached as by a sequential evaluation.
+    With DEEP True, each one is re-computed. The graph is built once : script calls are
+    evaluated in worker threads (even with one worker), which do not schedule their own
+    operands, and the graph does not go below cached objects
+
+    Returns False if there is no script call to evaluate; otherwise, returns True once all are
+    evaluated, or raises the error of the first failing one once running ones are completed
+    """
+    if workers is None:
+        workers = max_workers
+    nodes = dag(objects, deep)
+    if not nodes:
+        return False
+    workers = max(1, min(workers, len(nodes)))
+    clogger.info("Evaluating %d script calls with %d workers" % (len(nodes), workers))
+    waiting = dict([(crs, children) for crs, (obj, children, found) in nodes.items()])
+    running = set()
+    errors = []
+    condition = threading.Condition()
+
+    # Operands are evaluated beforehand : with DEEP, each script call has to be re-computed, but
+    # not its operands; this is what ceval does with deep=False (its cached result is dropped)
+    recompute = False if deep else None
+
+    def run(crs):
+        obj, children, found = nodes[crs]
+        try:
+            ceval(obj, format='file', deep=recompute, recurse_list=[], found=found)
+        except Exception, e:
+            with condition:
+                errors.append(e)
+        with condition:
+            running.discard(crs)
+            condition.notify()
+
+    pool = ThreadPool(workers)
+    try:
+        with condition:
+            while True:
+                if not errors:
+                    pending = set(waiting) | running
+                    for crs in [crs for crs in nodes if crs in waiting and not waiting[crs] & pending]:
+                        del waiting[crs]
+                        running.add(crs)
+                        pool.apply_async(run, (crs,))
+                if not running:
+                    break
+                condition.wait()
+    finally:
+        pool.close()
+        pool.join()
+    if errors:
+        raise errors[0]
+    return True
+
+
+def ceval_members(ensemble, userflags, format, deep, recurse_list, max_parallel=None):
+    """
+    Evaluates the members of ENSEMBLE concurrently, by at most MAX_PARALLEL workers (default :
+    :py:data:`max_workers`; members are evaluated one after the other in worker threads), and
+    returns a dict of their values by label
+
+    A failing member does not prevent the evaluation of the others (which are then cached);
+    an error listing failing members is raised once all are evaluated
+    """
+    if max_parallel is None:
+        max_parallel = max_workers
+    if not in_main_thread():
+        max_parallel = 1
+
+    def evaluate(member):
+        try:
+            # Members are evaluated as files concurrently, and read afterwards
+            return ceval(ensemble[member], copy.copy(userflags), 'file', deep, recurse_list=list(recurse_list))
+        except Exception, e:
+            return e
+
+    values = dict(zip(ensemble.order, parallel_map(evaluate, ensemble.order, max_parallel)))
+    failed = [member for member in ensemble.order if isinstance(values[member], Exception)]
+    if failed:
+        for member in failed:
+            clogger.error("Evaluation of member %s failed : %s" % (member, values[member]))
+        raise Climaf_Driver_Error("Evaluation failed for members %s of %s" % (", ".join(failed), ensemble.crs))
+    if format != 'file':
+        for member in ensemble.order:
+            values[member] = ceval(ensemble[member], copy.copy(userflags), format, deep=None,
+                                   recurse_list=recurse_list)
+    return values
+
+
 def ceval_script(scriptCall, deep, recurse_list=[]):
     """ Actually applies a CliMAF-declared script on a script_call object
 
@@ -402,9 +923,23 @@ def ceval_script(scriptCall, deep, recurse_list=[]):
     documented in operators.cscript
 
     Returns a CLiMAF cache data filename
+
+    Unless DEEP is True, a script call which failed less than cache.failure_ttl seconds ago
+    is not launched again, and its error is raised (see :py:func:`~climaf.cache.cforget_failures`)
     """
+    if not deep:
+        failure = cache.known_failure(scriptCall.crs)
+        if failure is not None:
+            raise Climaf_Driver_Error("Evaluation of %s already failed : %s. Use deep=True or cforget_failures() "
+                                      "to try again" % (scriptCall.crs, failure))
     script = operators.scripts[scriptCall.operator]
     template = Template(script.command)
+    # Whether a result published by another process may be used (see the computation lock below)
+    reuse = deep is None
+    # Evaluate the script calls needed for input data concurrently, once; they are then cached,
+    # and must not be re-computed below
+    if in_main_thread() and schedule(scriptCall.operands, deep):
+        deep = None
     # Evaluate input data
     invalues = []
     sizes = []
@@ -574,76 +1109,124 @@ def ceval_script(scriptCall, deep, recurse_list=[]):
     #  some_word=${some_keyword}  or  simply : ${some_keyword}
     template = re.sub(r"(\w*=)?\$\{\w*\}", r"", template)
     #
-    # Link the fixed fields needed by the script/operator
-    if script.fixedfields is not None:
-        # subdict_ff=dict()
-        subdict_ff = scriptCall.parameters.copy()
-        subdict_ff["model"] = classes.modelOf(scriptCall.operands[0])
-        subdict_ff["simulation"] = classes.simulationOf(scriptCall.operands[0])
-        subdict_ff["project"] = classes.projectOf(scriptCall.operands[0])
-        subdict_ff["realm"] = classes.realmOf(scriptCall.operands[0])
-        subdict_ff["grid"] = classes.gridOf(scriptCall.operands[0])
-        l = script.fixedfields  # return paths: (linkname, targetname)
-        files_exist = dict()
-        for ll, lt in l:
-            # Replace input data placeholders with filenames for fixed fields
-            template_ff_target = Template(lt).substitute(subdict_ff)
-            # symlink if needed
-            files_exist[ll] = False
-            if os.path.isfile(ll):
-                files_exist[ll] = True
-            else:
-                os.system("ln -s " + template_ff_target + " " + ll)
-    #
-    tim1 = time.time()
-    clogger.info("Launching command:" + template)
-    #
-    logfile = open(logdir + '/last.out', 'w')
-    logfile.write("\n\nstdout and stderr of script call :\n\t " + template + "\n\n")
+    # Only one process computes a given object at a time; others wait for it, and use its result.
+    # Once the lock is held, the result is looked for again, as another process may have published
+    # it since the cache lookup; unless re-computation is required, or we waited for its holder
+    lock = None
+    if script.outputFormat not in operators.none_formats:
+        lock = cache.computation_lock(subdict["out_final"])
+        if not lock.acquire():
+            clogger.warning("Another process is computing %s for too long; computing it too" % scriptCall.crs)
+            lock = None
+        elif lock.waited or reuse:
+            done = cache.published(scriptCall.crs, subdict["out_final"])
+            for output in scriptCall.outputs:
+                done = done and cache.published(scriptCall.crs + "." + output, subdict["out_final_" + output])
+            if done:
+                lock.release()
+                clogger.info("Another process computed %s" % scriptCall.crs)
+                return subdict["out_final"]
+    links = []
+    files_exist = dict()
     try:
-        subprocess.check_call(template, stdout=logfile, stderr=subprocess.STDOUT, shell=True)
-    except subprocess.CalledProcessError, inst:
-        logfile.close()
-        raise Climaf_Driver_Error("Something went wrong - Type 'cerr()' for details")
+        #
+        # Link the fixed fields needed by the script/operator
+        if script.fixedfields is not None:
+            links = fixed_fields_locks([ll for ll, lt in script.fixedfields])
+            for link in links:
+                link.acquire()
+            # subdict_ff=dict()
+            subdict_ff = scriptCall.parameters.copy()
+            subdict_ff["model"] = classes.modelOf(scriptCall.operands[0])
+            subdict_ff["simulation"] = classes.simulationOf(scriptCall.operands[0])
+            subdict_ff["project"] = classes.projectOf(scriptCall.operands[0])
+            subdict_ff["realm"] = classes.realmOf(scriptCall.operands[0])
+            subdict_ff["grid"] = classes.gridOf(scriptCall.operands[0])
+            l = script.fixedfields  # return paths: (linkname, targetname)
+            for ll, lt in l:
+                # Replace input data placeholders with filenames for fixed fields
+                template_ff_target = Template(lt).substitute(subdict_ff)
+                # symlink if needed
+                files_exist[ll] = False
+                if os.path.isfile(ll):
+                    files_exist[ll] = True
+                else:
+                    os.system("ln -s " + template_ff_target + " " + ll)
+        #
+        tim1 = time.time()
+        clogger.info("Launching command:" + template)
+        #
+        logname = script_logfile()
+        logfile = open(logname, 'w')
+        logfile.write("\n\nstdout and stderr of script call :\n\t " + template + "\n\n")
+        try:
+            subprocess.check_call(template, stdout=logfile, stderr=subprocess.STDOUT, shell=True,
+                                  env=script_environment(scriptCall.operator, script))
+        except subprocess.CalledProcessError, inst:
+            logfile.close()
+            with open(logname, 'r') as f:
+                cache.record_failure(scriptCall.crs, "command exited with status %d, ending with : %s" %
+                                     (inst.returncode, " ".join(f.readlines()[-3:]).strip()))
+            if logname != logdir + "/last.out":
+                # Let cerr() display it
+                shutil.move(logname, logdir + "/last.out")
+            raise Climaf_Driver_Error("Something went wrong - Type 'cerr()' for details")
 
-    logfile.close()
-    #
-    # For remote files, we supply ds.local_copies_of_remote_files
-    # for local filenames in order to can use ds.check()
-    if scriptCall.operator == 'remote_select':
-        local_filename = []
-        for el in scriptCall.operands[0].baseFiles().split(" "):
-            local_filename.append(climaf.dataloc.remote_to_local_filename(el))
-        scriptCall.operands[0].local_copies_of_remote_files = ' '.join(local_filename)
-    #
-    # Clean fixed fields symbolic links (linkname, targetname)
-    if script.fixedfields:
-        for ll, lt in script.fixedfields:
+        logfile.close()
+        #
+        # For remote files, we supply ds.local_copies_of_remote_files
+        # for local filenames in order to can use ds.check()
+        if scriptCall.operator == 'remote_select':
+            local_filename = []
+            for el in scriptCall.operands[0].baseFiles().split(" "):
+                local_filename.append(climaf.dataloc.remote_to_local_filename(el))
+            scriptCall.operands[0].local_copies_of_remote_files = ' '.join(local_filename)
+        # Handle ouptuts
+        if script.outputFormat == "txt":
+            with open(logname, 'r') as f:
+                for line in f.readlines():
+                    sys.stdout.write(line)
+        if logname != logdir + "/last.out":
+            os.remove(logname)
+        if script.outputFormat in operators.none_formats:
+            return None
+        duration = time.time() - tim1
+        cache.count_computation(scriptCall.crs, duration)
+        # Tagging output files with their CliMAF Reference Syntax definition
+        # 1 - Un-named main output
+        ok = cache.register(main_output_filename, scriptCall.crs, subdict["out_final"], cost=duration)
+        # 2 - Named outputs
+        for output in scriptCall.outputs:
+            ok = ok and cache.register(subdict["out_" + output], scriptCall.crs + "." + output,
+                                       subdict["out_final_" + output], cost=duration)
+        if ok:
+            inputs = []
+            for invalue in invalues:
+                if not isinstance(invalue, list):
+                    invalue = [invalue]
+                for value in invalue:
+                    inputs.extend(value.split(" "))
+            cache.record_provenance(scriptCall.crs, inputs)
+            for output in scriptCall.outputs:
+                cache.record_provenance(scriptCall.crs + "." + output, inputs)
+            # print(...file=sys.stderr)
+            clogger.info("Done in %.1f s with script computation for "
+                         "%s (command was :%s )" % (duration, repr(scriptCall), template))
+            return subdict["out_final"]  # main_output_filename
+        else:
+            cache.record_failure(scriptCall.crs, "some output missing when executing : %s" % template)
+            raise Climaf_Driver_Error("Some output missing when executing "
+                                      ": %s. \n See %s/last.out" % (template, logdir))
+    finally:
+        #
+        # Clean fixed fields symbolic links (linkname, targetname)
+        for ll in files_exist:
             if not files_exist[ll]:
                 os.system("rm -f " + ll)
-    # Handle ouptuts
-    if script.outputFormat == "txt":
-        with open(logdir + "/last.out", 'r') as f:
-            for line in f.readlines():
-                sys.stdout.write(line)
-    if script.outputFormat in operators.none_formats:
-        return None
-    # Tagging output files with their CliMAF Reference Syntax definition
-    # 1 - Un-named main output
-    ok = cache.register(main_output_filename, scriptCall.crs, subdict["out_final"])
-    # 2 - Named outputs
-    for output in scriptCall.outputs:
-        ok = ok and cache.register(subdict["out_" + output], scriptCall.crs + "." + output,
-                                   subdict["out_final_" + output])
-    if ok:
-        duration = time.time() - tim1
-        # print(...file=sys.stderr)
-        clogger.info("Done in %.1f s with script computation for "
-                     "%s (command was :%s )" % (duration, repr(scriptCall), template))
-        return subdict["out_final"]  # main_output_filename
-    else:
-        raise Climaf_Driver_Error("Some output missing when executing "
-                                  ": %s. \n See %s/last.out" % (template, logdir))
+        for link in reversed(links):
+            link.release()
+        if lock is not None:
+            lock.release()
 
 
 def timePeriod(cobject):
@@ -669,6 +1252,9 @@ def ceval_select(includer, included, userflags, format, deep, derived_list, recu
     """ Extract object INCLUDED from (existing) object INCLUDER,
     taking into account the capability of the user process (USERFLAGS)
     and the required delivering FORMAT(file or object)
+
+    INCLUDER may be larger than INCLUDED for the period, the domain, and/or the variables
+    (see :py:func:`~climaf.cache.hasIncludingObject`)
     """
     if format == 'file':
         if userflags.canSelectTime or userflags.canSelectDomain:
@@ -676,11 +1262,17 @@ def ceval_select(includer, included, userflags, format, deep, derived_list, recu
             # includer.setperiod(included.period)
         incperiod = timePeriod(included)
         clogger.debug("extract sub period %s out of %s" % (repr(incperiod), includer.crs))
-        extract = capply('select', includer, period=repr(incperiod))
+        selection = dict(period=repr(incperiod))
+        if classes.domainOf(includer) != classes.domainOf(included):
+            selection["domain"] = classes.domainOf(included)
+            clogger.debug("extract domain %s" % selection["domain"])
+        if classes.varOf(includer) != classes.varOf(included):
+            selection["var"] = classes.varOf(included)
+            clogger.debug("extract variable %s" % selection["var"])
+        extract = capply('select', includer, **selection)
         objfile = ceval(extract, userflags, 'file', deep, derived_list, recurse_list)
         if objfile:
-            crs = includer.buildcrs(period=incperiod)
-            return cache.rename(objfile, crs)
+            return cache.rename(objfile, included.crs)
         else:
             clogger.critical("Cannot evaluate " + repr(extract))
             exit()
@@ -705,6 +1297,17 @@ def cread(datafile, varname=None, period=None):
             raise Climaf_Driver_Error("")
         if period is not None:
             clog.warning("Cannot yet select on period (%s) using CMa for files %s - TBD" % (period, files))
+        # Data read recently from the same file is served from memory
+        try:
+            st = os.stat(datafile)
+            key = ("array", datafile, varname, st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            key = None
+        rep = cache.memory.get(key)
+        if rep is not None:
+            clogger.debug("data for %s in %s served from memory" % (varname, datafile))
+            cache.count("memory_hits")
+            return rep.copy()
         from anynetcdf import ncf
         fileobj = ncf(datafile)
         # import netCDF4
@@ -719,6 +1322,8 @@ def cread(datafile, varname=None, period=None):
         else:
             rep = numpy.ma.array(data)
         fileobj.close()
+        if key is not None:
+            cache.memory.put(key, rep.copy(), rep.nbytes + numpy.ma.getmaskarray(rep).nbytes)
         return rep
     else:
         clogger.error("cannot yet handle %s" % datafile)
@@ -816,7 +1421,7 @@ def noselect(userflags, ds, format):
 # Commodity functions
 #########################
 
-def cfile(object, target=None, ln=None, hard=None, deep=None):
+def cfile(object, target=None, ln=None, hard=None, deep=None, grow=False, max_parallel=None):
     """
     Provide the filename for a CliMAF object, or copy this file to target. Launch computation if needed.
 
@@ -844,6 +1449,14 @@ def cfile(object, target=None, ln=None, hard=None, deep=None):
 
         - True  : make a deep computation, i.e. do not use any cached value
 
+      grow (logical, optional) : if True, the period of datasets with period '*' is the one
+       currently covered by their data files, and the result cached for a former state of
+       these files is extended in place with the result for the new period (see
+       :py:func:`~climaf.driver.ceval_grow`); useful for monitoring running simulations
+
+      max_parallel (int, optional) : the maximum number of members of an ensemble which are
+       evaluated concurrently (default : driver.max_workers)
+
     Returns:
 
        - if target is provided, returns this filename (or linkname) if computation is
@@ -859,7 +1472,7 @@ def cfile(object, target=None, ln=None, hard=None, deep=None):
     clogger.debug("Starting cfile at: "+start_time.strftime("%Y-%m-%d %H:%M:%S"))
     #
     # -- Evaluate the CliMAF object
-    result = ceval(object, format='file', deep=deep)
+    result = ceval(object, format='file', deep=deep, grow=grow, max_parallel=max_parallel)
     #
     end_time = datetime.now()
     duration = end_time - start_time
@@ -980,6 +1593,52 @@ def cimport(cobject, crs):
         clogger.error("argument is not a Masked Array nor a filename", cobject)
 
 
+def figure_size(figfile):
+    """
+    Returns the size of figure file FIGFILE in pixels, as a pair of strings (width, height);
+    the size of a PNG file is read in its header, and 'xc:None' stands for an empty figure
+    """
+    if figfile == 'xc:None':
+        return "1", "1"
+    try:
+        return tuple(map(str, filemeta.png_size(figfile)))
+    except filemeta.Climaf_Filemeta_Error:
+        output = subprocess.Popen(["identify", figfile], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.read()
+        return tuple(output.split(" ")[2].split("x")[0:2])
+
+
+def composite_page(cobj, placements, out_fig):
+    """
+    Composites the figures of cpage COBJ in-process, using module PIL, into PNG file OUT_FIG
+    (the title is not drawn); PLACEMENTS is a list of (figure file, width, height, x, y), where
+    each figure is resized for fitting in width x height as ImageMagick does
+
+    Returns False if module PIL is not available
+    """
+    try:
+        from PIL import Image, ImageChops
+    except ImportError:
+        clogger.warning("Module PIL is not available : compositing cpage %s with convert" % cobj.crs)
+        return False
+    page = Image.new("RGB", (cobj.page_width, cobj.page_height), "white")
+    for figfile, width, height, x, y in placements:
+        if figfile == 'xc:None':
+            continue
+        fig = Image.open(figfile)
+        ratio = min(float(width) / fig.size[0], float(height) / fig.size[1])
+        fig = fig.convert("RGBA").resize((max(1, int(round(fig.size[0] * ratio))),
+                                          max(1, int(round(fig.size[1] * ratio)))), Image.LANCZOS)
+        page.paste(fig, (int(x), int(y)), fig)
+    if cobj.page_trim:
+        # As 'convert -trim' : remove borders which have the color of the top-left corner
+        background = Image.new(page.mode, page.size, page.getpixel((0, 0)))
+        box = ImageChops.difference(page, background).getbbox()
+        if box:
+            page = page.crop(box)
+    page.save(out_fig, "PNG")
+    return True
+
+
 def cfilePage(cobj, deep, recurse_list=None):
     """
     Builds a page with CliMAF figures, computing associated crs
@@ -993,10 +1652,9 @@ def cfilePage(cobj, deep, recurse_list=None):
     if not isinstance(cobj, classes.cpage):
         raise Climaf_Driver_Error("cobj is not a cpage object")
     clogger.debug("Computing figure array for cpage %s" % cobj.crs)
-    #
-    # page size and creation
-    page_size = "%dx%d" % (cobj.page_width, cobj.page_height)
-    args = ["convert", "-size", page_size, "xc:white"]
+    # Render missing figures concurrently
+    if in_main_thread() and schedule([fig for line in cobj.fig_lines for fig in line if fig], deep):
+        deep = None
     #
     # margins
     x_left_margin = 30.  # Left shift at start and end of line
@@ -1012,7 +1670,8 @@ def cfilePage(cobj, deep, recurse_list=None):
         usable_height = cobj.page_height - ymargin * (len(cobj.heights) - 1.) - y_top_margin - y_bot_margin - cobj.ybox
     usable_width = cobj.page_width - xmargin * (len(cobj.widths) - 1.) - x_left_margin - x_right_margin
     #
-    # page composition
+    # page composition : list of (figure file, width, height, x, y)
+    placements = []
     y = y_top_margin
     for line, rheight in zip(cobj.fig_lines, cobj.heights):
         # Line height in pixels
@@ -1022,22 +1681,15 @@ def cfilePage(cobj, deep, recurse_list=None):
         for fig, rwidth in zip(line, cobj.widths):
             # Figure width in pixels
             width = usable_width * rwidth
-            scaling = "%dx%d+%d+%d" % (width, height, x, y)
             if fig:
                 figfile = ceval(fig, format="file", deep=deep, recurse_list=recurse_list)
             else:
                 figfile = 'xc:None'
             clogger.debug("Compositing figure %s", fig.crs if fig else 'None')
-
-            args.extend([figfile, "-geometry", scaling, "-composite"])
+            placements.append((figfile, width, height, x, y))
 
             # Real size of figure in pixels: [fig_width x fig_height]
-            args_figsize = ["identify", figfile]
-            comm_figsize = subprocess.Popen(args_figsize, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output_figsize = comm_figsize.stdout.read()
-            figsize = output_figsize.split(" ").pop(2)
-            fig_width = figsize.split("x").pop(0)
-            fig_height = figsize.split("x").pop(1)
+            fig_width, fig_height = figure_size(figfile)
             # Scaling and max height
             if float(fig_width) != 1. and float(fig_height) != 1.:
                 if ((float(fig_width) / float(fig_height)) * float(height)) < width:
@@ -1066,23 +1718,32 @@ def cfilePage(cobj, deep, recurse_list=None):
             y += height + ymargin
 
     out_fig = cache.generateUniqueFileName(cobj.buildcrs(), format=cobj.format)
-    if cobj.page_trim:
-        args.append("-trim")
+    title_args = []
     if cobj.title != "":
         splice = "0x%d" % cobj.ybox
         annotate = "+%d+%d" % (cobj.x, cobj.y)
-        args.extend(["-gravity", cobj.gravity, "-background", cobj.background, "-splice", splice, "-font", cobj.font,
-                     "-pointsize", "%d" % cobj.pt, "-annotate", annotate, cobj.title])
-
-    args.append(out_fig)
-    clogger.debug("Compositing figures : %s" % repr(args))
+        title_args = ["-gravity", cobj.gravity, "-background", cobj.background, "-splice", splice,
+                      "-font", cobj.font, "-pointsize", "%d" % cobj.pt, "-annotate", annotate, cobj.title]
 
-    comm = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if comm.wait() != 0:
-        raise Climaf_Driver_Error("Compositing failed : %s" % comm.stderr.read())
+    if page_compositor == "pil" and cobj.format == "png" and composite_page(cobj, placements, out_fig):
+        args = ["convert", out_fig] + title_args + [out_fig] if title_args else None
+    else:
+        args = ["convert", "-size", "%dx%d" % (cobj.page_width, cobj.page_height), "xc:white"]
+        for figfile, width, height, x, y in placements:
+            args.extend([figfile, "-geometry", "%dx%d+%d+%d" % (width, height, x, y), "-composite"])
+        if cobj.page_trim:
+            args.append("-trim")
+        args.extend(title_args + [out_fig])
+
+    if args:
+        clogger.debug("Compositing figures : %s" % repr(args))
+        comm = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if comm.wait() != 0:
+            raise Climaf_Driver_Error("Compositing failed : %s" % comm.stderr.read())
 
     if cache.register(out_fig, cobj.crs):
         clogger.debug("Registering file %s for cpage %s" % (out_fig, cobj.crs))
+        cache.record_provenance(cobj.crs, parents=[fig.crs for line in cobj.fig_lines for fig in line if fig])
         return out_fig
 
 
@@ -1099,6 +1760,9 @@ def cfilePage_pdf(cobj, deep, recurse_list=None):
     if not isinstance(cobj, classes.cpage_pdf):
         raise Climaf_Driver_Error("cobj is not a cpage_pdf object")
     clogger.debug("Computing figure array for cpage %s" % cobj.crs)
+    # Render missing figures concurrently
+    if in_main_thread() and schedule([fig for line in cobj.fig_lines for fig in line if fig], deep):
+        deep = None
     #
     # margins
     xmargin = 30.  # Horizontal shift between figures
@@ -1159,6 +1823,7 @@ def cfilePage_pdf(cobj, deep, recurse_list=None):
 
     if cache.register(out_fig, cobj.crs):
         clogger.debug("Registering file %s for cpage %s" % (out_fig, cobj.crs))
+        cache.record_provenance(cobj.crs, parents=[fig.crs for line in cobj.fig_lines for fig in line if fig])
     return out_fig
 
 
@@ -1189,7 +1854,7 @@ def CFlongname(varname):
     return "TBD_should_improve_function_climaf.driver.CFlongname"
 
 
-def efile(obj, filename, force=False):
+def efile(obj, filename, force=False, max_parallel=None):
     """
     Create a single file for an ensemble of CliMAF objects (launch computation if needed).
 
@@ -1207,6 +1872,11 @@ def efile(obj, filename, force=False):
         force (logical, optional) : if True, CliMAF will override the file
          'filename' if it already exists
 
+        max_parallel (int, optional) : the maximum number of members which are
+         evaluated concurrently (default : driver.max_workers)
+
+    Members are evaluated concurrently, and the file is then written in a single pass
+    (using CDO operator merge)
     """
     if isinstance(obj, classes.cens):
 
@@ -1217,20 +1887,12 @@ def efile(obj, filename, force=False):
             else:
                 raise Climaf_Driver_Error("File '%s' already exists: use 'force=True' to override it" % filename)
 
-        for lab in obj.order:
-            memb = obj[lab]
-            ffile = cfile(memb)
-
-            f = tempfile.NamedTemporaryFile(suffix=".nc")
-            command = "ncrename -O -v %s,%s_%s %s %s" % (classes.varOf(memb), classes.varOf(memb), lab, ffile, f.name)
-            if os.system(command) != 0:
-                raise Climaf_Driver_Error("ncrename failed : %s" % command)
-
-            command2 = "ncks -A %s %s" % (f.name, filename)
-            if os.system(command2) != 0:
-                raise Climaf_Driver_Error(
-                    "Issue when merging %s and %s (using command: %s)" % (f.name, filename, command2))
-            f.close()
+        files = ceval_members(obj, operators.scriptFlags(), 'file', None, [], max_parallel)
+        inputs = ["-chname,%s,%s_%s %s" % (classes.varOf(obj[lab]), classes.varOf(obj[lab]), lab, files[lab])
+                  for lab in obj.order]
+        command = "cdo -O merge %s %s" % (" ".join(inputs), filename)
+        if os.system(command) != 0:
+            raise Climaf_Driver_Error("Issue when merging members in %s (using command: %s)" % (filename, command))
 
     else:
         clogger.warning("objet is not a 'cens' objet")
@@ -0,0 +1,462 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+
+Writing and reading the CliMAF stamp of cache files, i.e. their metadata 'CRS_def'
+(the CRS expression of the object) and 'CliMAF' (CliMAF version and reference URL)
+
+This is done within the CliMAF process, touching only the files' headers or metadata :
+
+- NetCDF : global attributes; classic formats headers are read directly, while
+  writing (and reading NetCDF4/HDF5 files) uses module netCDF4
+- PNG : ``tEXt`` chunks, inserted before chunk ``IEND``
+- PDF : an Info dictionary, appended as an incremental update (for both cross-reference
+  tables and cross-reference streams); the CRS is also stored as ``Keywords``
+
+External tools (ncatted/ncdump, convert/identify, pdftk/pdfinfo, exiv2) are used as a
+fallback, and for EPS files
+
+"""
+
+import os
+import re
+import zlib
+import struct
+import subprocess
+from distutils.spawn import find_executable
+
+from climaf import version
+from clogging import clogger
+
+#: The value of metadata 'CliMAF' in cache files
+climaf_stamp = "CLImate Model Assessment Framework version %s (http://climaf.rtfd.org)" % version
+
+
+class Climaf_Filemeta_Error(Exception):
+    def __init__(self, valeur):
+        self.valeur = valeur
+        clogger.debug(self.__str__())
+
+    def __str__(self):
+        return repr(self.valeur)
+
+
+def file_format(filename):
+    """
+    Returns the format of FILENAME, based on its extension ('nc', 'png', 'pdf', 'eps'), or None
+    """
+    ext = os.path.splitext(filename)[1][1:]
+    if ext in writers:
+        return ext
+
+
+def write_crs(filename, crs):
+    """
+    Stamps FILENAME with metadata 'CRS_def' = CRS and 'CliMAF' = CliMAF version
+
+    Returns True on success
+    """
+    form = file_format(filename)
+    if form is None:
+        clogger.error("unknown filetype for %s" % filename)
+        return False
+    try:
+        writers[form](filename, crs)
+        return True
+    except Exception, e:
+        clogger.debug("Cannot stamp %s in-process (%s), using external tools" % (filename, e))
+    command = external_writers[form](filename, crs)
+    clogger.debug("trying stamping by %s" % command)
+    if os.system(command) == 0:
+        return True
+    clogger.error("cannot stamp by %s" % command)
+    return False
+
+
+def read_crs(filename):
+    """
+    Returns the CRS expression found in FILENAME's metadata, '' if there is none,
+    and None if FILENAME's type is unknown or if its CRS cannot be read
+
+    Metadata is read in-process; external tools are used when this fails, or finds no
+    CRS (e.g. for a legacy stamp in a format which is not read in-process), so that ''
+    means that both find none
+    """
+    form = file_format(filename)
+    if form is None:
+        clogger.error("unknown filetype for %s" % filename)
+        return None
+    try:
+        rep = readers[form](filename)
+        if rep:
+            return rep
+        clogger.debug("No CRS read in-process in %s, using external tools" % filename)
+    except Exception, e:
+        clogger.debug("Cannot read CRS of %s in-process (%s), using external tools" % (filename, e))
+    return read_crs_external(filename, form)
+
+
+# NetCDF
+
+nc_type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+
+
+def netcdf_global_attributes(filename):
+    """
+    Returns the dict of character global attributes of classic format
+    (CDF-1, CDF-2 or CDF-5) NetCDF file FILENAME, reading only its header
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+        if magic[0:3] != "CDF" or magic[3] not in "\x01\x02\x05":
+            raise Climaf_Filemeta_Error("%s is not a classic NetCDF file" % filename)
+        if magic[3] == "\x05":
+            nonneg_fmt, nonneg_size = ">Q", 8
+        else:
+            nonneg_fmt, nonneg_size = ">I", 4
+
+        def nonneg():
+            return struct.unpack(nonneg_fmt, f.read(nonneg_size))[0]
+
+        def padded(n):
+            value = f.read(n)
+            f.read(-n % 4)
+            return value
+
+        nonneg()  # number of records
+        # Dimensions list
+        tag = struct.unpack(">I", f.read(4))[0]
+        for i in range(nonneg()):
+            padded(nonneg())
+            nonneg()
+        # Global attributes list
+        attributes = dict()
+        tag = struct.unpack(">I", f.read(4))[0]
+        nattr = nonneg()
+        if tag != 0x0C and nattr > 0:
+            raise Climaf_Filemeta_Error("Malformed NetCDF header in %s" % filename)
+        for i in range(nattr):
+            name = padded(nonneg())
+            nc_type = struct.unpack(">I", f.read(4))[0]
+            values = padded(nonneg() * nc_type_sizes[nc_type])
+            if nc_type == 2:
+                attributes[name] = values.rstrip("\x00")
+        return attributes
+
+
+def read_crs_netcdf(filename):
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+    if magic.startswith("CDF"):
+        return netcdf_global_attributes(filename).get("CRS_def", "")
+    from netCDF4 import Dataset
+    fileobj = Dataset(filename, "r")
+    try:
+        if "CRS_def" in fileobj.ncattrs():
+            return str(fileobj.getncattr("CRS_def"))
+        return ""
+    finally:
+        fileobj.close()
+
+
+def write_crs_netcdf(filename, crs):
+    from netCDF4 import Dataset
+    fileobj = Dataset(filename, "a")
+    try:
+        fileobj.setncattr("CRS_def", crs)
+        fileobj.setncattr("CliMAF", climaf_stamp)
+    finally:
+        fileobj.close()
+
+
+# PNG
+
+png_signature = "\x89PNG\r\n\x1a\n"
+
+
+def png_chunks(f):
+    """
+    Yields (offset, type, data) for the chunks of PNG file object F; data is
+    read only for textual chunks
+    """
+    if f.read(8) != png_signature:
+        raise Climaf_Filemeta_Error("Not a PNG file")
+    while True:
+        offset = f.tell()
+        header = f.read(8)
+        if len(header) < 8:
+            raise Climaf_Filemeta_Error("Truncated PNG file")
+        length, ctype = struct.unpack(">I4s", header)
+        if ctype in ["tEXt", "zTXt", "iTXt"]:
+            data = f.read(length)
+            f.seek(4, 1)
+        else:
+            data = None
+            f.seek(length + 4, 1)
+        yield offset, ctype, data
+        if ctype == "IEND":
+            return
+
+
+def png_size(filename):
+    """
+    Returns the (width, height) of PNG file FILENAME in pixels, as read in its IHDR chunk
+    """
+    with open(filename, "rb") as f:
+        header = f.read(24)
+    if len(header) < 24 or header[:8] != png_signature or header[12:16] != "IHDR":
+        raise Climaf_Filemeta_Error("Not a PNG file : %s" % filename)
+    return struct.unpack(">II", header[16:24])
+
+
+def png_text(ctype, data):
+    """
+    Returns the keyword and text of a PNG textual chunk
+    """
+    keyword, text = data.split("\x00", 1)
+    if ctype == "zTXt":
+        text = zlib.decompress(text[1:])
+    elif ctype == "iTXt":
+        compressed = text[0] == "\x01"
+        text = text[2:].split("\x00", 2)[2]
+        if compressed:
+            text = zlib.decompress(text)
+    return keyword, text
+
+
+def png_chunk(ctype, data):
+    return struct.pack(">I", len(data)) + ctype + data + \
+        struct.pack(">I", zlib.crc32(ctype + data) & 0xffffffff)
+
+
+def read_crs_png(filename):
+    crs = ""
+    with open(filename, "rb") as f:
+        for offset, ctype, data in png_chunks(f):
+            if data is not None:
+                keyword, text = png_text(ctype, data)
+                if keyword == "CRS_def":
+                    crs = text
+    return crs
+
+
+def write_crs_png(filename, crs):
+    stamp = png_chunk("tEXt", "CRS_def\x00" + crs) + png_chunk("tEXt", "CliMAF\x00" + climaf_stamp)
+    stale = []
+    with open(filename, "r+b") as f:
+        for offset, ctype, data in png_chunks(f):
+            if data is not None and png_text(ctype, data)[0] in ["CRS_def", "CliMAF"]:
+                stale.append(offset)
+            iend = offset
+        if not stale:
+            # Usual case : just insert the stamp before IEND
+            f.seek(iend)
+            f.write(stamp + png_chunk("IEND", ""))
+            f.truncate()
+            return
+    # The file was already stamped : rewrite it without former stamp chunks
+    with open(filename, "rb") as f:
+        content = f.read()
+    chunks = []
+    start = len(png_signature)
+    while start < iend:
+        length = struct.unpack(">I", content[start:start + 4])[0]
+        if start not in stale:
+            chunks.append(content[start:start + length + 12])
+        start += length + 12
+    tmpfile = filename + ".stamp"
+    with open(tmpfile, "wb") as f:
+        f.write(png_signature + "".join(chunks) + stamp + png_chunk("IEND", ""))
+    os.rename(tmpfile, filename)
+
+
+# PDF
+
+def pdf_string(text):
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+pdf_escapes = {"n": "\n", "r": "\r", "t": "\t", "b": "\b", "f": "\f"}
+
+
+def pdf_unstring(content, start):
+    """
+    Returns the value of the PDF literal string beginning at CONTENT[START] (an opening
+    parenthesis), and the index of its closing parenthesis
+    """
+    value = []
+    depth = 0
+    i = start
+    while i < len(content):
+        c = content[i]
+        if c == "\\":
+            i += 1
+            c = content[i]
+            if c in pdf_escapes:
+                value.append(pdf_escapes[c])
+            elif c in "01234567":
+                octal = re.match("[0-7]{1,3}", content[i:i + 3]).group(0)
+                value.append(chr(int(octal, 8) & 0xff))
+                i += len(octal) - 1
+            elif c == "\r":
+                if content[i + 1:i + 2] == "\n":
+                    i += 1
+            elif c != "\n":
+                value.append(c)
+        elif c == "(":
+            if depth > 0:
+                value.append(c)
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return "".join(value), i
+            value.append(c)
+        else:
+            value.append(c)
+        i += 1
+    raise Climaf_Filemeta_Error("Unterminated PDF string")
+
+
+def pdf_trailer(content):
+    """
+    Returns the text of the last trailer dictionary of PDF file content CONTENT (or of
+    its last cross-reference stream dictionary), whether it is a cross-reference stream,
+    and the offset of the last cross-reference section
+    """
+    match = None
+    for match in re.finditer(r"startxref\s+(\d+)", content[-1024:]):
+        pass
+    if match is None:
+        raise Climaf_Filemeta_Error("No startxref in PDF file")
+    xref = int(match.group(1))
+    section = content[xref:xref + 65536]
+    if section.startswith("xref"):
+        trailer = re.search(r"trailer\s*<<(.*?)>>\s*startxref", content[xref:], re.S)
+        if trailer is None:
+            raise Climaf_Filemeta_Error("No trailer in PDF file")
+        return trailer.group(1), False, xref
+    stream = re.match(r"\d+\s+\d+\s+obj\s*<<(.*?)>>\s*stream", section, re.S)
+    if stream is None or "/XRef" not in stream.group(1):
+        raise Climaf_Filemeta_Error("Cannot find cross-reference section in PDF file")
+    return stream.group(1), True, xref
+
+
+def pdf_info_keys(info):
+    """
+    Returns the text of PDF Info dictionary content INFO, without the keys written by CliMAF
+    """
+    for key in ["CRS_def", "CliMAF", "Keywords"]:
+        match = re.search(r"/%s\s*(\(|<)" % key, info)
+        if match:
+            if match.group(1) == "(":
+                end = pdf_unstring(info, match.end() - 1)[1]
+            else:
+                end = info.index(">", match.end())
+            info = info[:match.start()] + info[end + 1:]
+    return info.strip()
+
+
+def write_crs_pdf(filename, crs):
+    with open(filename, "rb") as f:
+        content = f.read()
+    trailer, is_stream, prev = pdf_trailer(content)
+    if "/Encrypt" in trailer:
+        raise Climaf_Filemeta_Error("PDF file is encrypted")
+    size = int(re.search(r"/Size\s+(\d+)", trailer).group(1))
+    root = re.search(r"/Root\s+(\d+\s+\d+\s+R)", trailer).group(1)
+    fileid = re.search(r"/ID\s*\[[^\]]*\]", trailer)
+    fileid = " " + fileid.group(0) if fileid else ""
+    # Keep the entries of the former Info dictionary, if it can be found
+    former = ""
+    info = re.search(r"/Info\s+(\d+)\s+(\d+)\s+R", trailer)
+    if info:
+        match = None
+        for match in re.finditer(r"(?<!\d)%s\s+%s\s+obj\s*<<(.*?)>>\s*endobj" % info.groups(), content, re.S):
+            pass
+        if match:
+            former = pdf_info_keys(match.group(1)) + " "
+    info_num = size
+    update = "\n"
+    info_offset = len(content) + len(update)
+    update += "%d 0 obj\n<< %s/CRS_def %s /CliMAF %s /Keywords %s >>\nendobj\n" % \
+              (info_num, former, pdf_string(crs), pdf_string(climaf_stamp), pdf_string(crs))
+    xref_offset = len(content) + len(update)
+    if not is_stream:
+        update += "xref\n0 1\n0000000000 65535 f \n%d 1\n%010d 00000 n \n" \
+                  "trailer\n<< /Size %d /Root %s /Info %d 0 R /Prev %d%s >>\n" % \
+                  (info_num, info_offset, size + 1, root, info_num, prev, fileid)
+    else:
+        xref_num = size + 1
+        data = struct.pack(">BIHBIH", 1, info_offset, 0, 1, xref_offset, 0)
+        update += "%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 2] /Index [%d 2] /Root %s /Info %d 0 R " \
+                  "/Prev %d%s /Length %d >>\nstream\n%s\nendstream\nendobj\n" % \
+                  (xref_num, size + 2, info_num, root, info_num, prev, fileid, len(data), data)
+    update += "startxref\n%d\n%%%%EOF\n" % xref_offset
+    with open(filename, "ab") as f:
+        f.write(update)
+
+
+def read_crs_pdf(filename):
+    with open(filename, "rb") as f:
+        content = f.read()
+    for key in ["CRS_def", "Keywords"]:
+        match = None
+        for match in re.finditer(r"/%s\s*\(" % key, content):
+            pass
+        if match:
+            return pdf_unstring(content, match.end() - 1)[0]
+    return ""
+
+
+# Fallbacks on external tools
+
+def write_crs_eps(filename, crs):
+    raise Climaf_Filemeta_Error("No in-process stamping for EPS files")
+
+
+def read_crs_eps(filename):
+    raise Climaf_Filemeta_Error("No in-process reading for EPS files")
+
+
+external_writers = dict(
+    nc=lambda filename, crs: "ncatted -h -a CRS_def,global,o,c,\"%s\" -a CliMAF,global,o,c,\"%s\" %s" %
+                             (crs, climaf_stamp, filename),
+    png=lambda filename, crs: "convert -set \"CRS_def\" \"%s\" -set \"CliMAF\" \"%s\" %s %s.png && mv -f %s.png %s" %
+                              (crs.replace("%", "\%"), climaf_stamp, filename, filename, filename, filename),
+    pdf=lambda filename, crs: "tmpfile=$(mktemp) && pdftk %s dump_data output $tmpfile && echo -e \"InfoBegin\n"
+                              "InfoKey: Keywords\nInfoValue: %s\" >> $tmpfile && pdftk %s update_info $tmpfile "
+                              "output %s.pdf && mv -f %s.pdf %s && rm -f $tmpfile" %
+                              (filename, crs, filename, filename, filename, filename),
+    eps=lambda filename, crs: "exiv2 -M\"add Xmp.dc.CliMAF %s\" -M\"add Xmp.dc.CRS_def %s\" %s" %
+                              (climaf_stamp, crs, filename),
+)
+
+external_readers = dict(
+    nc='ncdump -h %s | grep -E "CRS_def *=" | sed -r -e "s/.*:CRS_def *= *\\\"(.*)\\\" *;$/\\1/" ',
+    png='identify -verbose %s | grep -E " *CRS_def: " | sed -r -e "s/.*CRS_def: *//"',
+    pdf='pdfinfo %s | grep "Keywords" | awk -F ":" \'{print $2}\' | sed "s/^ *//g"',
+    eps='exiv2 -p x %s | grep "CRS_def" | awk \'{for (i=4;i<=NF;i++) {print $i " "} }\' ',
+)
+
+
+def read_crs_external(filename, form):
+    """
+    Returns the CRS expression found in FILENAME's metadata by external tools, '' if
+    there is none, and None if the tools are not available or fail
+    """
+    command = external_readers[form] % filename
+    if find_executable(command.split()[0]) is None:
+        clogger.debug("Cannot read CRS of %s : %s is not available" % (filename, command.split()[0]))
+        return None
+    try:
+        rep = subprocess.check_output(command, shell=True).replace('\n', '')
+        if form == "nc":
+            rep = rep.replace(r"\'", r"'")
+    except:
+        rep = None
+    return rep
+
+
+writers = dict(nc=write_crs_netcdf, png=write_crs_png, pdf=write_crs_pdf, eps=write_crs_eps)
+readers = dict(nc=read_crs_netcdf, png=read_crs_png, pdf=read_crs_pdf, eps=read_crs_eps)
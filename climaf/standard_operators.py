@@ -108,6 +108,16 @@ def load_standard_operators():
             sdev_var="std(%s)",
             commuteWithTimeConcatenation=True)
     #
+    # Partial sums for a period, which allow to compute time means and standard deviations
+    # over longer periods (see module climaf.aggregates)
+    cscript('time_partials',
+            scriptpath + 'time_partials.sh ${cycle} "${out}" "${out_sqdev}" "${out_count}" "${var}" "${period_iso}" '
+                         '"${domain}" "${alias}" "${units}" "${missing}" ${ins}',
+            sqdev_var="%s", count_var="%s",
+            commuteWithSpaceConcatenation=True)
+    cscript('combine_partials', scriptpath + 'combine_partials.sh ${stat} ${cycle} "${out}" ${mmin}',
+            commuteWithSpaceConcatenation=True)
+    #
     # Declare plot scripts
     cscript('ncview', 'ncview ${in} 1>/dev/null 2>&1&')
     #
@@ -0,0 +1,42 @@
+#!/bin/bash
+# Combines the partial aggregates of successive periods, as computed by time_partials.sh for
+# CYCLE (tim or ymon), into their mean or standard deviation (STAT = mean or std) over the
+# whole period, written in OUT with the time axis of the whole period; FILES are, for each
+# period in time order, the sum, the sum of squared deviations and the count files
+#
+# The squared deviations of the periods are combined in a numerically stable way (Chan et al.),
+# the deviations of all periods from the mean being summed in one chained CDO call :
+#   M2 = sum(M2_p) + sum((S_p - N_p * mean)**2 / N_p)
+# Standard deviations are normalized by N, as by CDO
+set -ex
+stat=$1 ; shift
+cycle=$1 ; shift
+out=$1 ; shift
+
+sums="" ; sqdevs="" ; counts="" ; deviations=""
+while [ $# -gt 0 ] ; do
+    sums="$sums $1" ; sqdevs="$sqdevs $2" ; counts="$counts $3"
+    deviations="$deviations -div -sqr -sub $1 -mul $3 MEAN $3"
+    shift 3
+done
+
+tmp=$(mktemp -d -t climaf_partials_XXXXXX) # Will use TMPDIR if set, else /tmp
+[ $? -ne 0 ] && tmp=$(mktemp -d  climaf_partials_XXXXXX)
+
+CDO="cdo -O -b F64"
+$CDO enssum $counts $tmp/count.nc
+$CDO enssum $sums $tmp/sum.nc
+$CDO div $tmp/sum.nc $tmp/count.nc $tmp/mean.nc
+if [ $stat = std ] ; then
+    $CDO enssum $sqdevs $tmp/within.nc
+    $CDO enssum ${deviations//MEAN/$tmp/mean.nc} $tmp/between.nc
+    $CDO sqrt -div -add $tmp/within.nc $tmp/between.nc $tmp/count.nc $tmp/result.nc
+else
+    mv $tmp/mean.nc $tmp/result.nc
+fi
+# Ensemble operators keep the time axis of the first period : the time axis (and bounds) of the
+# whole period is the one of a time mean of the counts of all periods, which is added as zeros
+$CDO ${cycle}mean -mulc,0 -mergetime $counts $tmp/axis.nc
+cdo -O $CLIMAF_CDO_OPTIONS add $tmp/axis.nc $tmp/result.nc $out
+
+rm -fr $tmp
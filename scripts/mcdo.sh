@@ -30,8 +30,10 @@ aux=$0 ; aux=${aux/.sh/_aux.sh}
 . $aux
 
 # For the time being, at most sites, must use NetCDF3 file format chained CDO
-# operations because NetCDF4 is not threadsafe there
-if [[ $(uname -n ) == ciclad* ]] ; then CDO="cdo -O " ; else CDO="cdo -O -f nc" ; fi
+# operations because NetCDF4 is not threadsafe there, unless CliMAF asks for
+# compressed outputs through CLIMAF_CDO_OPTIONS (e.g. "-f nc4 -z zip_4")
+if [ "$CLIMAF_CDO_OPTIONS" ] ; then CDO="cdo -O $CLIMAF_CDO_OPTIONS"
+elif [[ $(uname -n ) == ciclad* ]] ; then CDO="cdo -O " ; else CDO="cdo -O -f nc" ; fi
 
 # Prepare CDO operator strings
 
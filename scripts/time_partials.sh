@@ -0,0 +1,34 @@
+#!/bin/bash
+# Computes partial aggregates of a field over the time steps of FILES, after selecting
+# variable VAR, PERIOD and REGION as mcdo.sh does : the sum, the sum of squared deviations
+# from the mean (computed in two passes) and the number of valid values, either over all
+# time steps (CYCLE=tim) or for each calendar month (CYCLE=ymon); outputs are OUT,
+# OUT_SQDEV and OUT_COUNT, in double precision
+#
+# Partial aggregates for successive periods can be summed, for computing means and
+# standard deviations over the whole period (see module climaf.aggregates)
+set -ex
+cycle=$1 ; shift
+out=$1 ; shift
+out_sqdev=$1 ; shift
+out_count=$1 ; shift
+var=$1 ; shift
+period=$1 ; shift
+region=$1 ; shift
+alias=$1 ; shift
+units="$1" ; shift
+vm=$1 ; shift
+
+tmp=$(mktemp -d -t climaf_partials_XXXXXX) # Will use TMPDIR if set, else /tmp
+[ $? -ne 0 ] && tmp=$(mktemp -d  climaf_partials_XXXXXX)
+
+# Data files are read once, for extracting the relevant data (not compressed)
+CLIMAF_CDO_OPTIONS= $(dirname $0)/mcdo.sh "" $tmp/extract.nc "$var" "$period" "$region" "$alias" "$units" "$vm" $*
+
+CDO="cdo -O -b F64 $CLIMAF_CDO_OPTIONS"
+$CDO ${cycle}sum $tmp/extract.nc $out
+if [ $cycle = ymon ] ; then sub=ymonsub ; else sub=sub ; fi
+$CDO ${cycle}sum -sqr -$sub $tmp/extract.nc -${cycle}mean $tmp/extract.nc $out_sqdev
+$CDO ${cycle}sum -addc,1 -mulc,0 $tmp/extract.nc $out_count
+
+rm -fr $tmp
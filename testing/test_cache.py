@@ -0,0 +1,1372 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests for CliMAF cache machinery which do not need external binaries nor data
+
+Call it as : python -m unittest -b -v test_cache
+
+"""
+
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import pickle
+import struct
+import zlib
+import json
+import threading
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from climaf import cache, operators, aggregates, driver, clogging
+from climaf.classes import cproject, ds, ctree, cens, cdataset, cpage
+from climaf.cache_index import open_index
+from climaf.dataloc import dataloc
+from climaf.period import init_period
+from climaf.filemeta import write_crs, read_crs, read_crs_pdf, png_chunk, png_signature, png_size
+
+
+def setUpModule():
+    # Log files (see clogging.clog_file), and those of script calls, are written in a temporary directory
+    global logdir, script_logdir
+    logdir, clogging.logdir = clogging.logdir, tempfile.mkdtemp(prefix="climaf_test_log_")
+    script_logdir, driver.logdir = driver.logdir, clogging.logdir
+
+
+def tearDownModule():
+    for handler in [h for h in clogging.clogger.handlers if isinstance(h, clogging.logging.FileHandler)]:
+        handler.close()
+        clogging.clogger.removeHandler(handler)
+    shutil.rmtree(clogging.logdir)
+    clogging.logdir, driver.logdir = logdir, script_logdir
+
+
+# Test cases are grouped by feature, in the order they were added; classes named in lower case
+# only hold the fixtures shared by several test cases
+class index_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="climaf_test_cache_")
+        self.file = os.path.join(self.dir, "a.nc")
+        with open(self.file, "w") as f:
+            f.write("1234")
+
+    def check_backend(self, backend):
+        index = open_index(self.dir, backend)
+        index["select(ds('a|b'))"] = self.file
+        self.assertEqual(index["select(ds('a|b'))"], self.file)
+        self.assertTrue("select(ds('a|b'))" in index)
+        self.assertEqual(index.crs_of(self.file), ["select(ds('a|b'))"])
+        self.assertEqual(index.entry("select(ds('a|b'))")["size"], 4)
+        # The creation date of an entry is the modification time of its file, for all backends
+        self.assertEqual(index.entry("select(ds('a|b'))")["created"], os.path.getmtime(self.file))
+        index.sync()
+        index.close()
+        # A new session sees the entry
+        index = open_index(self.dir, backend)
+        index.load()
+        self.assertEqual(index.copy(), {"select(ds('a|b'))": self.file})
+        index.pop("select(ds('a|b'))")
+        index.sync()
+        self.assertEqual(len(index), 0)
+        index.close()
+
+    def check_shapes(self, backend):
+        index = open_index(self.dir, backend)
+        index.record("a1", self.file, signature="s", pstart="198001010000", pend="199001010000")
+        index.record("a2", self.file, signature="s", pstart="197001010000", pend="201001010000")
+        index.record("b", self.file, signature="t", pstart="198001010000", pend="199001010000")
+        index["c"] = self.file
+        self.assertEqual(index.shapes("s"), [("197001010000", "201001010000", "a2"),
+                                             ("198001010000", "199001010000", "a1")])
+        self.assertEqual(index.unshaped(), ["c"])
+        index.set_shapes([("c", "t", "200001010000", "200101010000")])
+        self.assertEqual(index.unshaped(), [])
+        self.assertEqual(len(index.shapes("t")), 2)
+        index.pop("b")
+        self.assertEqual(index.shapes("t"), [("200001010000", "200101010000", "c")])
+        index.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+class A_index_backends(index_test):
+    def test_1_pickle(self):
+        self.check_backend("pickle")
+
+    def test_2_sqlite(self):
+        self.check_backend("sqlite")
+
+    def test_3_sqlite_concurrent_sessions(self):
+        first = open_index(self.dir, "sqlite")
+        second = open_index(self.dir, "sqlite")
+        first["crs1"] = self.file
+        second["crs2"] = self.file
+        self.assertEqual(sorted(first.keys()), ["crs1", "crs2"])
+        del second["crs1"]
+        self.assertFalse("crs1" in first)
+        first.close()
+        second.close()
+
+    def test_4_sqlite_imports_pickle_index(self):
+        with open(os.path.join(self.dir, "index"), "w") as f:
+            pickle.dump({"legacy": self.file}, f)
+        index = open_index(self.dir, "sqlite")
+        index.load()
+        self.assertEqual(index.get("legacy"), self.file)
+        index.close()
+
+
+class B_index_shapes(index_test):
+    def test_1_pickle_shapes(self):
+        self.check_shapes("pickle")
+
+    def test_2_sqlite_shapes(self):
+        self.check_shapes("sqlite")
+
+
+class C_stamping(unittest.TestCase):
+    crs = "llbox(ds(project='CMIP5',period='1980'),latmin=(10),title='a\\\\b')"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="climaf_test_stamp_")
+        # Stubs for the external readers of CRS, which find none
+        self.path = os.environ["PATH"]
+        os.mkdir(os.path.join(self.dir, "tools"))
+        os.environ["PATH"] = os.path.join(self.dir, "tools") + ":" + self.path
+        for tool in ["identify", "pdfinfo"]:
+            self.stub(tool, "")
+
+    def stub(self, tool, output):
+        with open(os.path.join(self.dir, "tools", tool), "w") as f:
+            f.write("#!/bin/sh\necho \"%s\"\n" % output)
+        os.chmod(os.path.join(self.dir, "tools", tool), 0755)
+
+    def pdf(self, filename, info):
+        content = "%PDF-1.4\n"
+        offsets = []
+        for obj in ["<< /Type /Catalog /Pages 2 0 R >>", "<< /Type /Pages /Kids [] /Count 0 >>", info]:
+            offsets.append(len(content))
+            content += "%d 0 obj\n%s\nendobj\n" % (len(offsets), obj)
+        xref = len(content)
+        content += "xref\n0 4\n0000000000 65535 f \n" + "".join(["%010d 00000 n \n" % o for o in offsets])
+        content += "trailer\n<< /Size 4 /Root 1 0 R /Info 3 0 R >>\nstartxref\n%d\n%%%%EOF\n" % xref
+        with open(filename, "wb") as f:
+            f.write(content)
+
+    def check_stamp(self, filename):
+        self.assertEqual(read_crs(filename), "")
+        self.assertTrue(write_crs(filename, self.crs))
+        self.assertEqual(read_crs(filename), self.crs)
+        # Stamping again replaces the stamp
+        self.assertTrue(write_crs(filename, "ds('a|b')"))
+        self.assertEqual(read_crs(filename), "ds('a|b')")
+
+    def test_1_png(self):
+        filename = os.path.join(self.dir, "a.png")
+        with open(filename, "wb") as f:
+            f.write(png_signature + png_chunk("IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0)) +
+                    png_chunk("IDAT", zlib.compress("\x00\x00")) + png_chunk("IEND", ""))
+        self.check_stamp(filename)
+
+    def test_2_pdf(self):
+        filename = os.path.join(self.dir, "a.pdf")
+        self.pdf(filename, "<< /Producer (test) >>")
+        self.check_stamp(filename)
+        with open(filename, "rb") as f:
+            self.assertTrue("/Producer (test)" in f.read()[-1024:])
+
+    def test_3_legacy_pdf(self):
+        # A CRS stamped by pdftk as an hexadecimal string is read by pdfinfo
+        filename = os.path.join(self.dir, "a.pdf")
+        self.pdf(filename, "<< /Keywords <FEFF00640073002800270061007C006200270029> >>")
+        self.assertEqual(read_crs_pdf(filename), "")
+        self.stub("pdfinfo", "Keywords:       ds('a|b')")
+        self.assertEqual(read_crs(filename), "ds('a|b')")
+        # Without external tools, the CRS is unknown
+        os.environ["PATH"] = os.path.join(self.dir, "none")
+        self.assertEqual(read_crs(filename), None)
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.dir)
+
+
+class cache_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="climaf_test_evict_")
+        cache.stamping = False
+        cache.setNewUniqueCache(self.dir, raz=False)
+
+    def cache_file(self, crs, size, cost):
+        filename = os.path.join(self.dir, crs[-4] + ".nc")
+        with open(filename, "w") as f:
+            f.write("x" * size)
+        cache.register(filename, crs, cost=cost)
+        return filename
+
+    def tearDown(self):
+        cache.set_size_limits(0, {})
+        cache.stamping = True
+        cache.crs2filename.close()
+        shutil.rmtree(self.dir)
+
+
+class D_eviction(cache_test):
+    def test_1_cost_aware_eviction(self):
+        big = self.cache_file("select(ds('CMIP6|a'))", 1000, 1.)
+        small = self.cache_file("diag(ds('CMIP6|b'))", 100, 100.)
+        protected = self.cache_file("select(ds('EM|c'))", 1000, 1.)
+        os.chmod(protected, 0444)
+        self.assertEqual(cache.cevict(size=1500), 1000)
+        self.assertFalse(os.path.exists(big))
+        self.assertTrue(os.path.exists(small) and os.path.exists(protected))
+        self.assertEqual(sorted(cache.crs2filename.keys()), ["diag(ds('CMIP6|b'))", "select(ds('EM|c'))"])
+
+    def test_2_quotas(self):
+        cache.set_size_limits(0, "CMIP6:500,EM:10k")
+        self.cache_file("select(ds('EM|c'))", 1000, 1.)
+        self.cache_file("diag(ds('CMIP6|b'))", 100, 100.)
+        self.cache_file("select(ds('CMIP6|a'))", 1000, 1.)
+        # The object just computed is kept, even if it exceeds the quota
+        self.assertEqual(len(cache.crs2filename), 2)
+        self.assertFalse("diag(ds('CMIP6|b'))" in cache.crs2filename)
+
+
+class E_stats(cache_test):
+    def test_1_stats(self):
+        cache.reset_stats()
+        self.cache_file("select(ds('CMIP6|a'))", 1000, 1.)
+        cache.count_hit("exact", cache.crs2filename["select(ds('CMIP6|a'))"])
+        cache.count("misses")
+        cache.count_computation("diag(ds('CMIP6|b'))", 3.)
+        cache.count_computation("select(ds('CMIP6|a'))", 1.)
+        dump = os.path.join(self.dir, "stats.json")
+        stats = cache.cstats(top=1, dump=dump, reset=True)
+        self.assertEqual((stats["exact_hits"], stats["misses"], stats["hit_ratio"]), (1, 1, 0.5))
+        self.assertEqual((stats["bytes_read"], stats["bytes_written"]), (1000, 1000))
+        self.assertEqual(stats["most_expensive"], [("diag(ds('CMIP6|b'))", 3.)])
+        with open(dump) as f:
+            self.assertEqual(json.load(f)["compute_time"], 4.)
+        self.assertEqual(cache.cstats()["exact_hits"], 0)
+
+    def test_2_ceval_stats(self):
+        with open(os.path.join(self.dir, "in.nc"), "w") as f:
+            f.write("x\n")
+        tools = os.path.join(self.dir, "tools")
+        os.mkdir(tools)
+        # A stub for 'ncrcat -O FILES... OUTPUT'
+        with open(os.path.join(tools, "ncrcat"), "w") as f:
+            f.write('#!/bin/bash\nshift\nn=$#\ncat "${@:1:$((n-1))}" > "${!n}"\n')
+        os.chmod(os.path.join(tools, "ncrcat"), 0755)
+        cproject("test_stats", "simulation")
+        dataloc(project="test_stats", organization="generic", url=[os.path.join(self.dir, "${simulation}.nc")])
+        operators.cscript("tstats", "cat ${in} > ${out}")
+        operators.scripts["tstats"].flags = operators.scriptFlags(*[True] * 7, commuteWithTimeConcatenation=True)
+
+        def tree(period):
+            return ctree("tstats", operators.scripts["tstats"],
+                         ds(project="test_stats", simulation="in", variable="tas", period=period))
+
+        def counters():
+            stats = cache.cstats()
+            return [stats[name] for name in ["exact_hits", "begin_hits", "misses"]]
+
+        main = sys.modules['__main__'].__dict__
+        saved = dict([(name, main.get(name)) for name in ["ds", "tstats"]])
+        main.update(ds=ds, tstats=lambda dataset: ctree("tstats", operators.scripts["tstats"], dataset))
+        path, reads = os.environ["PATH"], []
+        os.environ["PATH"] = tools + os.pathsep + path
+        driver.cread, cread = (lambda datafile, varname=None: reads.append((datafile, varname))), driver.cread
+        cache.stamping = False
+        cache.reset_stats()
+        try:
+            driver.ceval(tree("1980"), format='file')
+            self.assertEqual(counters(), [0, 0, 1])
+            # The cached chunk is used, and the rest of the period is computed : each lookup is counted once
+            driver.ceval(tree("1980-1981"), format='MaskedArray')
+            self.assertEqual(counters(), [0, 1, 2])
+            self.assertEqual(reads, [(cache.crs2filename[tree("1980-1981").crs], "tas")])
+            driver.ceval(tree("1980-1981"), format='file')
+            self.assertEqual(counters(), [1, 1, 2])
+        finally:
+            os.environ["PATH"] = path
+            driver.cread = cread
+            cache.reset_stats()
+            del operators.scripts["tstats"]
+            for name, value in saved.items():
+                if value is None:
+                    main.pop(name, None)
+                else:
+                    main[name] = value
+
+
+class F_shared_caches(unittest.TestCase):
+    class obj(object):
+        crs = "diag(ds('CMIP6|a'))"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="climaf_test_shared_")
+        cache.stamping = False
+        # Fill a team cache
+        cache.setNewUniqueCache(os.path.join(self.dir, "team"), raz=False)
+        self.shared = cache.generateUniqueFileName(self.obj.crs)
+        with open(self.shared, "w") as f:
+            f.write("1234")
+        cache.register(self.shared, self.obj.crs)
+        cache.crs2filename.close()
+        cache.setNewUniqueCache(os.path.join(self.dir, "private"), raz=False)
+
+    def test_1_served_from_shared_cache(self):
+        cache.set_shared_caches(os.path.join(self.dir, "team"), promote=False)
+        self.assertEqual(cache.hasExactObject(self.obj), self.shared)
+        self.assertFalse(self.obj.crs in cache.crs2filename)
+
+    def test_2_promotion(self):
+        cache.set_shared_caches([os.path.join(self.dir, "team")], promote=True)
+        filename = cache.hasExactObject(self.obj)
+        self.assertTrue(filename.startswith(os.path.join(self.dir, "private")))
+        self.assertEqual(os.stat(filename).st_ino, os.stat(self.shared).st_ino)
+        self.assertEqual(cache.crs2filename[self.obj.crs], filename)
+
+    def tearDown(self):
+        cache.set_shared_caches([], promote=False)
+        cache.stamping = True
+        cache.crs2filename.close()
+        shutil.rmtree(self.dir)
+
+
+class G_single_flight(cache_test):
+    def test_1_single_flight(self):
+        final = os.path.join(self.dir, "final.nc")
+        holder = cache.computation_lock(final)
+        self.assertTrue(holder.acquire())
+
+        def compute():
+            time.sleep(0.3)
+            with open(final + "_tmp", "w") as f:
+                f.write("1234")
+            cache.register(final + "_tmp", "diag(ds('CMIP6|b'))", final)
+            holder.release()
+
+        threading.Thread(target=compute).start()
+        waiter = cache.computation_lock(final)
+        self.assertTrue(waiter.acquire(timeout=10))
+        self.assertTrue(waiter.waited)
+        self.assertEqual(cache.published("diag(ds('CMIP6|b'))", final), final)
+        waiter.release()
+        self.assertFalse(os.path.exists(final + ".lock"))
+        self.assertFalse(os.path.exists(final + "_tmp"))
+
+    def test_2_published_before_lock(self):
+        operators.cscript("tsingle", "touch %s/launched ${in} ${out}" % self.dir)
+        cproject("test_single_flight", "simulation")
+        tree = ctree("tsingle", operators.scripts["tsingle"],
+                     ds(project="test_single_flight", simulation="s", variable="tas", period="1980"))
+        infile = os.path.join(self.dir, "in.nc")
+        with open(infile, "w") as f:
+            f.write("1234")
+        # Another process publishes the result between the cache lookup and the lock acquisition
+        final = cache.generateUniqueFileName(tree.crs, format="nc")
+        with open(final, "w") as f:
+            f.write("1234")
+        driver.ceval, ceval = (lambda cobject, **kwargs: infile), driver.ceval
+        try:
+            self.assertEqual(driver.ceval_script(tree, None), final)
+            self.assertFalse(os.path.exists(os.path.join(self.dir, "launched")))
+            self.assertEqual(cache.crs2filename[tree.crs], final)
+        finally:
+            driver.ceval = ceval
+            del operators.scripts["tsingle"]
+
+
+class H_provenance(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="climaf_test_provenance_")
+        cache.stamping = False
+
+    def make(self, name):
+        filename = os.path.join(self.dir, "data", name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, "w") as f:
+            f.write(name)
+        return filename
+
+    def compute(self, crs, input_files=(), parents=()):
+        filename = cache.generateUniqueFileName(crs)
+        with open(filename, "w") as f:
+            f.write(crs)
+        cache.register(filename, crs)
+        cache.record_provenance(crs, input_files, parents)
+        return filename
+
+    def check_cascade(self, backend):
+        cache.index_backend = backend
+        cache.setNewUniqueCache(os.path.join(self.dir, "cache"), raz=False)
+        raw1, raw2 = self.make("tas_1.nc"), self.make("pr_1.nc")
+        sel1 = self.compute("select(ds('P|tas'))", [raw1])
+        sel2 = self.compute("select(ds('P|pr'))", [raw2])
+        self.compute("ccdo(select(ds('P|tas')),select(ds('P|pr')))", [sel1, sel2])
+        self.compute("plot(select(ds('P|pr')))", [sel2])
+        self.compute("cpage(plot(select(ds('P|pr'))))", parents=["plot(select(ds('P|pr')))"])
+        self.assertEqual(cache.cinvalidate(raw1, drop=False),
+                         ["ccdo(select(ds('P|tas')),select(ds('P|pr')))", "select(ds('P|tas'))"])
+        self.assertEqual(cache.cinvalidate(), [])
+        # A data file is re-published
+        time.sleep(0.01)
+        with open(raw2, "a") as f:
+            f.write("corrected")
+        self.assertEqual(len(cache.cinvalidate()), 4)
+        self.assertEqual(cache.crs2filename.keys(), ["select(ds('P|tas'))"])
+        self.assertEqual(cache.cinvalidate(os.path.join(self.dir, "data")), ["select(ds('P|tas'))"])
+        self.assertEqual(len(cache.crs2filename), 0)
+
+    def test_1_pickle(self):
+        self.check_cascade("pickle")
+
+    def test_2_sqlite(self):
+        self.check_cascade("sqlite")
+
+    def tearDown(self):
+        cache.index_backend = "sqlite"
+        cache.stamping = True
+        cache.crs2filename.close()
+        shutil.rmtree(self.dir)
+
+
+class I_journal(index_test):
+    def test_1_journal(self):
+        self.check_backend("journal")
+        self.check_shapes("journal")
+
+    def test_2_journal_concurrent_sessions_and_compaction(self):
+        from climaf import cache_index
+        first = open_index(self.dir, "journal")
+        second = open_index(self.dir, "journal")
+        first.record("crs1", self.file, signature="s", pstart="1980", pend="1990", cost=3.)
+        second["crs2"] = self.file
+        # Entries are journaled at once, and read by other sessions on lookup or load
+        self.assertTrue("crs1" in second)
+        self.assertEqual(second.entry("crs1")["cost"], 3.)
+        first.load()
+        self.assertEqual(sorted(first.keys()), ["crs1", "crs2"])
+        del second["crs1"]
+        first.load()
+        self.assertFalse("crs1" in first)
+        # Compaction replaces the journal by a snapshot; other sessions replay it when noticing
+        size = cache_index.journal_compaction_size
+        cache_index.journal_compaction_size = 0
+        try:
+            second.record("crs3", self.file, signature="s", pstart="2000", pend="2010")
+        finally:
+            cache_index.journal_compaction_size = size
+        self.assertEqual(os.path.getsize(os.path.join(self.dir, "index.journal")), 0)
+        first.load()
+        self.assertEqual(sorted(first.keys()), ["crs2", "crs3"])
+        self.assertEqual(first.shapes("s"), [("2000", "2010", "crs3")])
+        self.assertEqual(sorted(open_index(self.dir, None).keys()), ["crs2", "crs3"])
+
+
+class J_failures(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="climaf_test_failures_")
+        cache.setNewUniqueCache(self.dir, raz=False)
+
+    def test_1_failures(self):
+        cache.record_failure("ccdo(ds('P|a'))", "cdo: error")
+        cache.record_failure("ds('P|b')", "no file found", "locs1")
+        self.assertTrue(cache.known_failure("ccdo(ds('P|a'))").startswith("cdo: error"))
+        self.assertEqual(cache.known_failure("ds('P|b')", "locs2"), None)
+        # Failures are shared by sessions using the same cache
+        cache.setNewUniqueCache(self.dir, raz=False)
+        self.assertNotEqual(cache.known_failure("ds('P|b')", "locs1"), None)
+        self.assertEqual(cache.cforget_failures("ccdo(ds('P|a'))"), 1)
+        self.assertEqual(cache.known_failure("ccdo(ds('P|a'))"), None)
+        ttl = cache.failure_ttl
+        cache.failure_ttl = 0.01
+        try:
+            time.sleep(0.02)
+            self.assertEqual(cache.known_failure("ds('P|b')", "locs1"), None)
+        finally:
+            cache.failure_ttl = ttl
+        self.assertEqual(cache.cforget_failures(), 1)
+        self.assertEqual(cache.read_failures(), {})
+
+    def test_2_short_circuit(self):
+        class script(object):
+            flags = operators.scriptFlags()
+            outputs = {'': '%s'}
+            outputFormat = "nc"
+            command = "touch %s" % os.path.join(self.dir, "launched")
+
+        explored = []
+
+        def explore(dataset, *args, **kwargs):
+            explored.append(dataset.crs)
+            return cdataset_explore(dataset, *args, **kwargs)
+
+        cproject("test_failures", "simulation")
+        cdataset_explore, cdataset.explore = cdataset.explore, explore
+        operators.scripts["tscript"] = script
+        try:
+            # A dataset with no file is searched once
+            tas = ds(project="test_failures", simulation="s", variable="tas", period="1980")
+            self.assertFalse(tas.baseFiles())
+            self.assertFalse(ds(project="test_failures", simulation="s", variable="tas", period="1980").baseFiles())
+            self.assertEqual(explored, [tas.crs])
+            # A script call which already failed is not launched again
+            tree = ctree("tscript", script, tas)
+            cache.record_failure(tree.crs, "cdo: error")
+            self.assertRaises(driver.Climaf_Driver_Error, driver.ceval, tree, format='file')
+            self.assertFalse(os.path.exists(os.path.join(self.dir, "launched")))
+        finally:
+            cdataset.explore = cdataset_explore
+            del operators.scripts["tscript"]
+
+    def tearDown(self):
+        cache.crs2filename.close()
+        shutil.rmtree(self.dir)
+
+
+class K_memory_tier(unittest.TestCase):
+    def test_1_lru(self):
+        budget = cache.memory_budget
+        cache.memory_budget = 100
+        try:
+            memory = cache.memory_tier()
+            memory.put("a", "A", 40)
+            memory.put("b", "B", 40)
+            self.assertEqual(memory.get("a"), "A")
+            # Least recently used values are discarded first
+            memory.put("c", "C", 40)
+            self.assertFalse("b" in memory)
+            self.assertEqual((memory.get("a"), memory.get("c"), memory.size), ("A", "C", 80))
+            memory.put("d", "D", 101)
+            self.assertEqual(len(memory), 2)
+        finally:
+            cache.memory_budget = budget
+
+    def test_2_crs_object(self):
+        evaluated = []
+
+        def tscript(*operands):
+            evaluated.append(operands)
+            return ctree("tscript", scheduler_test.script, *operands)
+
+        main = sys.modules['__main__'].__dict__
+        saved = dict([(name, main.get(name)) for name in ["ds", "tscript"]])
+        main.update(ds=ds, tscript=tscript)
+        cproject("test_memory", "simulation")
+        crs = "tscript(ds('test_memory.s.tas.1980.global'))"
+        try:
+            cache.memory.clear()
+            self.assertEqual(cache.crs_object(crs).crs, crs)
+            self.assertEqual(cache.crs_object(crs).crs, crs)
+            self.assertEqual(len(evaluated), 1)
+        finally:
+            cache.memory.clear()
+            for name, value in saved.items():
+                if value is None:
+                    main.pop(name, None)
+                else:
+                    main[name] = value
+
+    @unittest.skipUnless(numpy, "because numpy is not available")
+    def test_3_cread(self):
+        opened = []
+
+        class ncf(object):
+            def __init__(self, filename):
+                opened.append(filename)
+                self.variables = dict(tas=numpy.arange(4.))
+
+            def close(self):
+                pass
+
+        directory = tempfile.mkdtemp(prefix="climaf_test_memory_")
+        filename = os.path.join(directory, "tas.nc")
+        with open(filename, "w") as f:
+            f.write("1234")
+        anynetcdf = sys.modules.get("climaf.anynetcdf")
+        sys.modules["climaf.anynetcdf"] = type(sys)("anynetcdf")
+        sys.modules["climaf.anynetcdf"].ncf = ncf
+        try:
+            cache.memory.clear()
+            data = driver.cread(filename, "tas")
+            data[0] = 10.
+            # Data read from an unchanged file is served from memory, as a copy
+            self.assertEqual(list(driver.cread(filename, "tas")), [0., 1., 2., 3.])
+            self.assertEqual(opened, [filename])
+            with open(filename, "a") as f:
+                f.write("5")
+            driver.cread(filename, "tas")
+            self.assertEqual(opened, [filename] * 2)
+        finally:
+            cache.memory.clear()
+            if anynetcdf is None:
+                del sys.modules["climaf.anynetcdf"]
+            else:
+                sys.modules["climaf.anynetcdf"] = anynetcdf
+            shutil.rmtree(directory)
+
+
+class listing_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="climaf_test_listing_")
+        cache.stamping = False
+        cache.setNewUniqueCache(self.dir, raz=False)
+        for crs, size in [("select(ds('P|tas'))", 3000), ("select(ds('P|pr'))", 10)]:
+            filename = cache.generateUniqueFileName(crs)
+            with open(filename, "w") as f:
+                f.write("x" * size)
+            cache.register(filename, crs)
+
+    def tearDown(self):
+        cache.stamping = True
+        cache.crs2filename.close()
+        shutil.rmtree(self.dir)
+
+
+class L_listing(listing_test):
+    def test_1_clist(self):
+        self.assertEqual(sorted(cache.cls()), ["select(ds('P|pr'))", "select(ds('P|tas'))"])
+        self.assertEqual(cache.cls(size="2k"), ["select(ds('P|tas'))"])
+        self.assertEqual(cache.cls(size="2k", not_pattern="tas"), None)
+        self.assertEqual(cache.cls(pattern="P.pr"), ["select(ds('P|pr'))"])
+        self.assertEqual(cache.cls(age="-1"), cache.cls(age="0"))
+        self.assertEqual(cache.cls(age="+0"), None)
+        self.assertEqual(cache.crm(pattern="pr"), ["select(ds('P|pr'))"])
+        self.assertEqual(cache.crs2filename.keys(), ["select(ds('P|tas'))"])
+        self.assertEqual(cache.list_cache(), cache.crs2filename.values())
+
+
+class M_rebuild(listing_test):
+    def test_1_rebuild(self):
+        cache.stamping = True
+        png = png_signature + png_chunk("IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0)) + \
+            png_chunk("IDAT", zlib.compress("\x00\x00")) + png_chunk("IEND", "")
+        for crs in ["plot(ds('P|a'))", "plot(ds('P|b'))", "legacy", None]:
+            filename = cache.generateUniqueFileName(crs or "unstamped", format="png")
+            with open(filename, "wb") as f:
+                f.write(png)
+            if crs == "legacy":
+                legacy = filename
+            elif crs:
+                write_crs(filename, crs)
+        orphan = filename.replace(".png", "_999999999.png")
+        shutil.copy(filename, orphan)
+        os.utime(orphan, (0, 0))
+        # A stub for 'identify -verbose FILE', which finds a CRS in the legacy file only
+        tools = tempfile.mkdtemp(prefix="climaf_test_listing_")
+        with open(os.path.join(tools, "identify"), "w") as f:
+            f.write('#!/bin/sh\nif [ "$2" = "%s" ]; then echo "    CRS_def: plot(ds(\'P|c\'))"; fi\n' % legacy)
+        os.chmod(os.path.join(tools, "identify"), 0755)
+        path = os.environ["PATH"]
+        try:
+            # Files which CRS cannot be read (without external tools) are kept
+            os.environ["PATH"] = tools + "/none"
+            index = cache.rebuild(workers=2)
+            self.assertEqual(sorted(index.keys()), ["plot(ds('P|a'))", "plot(ds('P|b'))",
+                                                    "select(ds('P|pr'))", "select(ds('P|tas'))"])
+            self.assertTrue(os.path.exists(filename) and os.path.exists(legacy))
+            self.assertFalse(os.path.exists(orphan))
+            # Files are removed only if external tools find no CRS either
+            os.environ["PATH"] = tools + ":" + path
+            index = cache.rebuild(workers=2)
+            self.assertEqual(sorted(index.keys()), ["plot(ds('P|a'))", "plot(ds('P|b'))", "plot(ds('P|c'))",
+                                                    "select(ds('P|pr'))", "select(ds('P|tas'))"])
+            self.assertFalse(os.path.exists(filename))
+        finally:
+            os.environ["PATH"] = path
+            shutil.rmtree(tools)
+        # Files already indexed are not read again
+        cache.getCRS, getCRS = None, cache.getCRS
+        try:
+            self.assertEqual(len(cache.rebuild()), 5)
+        finally:
+            cache.getCRS = getCRS
+
+
+class canonical_test(unittest.TestCase):
+    class script(object):
+        flags = operators.scriptFlags()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="climaf_test_canonical_")
+        cache.stamping = False
+        cache.setNewUniqueCache(self.dir, raz=False)
+        cproject("test_canonical", separator="|")
+
+    def tearDown(self):
+        cache.stamping = True
+        cache.crs2filename.close()
+        shutil.rmtree(self.dir)
+
+
+class N_canonical_crs(canonical_test):
+    def test_1_canonical_crs(self):
+        d1 = ds(project="test_canonical", simulation="s", variable="tas", period="198001-198112", domain=[-10., 10])
+        d2 = ds(project="test_canonical", simulation="s", variable="tas", period="1980-1981", domain=[-10, 10])
+        self.assertEqual(d1.crs, d2.crs)
+        t1 = ctree("regrid", self.script, d1, latmin=10.0, period="198001-198112", option=u"bil")
+        t2 = ctree("regrid", self.script, d2, latmin=10, period="1980-1981", option="bil")
+        self.assertEqual(t1.crs, t2.crs)
+        self.assertEqual(cens({"b": d1, "a": d2}, order=["b", "a"]).crs, cens({"a": d1, "b": d2}).crs)
+        # An object cached under its legacy CRS is found, and its index entry renamed
+        legacy = t1.buildcrs(canonical=False)
+        self.assertNotEqual(legacy, t1.crs)
+        filename = cache.generateUniqueFileName(legacy)
+        with open(filename, "w") as f:
+            f.write("1234")
+        cache.register(filename, legacy)
+        self.assertEqual(cache.hasExactObject(t1), filename)
+        self.assertEqual(cache.crs2filename.keys(), [t1.crs])
+        self.assertEqual(cache.hasExactObject(t2), filename)
+
+
+class O_inclusion(canonical_test):
+    def test_1_dataset_inclusion(self):
+        def dataset(**kwargs):
+            facets = dict(project="test_canonical", simulation="s", variable="tas", period="1980-1989")
+            facets.update(kwargs)
+            return ds(**facets)
+
+        box = dataset(domain=[40, 60, -10, 20])
+        self.assertEqual(cache.ds_inclusion(dataset(), box), "domain")
+        self.assertEqual(cache.ds_inclusion(dataset(domain=[30, 60, -10, 30]), box), "domain")
+        self.assertEqual(cache.ds_inclusion(dataset(domain=[45, 60, -10, 20]), box), None)
+        self.assertEqual(cache.ds_inclusion(dataset(variable="pr,tas", period="1980-2000"), dataset(period="1985")),
+                         "period+variable")
+        self.assertEqual(cache.ds_inclusion(dataset(variable="pr,uas"), dataset()), None)
+        self.assertEqual(cache.ds_inclusion(dataset(simulation="t", variable="pr,tas"), dataset()), None)
+
+    def test_2_including_object(self):
+        class script(object):
+            flags = operators.scriptFlags(commuteWithTimeConcatenation=False, commuteWithSpaceConcatenation=True)
+
+        def tscript(dataset):
+            return ctree("tscript", script, dataset)
+
+        def dataset(**kwargs):
+            facets = dict(project="test_canonical", simulation="s", variable="tas", period="1980-1989")
+            facets.update(kwargs)
+            return ds(**facets)
+
+        main = sys.modules['__main__'].__dict__
+        saved = dict([(name, main.get(name)) for name in ["ds", "tscript"]])
+        main.update(ds=ds, tscript=tscript)
+        operators.scripts["tscript"] = script
+        try:
+            filename = cache.generateUniqueFileName(tscript(dataset()).crs)
+            with open(filename, "w") as f:
+                f.write("1234")
+            cache.register(filename, tscript(dataset()).crs)
+            # The global object includes a box, but the operator does not allow for selecting a sub-period
+            found, dimensions = cache.hasIncludingObject(tscript(dataset(domain=[40, 60, -10, 20])))
+            self.assertEqual((found.crs, dimensions), (tscript(dataset()).crs, "domain"))
+            self.assertEqual(cache.hasIncludingObject(tscript(dataset(period="1985"))), (None, None))
+        finally:
+            del operators.scripts["tscript"]
+            for name, value in saved.items():
+                if value is None:
+                    main.pop(name, None)
+                else:
+                    main[name] = value
+
+
+class P_period_chunks(unittest.TestCase):
+    def test_1_plan_chunks(self):
+        def plan(period, chunks):
+            return [(repr(p), crs) for p, crs in
+                    cache.plan_chunks(init_period(period), [(init_period(c), c) for c in chunks])]
+
+        chunks = ["1850-1899", "1900-1949", "1950-2014"]
+        self.assertEqual(plan("1850-2014", chunks), [(c, c) for c in chunks])
+        # Fewer pieces are preferred, for the same coverage
+        self.assertEqual(plan("1850-2014", chunks + ["1850-1949"]),
+                         [("1850-1949", "1850-1949"), ("1950-2014", "1950-2014")])
+        # Gaps are minimal, and chunks do not overlap
+        self.assertEqual(plan("1850-2020", ["1850-1899", "1880-1959", "1960-2014"]),
+                         [("1850-1879", None), ("1880-1959", "1880-1959"), ("1960-2014", "1960-2014"),
+                          ("2015-2020", None)])
+
+    def test_2_nested_parallel_map(self):
+        def ident(i):
+            time.sleep(0.02)
+            return threading.current_thread().ident
+
+        def threads(n):
+            return set(driver.parallel_map(ident, range(n), 4))
+
+        self.assertTrue(len(threads(8)) > 1)
+        # Worker threads do not start other threads
+        self.assertEqual([len(t) for t in driver.parallel_map(lambda i: threads(8), range(2), 2)], [1, 1])
+
+
+class Q_grow(unittest.TestCase):
+    def test_1_grow(self):
+        class script(object):
+            flags = operators.scriptFlags(commuteWithTimeConcatenation=True)
+            outputs = {'': '%s'}
+            outputFormat = "nc"
+
+        def obj(period):
+            return ctree("tscript", script, ds(project="test_grow", simulation="s", variable="tas", period=period))
+
+        def cached(cobject, content):
+            filename = cache.generateUniqueFileName(cobject.crs)
+            with open(filename, "w") as f:
+                f.write(content)
+            return cache.register(filename, cobject.crs)
+
+        def stub(name, command):
+            with open(os.path.join(directory, name), "w") as f:
+                f.write("#!/bin/sh\n%s\n" % command)
+            os.chmod(os.path.join(directory, name), 0755)
+
+        def ncrcat(command):
+            # A stub for 'ncrcat --rec_apn FILE_END FILE_BEGIN'
+            stub("ncrcat", command)
+
+        def content(cobject):
+            with open(cache.crs2filename[cobject.crs]) as f:
+                return f.read()
+
+        evaluated = []
+
+        def ceval(cobject, *args, **kwargs):
+            evaluated.append(cobject.crs)
+            return cached(cobject, "new\n")
+
+        main = sys.modules['__main__'].__dict__
+        saved = dict([(name, main.get(name)) for name in ["ds", "tscript"]])
+        main.update(ds=ds, tscript=lambda *operands, **parameters: ctree("tscript", script, *operands, **parameters))
+        operators.scripts["tscript"] = script
+        directory = tempfile.mkdtemp(prefix="climaf_test_grow_")
+        path = os.environ["PATH"]
+        os.environ["PATH"] = directory + ":" + path
+        cache.stamping = False
+        cache.setNewUniqueCache(directory, raz=False)
+        cproject("test_grow", "simulation")
+        driver.ceval, ceval = ceval, driver.ceval
+        other = tempfile.mkdtemp(prefix="climaf_test_grow_")
+        try:
+            # Stubs for 'ncdump -h FILE' and 'ncks -O -d time,0,N FILE FILE', with one record per line
+            stub("ncdump", 'echo "time = UNLIMITED ; // ($(wc -l < "$2") currently)"')
+            stub("ncks", 'head -n $((${3##*,} + 1)) "$4" > "$5.tmp" && mv "$5.tmp" "$5"')
+            ncrcat('cat "$2" >> "$3"')
+            cached(obj("1980"), "1980\n")
+            inode = os.stat(cache.crs2filename[obj("1980").crs]).st_ino
+            filename = driver.ceval_grow(obj("1980-1981"), None, None, [], [])
+            self.assertEqual(evaluated, [obj("1981").crs])
+            self.assertEqual(cache.crs2filename[obj("1980-1981").crs], filename)
+            self.assertEqual(content(obj("1980-1981")), "1980\nnew\n")
+            self.assertEqual(os.stat(filename).st_ino, inode)
+            self.assertFalse(obj("1980").crs in cache.crs2filename or obj("1981").crs in cache.crs2filename)
+            # A failing extension is rolled back, leaving the cached object unchanged
+            ncrcat('cat "$2" >> "$3"; exit 1')
+            self.assertEqual(driver.ceval_grow(obj("1980-1982"), None, None, [], []), None)
+            self.assertEqual(content(obj("1980-1981")), "1980\nnew\n")
+            files = [os.path.join(d, name) for d, dirs, names in os.walk(directory) for name in names
+                     if name.endswith(".nc")]
+            self.assertEqual(sorted(files), sorted(cache.crs2filename.values()))
+            # A file linked from another cache is extended on a copy
+            os.link(filename, os.path.join(other, "shared.nc"))
+            ncrcat('cat "$2" >> "$3"')
+            self.assertNotEqual(driver.ceval_grow(obj("1980-1982"), None, None, [], []), None)
+            self.assertEqual(content(obj("1980-1982")), "1980\nnew\nnew\n")
+            with open(os.path.join(other, "shared.nc")) as f:
+                self.assertEqual(f.read(), "1980\nnew\n")
+        finally:
+            shutil.rmtree(other)
+            driver.ceval = ceval
+            os.environ["PATH"] = path
+            cache.stamping = True
+            cache.crs2filename.close()
+            shutil.rmtree(directory)
+            del operators.scripts["tscript"]
+            for name, value in saved.items():
+                if value is None:
+                    main.pop(name, None)
+                else:
+                    main[name] = value
+
+
+class R_aggregates(unittest.TestCase):
+    def test_1_years(self):
+        cproject("test_aggregates", "simulation")
+        tas = ds(project="test_aggregates", simulation="s", variable="tas", period="1980-1989")
+        self.assertEqual(aggregates.years_of(tas), range(1980, 1990))
+        tas = ds(project="test_aggregates", simulation="s", variable="tas", period="198004-198903")
+        self.assertEqual(aggregates.years_of(tas), None)
+
+    def test_2_assembled(self):
+        class script(object):
+            def __init__(self, command, outputs=None, **flags):
+                self.command, self.flags, self.outputs = command, operators.scriptFlags(**flags), outputs or {'': '%s'}
+                self.outputFormat = "nc"
+
+        scripts = operators.scripts.copy()
+        operators.scripts.update(time_average=script(""), ccdo=script("${operator}"),
+                                 time_partials=script("${cycle}", {'': '%s', 'sqdev': '%s', 'count': '%s'}),
+                                 combine_partials=script("${stat} ${cycle}", commuteWithEnsemble=False))
+        cproject("test_aggregates", "simulation")
+        tas = ds(project="test_aggregates", simulation="s", variable="tas", period="1980-1982")
+        try:
+            mean = ctree("time_average", operators.scripts["time_average"], tas)
+            self.assertEqual(aggregates.assembled(mean), None)
+            aggregates.use_partials = True
+            assembled = aggregates.assembled(mean)
+            # The partial aggregates of all years are combined in one script call
+            self.assertEqual(assembled.operator, "combine_partials")
+            self.assertEqual(assembled.parameters, {"stat": "mean", "cycle": "tim"})
+            members, = assembled.operands
+            self.assertEqual(members.order, ["%d_%s" % (year, name) for year in [1980, 1981, 1982]
+                                             for name in ["sum", "sqdev", "count"]])
+            self.assertEqual(members["1981_sum"].crs,
+                             "time_partials(ds('test_aggregates.s.tas.1981.global'),cycle='tim')")
+            self.assertEqual(members["1981_sqdev"].crs, members["1981_sum"].crs + ".sqdev")
+            self.assertEqual(members["1981_count"].crs, members["1981_sum"].crs + ".count")
+            std = aggregates.assembled(ctree("ccdo", operators.scripts["ccdo"], tas, operator="ymonstd"))
+            self.assertEqual((std.operator, std.parameters), ("combine_partials", {"stat": "std", "cycle": "ymon"}))
+            self.assertTrue("cycle='ymon'" in std.crs)
+            # One year is not enough
+            tas.setperiod(init_period("1980"))
+            self.assertEqual(aggregates.assembled(mean), None)
+        finally:
+            aggregates.use_partials = False
+            operators.scripts.clear()
+            operators.scripts.update(scripts)
+
+
+class S_pack(listing_test):
+    def test_1_pack(self):
+        archive = os.path.join(self.dir, "pack.tar.gz")
+        data = os.path.join(self.dir, "data.nc")
+        with open(data, "w") as f:
+            f.write("data")
+        cache.record_provenance("select(ds('P|tas'))", [data, "/no/such/file"])
+        self.assertEqual(cache.cpack(archive, pattern="tas"), 1)
+        cache.crs2filename.close()
+        other = tempfile.mkdtemp(prefix="climaf_test_unpack_", dir=self.dir)
+        cache.setNewUniqueCache(other, raz=False)
+        self.assertEqual(cache.cunpack(archive), ["select(ds('P|tas'))"])
+        filename = cache.crs2filename["select(ds('P|tas'))"]
+        self.assertTrue(filename.startswith(other) and os.path.getsize(filename) == 3000)
+        # Provenance on missing data files is dropped
+        self.assertEqual([dep[1] for dep in cache.crs2filename.dependencies("select(ds('P|tas'))")],
+                         [os.path.abspath(data)])
+        self.assertEqual(cache.cunpack(archive), [])
+
+    def test_2_pack_home_cache(self):
+        # The default cache is relative to the home directory
+        home = os.environ.get("HOME")
+        os.environ["HOME"] = self.dir
+        try:
+            cache.crs2filename.close()
+            cache.setNewUniqueCache("~/cc", raz=False)
+            filename = cache.generateUniqueFileName("select(ds('P|tas'))")
+            with open(filename, "w") as f:
+                f.write("data")
+            cache.register(filename, "select(ds('P|tas'))")
+            self.assertEqual(cache.cpack("~/pack.tar"), 1)
+            self.assertEqual([name for name in os.listdir(self.dir) if name.startswith("pack")], ["pack.tar"])
+        finally:
+            os.environ["HOME"] = home
+        cache.crs2filename.close()
+        cache.setNewUniqueCache(os.path.join(self.dir, "other"), raz=False)
+        self.assertEqual(cache.cunpack(os.path.join(self.dir, "pack.tar")), ["select(ds('P|tas'))"])
+
+
+class T_compression(unittest.TestCase):
+    def test_1_policy(self):
+        try:
+            cache.set_compression("4, select:6,plot:0")
+            self.assertEqual([cache.compression_level(op) for op in ["ccdo", "select", "plot"]], [4, 6, 0])
+            cache.set_compression({"select": 1})
+            self.assertEqual([cache.compression_level(op) for op in ["ccdo", "select"]], [0, 1])
+            self.assertRaises(cache.Climaf_Cache_Error, cache.set_compression, 10)
+        finally:
+            cache.set_compression(0)
+
+    def test_2_register(self):
+        def cached(crs, content):
+            filename = cache.generateUniqueFileName(crs)
+            with open(filename, "wb") as f:
+                f.write(content)
+            cache.register(filename, crs)
+            with open(filename, "rb") as f:
+                return f.read()
+
+        directory = tempfile.mkdtemp(prefix="climaf_test_compression_")
+        # A stub for 'nccopy -k nc4 -d LEVEL -s INPUT OUTPUT', which logs its arguments
+        with open(os.path.join(directory, "nccopy"), "w") as f:
+            f.write('#!/bin/sh\necho "$@" >> %s/nccopy.log\nprintf "\\211HDF" > "$7"\n' % directory)
+        os.chmod(os.path.join(directory, "nccopy"), 0755)
+        path = os.environ["PATH"]
+        os.environ["PATH"] = directory + ":" + path
+        cache.stamping = False
+        cache.setNewUniqueCache(directory, raz=False)
+        try:
+            cache.set_compression("4,select:0")
+            self.assertEqual(cached("ccdo(ds('P|a'))", "CDF\x01"), "\x89HDF")
+            self.assertEqual(cached("select(ds('P|a'))", "CDF\x01"), "CDF\x01")
+            # NetCDF4 files are not converted again
+            self.assertEqual(cached("ccdo(ds('P|b'))", "\x89HDF"), "\x89HDF")
+            with open(os.path.join(directory, "nccopy.log")) as f:
+                self.assertEqual([line.split()[:5] for line in f], [["-k", "nc4", "-d", "4", "-s"]])
+        finally:
+            cache.set_compression(0)
+            os.environ["PATH"] = path
+            cache.stamping = True
+            cache.crs2filename.close()
+            shutil.rmtree(directory)
+
+
+class scheduler_test(unittest.TestCase):
+    class script(object):
+        flags = operators.scriptFlags()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="climaf_test_scheduler_")
+        cache.setNewUniqueCache(self.dir, raz=False)
+        cproject("test_scheduler", "simulation")
+        operators.scripts["tscript"] = self.script
+
+    def tearDown(self):
+        del operators.scripts["tscript"]
+        cache.crs2filename.close()
+        shutil.rmtree(self.dir)
+
+
+class U_scheduler(scheduler_test):
+    def test_1_dag(self):
+        d1, d2 = [ds(project="test_scheduler", simulation=s, variable="tas", period="1980") for s in "ab"]
+        t1, t2 = ctree("tscript", self.script, d1), ctree("tscript", self.script, d2)
+        top = ctree("tscript", self.script, t1, ctree("tscript", self.script, t1, t2), t2)
+        nodes = driver.dag(top.operands)
+        self.assertEqual(len(nodes), 3)
+        self.assertEqual(nodes[top.operands[1].crs][1], set([t1.crs, t2.crs]))
+        # Children are evaluated before their parents, independent ones concurrently
+        evaluated, active, lookups = [], [], []
+        lock = threading.Lock()
+
+        def ceval(obj, **kwargs):
+            with lock:
+                active.append(obj.crs)
+                evaluated.append((obj.crs, len(active)))
+                lookups.append((kwargs["deep"], kwargs["found"]))
+            time.sleep(0.1)
+            with lock:
+                active.remove(obj.crs)
+
+        driver.ceval, ceval = ceval, driver.ceval
+        try:
+            self.assertTrue(driver.schedule(top.operands, workers=4))
+            self.assertFalse(driver.schedule([d1, t1.operands[0]], workers=4))
+        finally:
+            driver.ceval = ceval
+        self.assertEqual(evaluated[-1], (top.operands[1].crs, 1))
+        self.assertEqual(sorted([n for crs, n in evaluated[:2]]), [1, 2])
+        # The cache lookups made by dag are handed to ceval
+        self.assertEqual(lookups, [(None, dict(including=None, pieces=None, tiles=[], equivalent=None))] * 3)
+
+    def test_2_found(self):
+        def no_lookup(obj):
+            raise AssertionError("cache lookup made again for %s" % obj.crs)
+
+        t1 = ctree("tscript", self.script, ds(project="test_scheduler", simulation="a", variable="tas", period="1980"))
+        saved = cache.hasExactObject, cache.hasIncludingObject, cache.hasChunkedObject, driver.ceval_script
+        cache.hasExactObject = cache.hasIncludingObject = cache.hasChunkedObject = no_lookup
+        driver.ceval_script = lambda obj, deep, recurse_list: "t1.nc"
+        try:
+            found = dict(including=None, pieces=None, tiles=[], equivalent=None)
+            self.assertEqual(driver.ceval(t1, format='file', found=found), "t1.nc")
+        finally:
+            cache.hasExactObject, cache.hasIncludingObject, cache.hasChunkedObject, driver.ceval_script = saved
+
+    def test_3_fixed_fields(self):
+        target = os.path.join(self.dir, "press_levels.txt")
+        with open(target, "w") as f:
+            f.write("1000\n")
+        infile = os.path.join(self.dir, "in.nc")
+        with open(infile, "w") as f:
+            f.write("1234")
+        # The fixed field link is needed by the script after a while
+        operators.cscript("tlevels", "sleep 0.2; cat levels.txt ${in} > ${out}")
+        operators.fixed_fields("tlevels", ("levels.txt", target))
+        trees = [ctree("tlevels", operators.scripts["tlevels"],
+                       ds(project="test_scheduler", simulation=s, variable="tas", period="1980")) for s in "ab"]
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        cache.stamping = False
+        driver.ceval, ceval = (lambda cobject, **kwargs: infile), driver.ceval
+        try:
+            # Script calls run concurrently do not remove the link used by another one
+            for filename in driver.parallel_map(lambda tree: driver.ceval_script(tree, None), trees, 2):
+                with open(filename) as f:
+                    self.assertEqual(f.read(), "1000\n1234")
+            self.assertFalse(os.path.lexists("levels.txt"))
+        finally:
+            driver.ceval = ceval
+            cache.stamping = True
+            os.chdir(cwd)
+            del operators.scripts["tlevels"]
+
+    def test_4_chain(self):
+        infile = os.path.join(self.dir, "in.nc")
+        with open(infile, "w") as f:
+            f.write("x\n")
+        cproject("test_chain", "simulation")
+        dataloc(project="test_chain", organization="generic", url=[os.path.join(self.dir, "${simulation}.nc")])
+        operators.cscript("tchain", "cat ${in} ${in} > ${out}")
+        operators.scripts["tchain"].flags = operators.scriptFlags(*[True] * 7)
+        tree = ds(project="test_chain", simulation="in", variable="tas", period="1980")
+        for i in range(4):
+            tree = ctree("tchain", operators.scripts["tchain"], tree)
+        lookups = []
+
+        def hasIncludingObject(cobject):
+            lookups.append(cobject.crs)
+            return including(cobject)
+
+        including, cache.hasIncludingObject = cache.hasIncludingObject, hasIncludingObject
+        cache.stamping = False
+        try:
+            with open(driver.ceval(tree, format='file')) as f:
+                self.assertEqual(len(f.read()), 32)
+            # The cache lookups for a chain of script calls are made once for each
+            self.assertEqual(len(lookups), 4)
+        finally:
+            cache.hasIncludingObject = including
+            cache.stamping = True
+            del operators.scripts["tchain"]
+
+
+class V_members(scheduler_test):
+    def test_1_members(self):
+        members = dict([(s, ds(project="test_scheduler", simulation=s, variable="tas", period="1980")) for s in "abcd"])
+        evaluated = []
+
+        def ceval(obj, *args, **kwargs):
+            # Members complete in another order than the ensemble's one
+            time.sleep(dict(a=0.1, b=0., c=0.05, d=0.15)[obj.simulation])
+            evaluated.append(obj.simulation)
+            if obj.simulation == "b":
+                raise ValueError("failure")
+            return obj.simulation + ".nc"
+
+        driver.ceval, ceval = ceval, driver.ceval
+        try:
+            ensemble = cens(dict([(m, members[m]) for m in "acd"]), order=["d", "a", "c"])
+            files = driver.ceval_members(ensemble, None, 'file', None, [], max_parallel=3)
+            self.assertEqual([files[m] for m in ensemble.order], ["d.nc", "a.nc", "c.nc"])
+            self.assertEqual(evaluated, ["c", "a", "d"])
+            # Other members are evaluated despite a failing one
+            del evaluated[:]
+            self.assertRaises(driver.Climaf_Driver_Error, driver.ceval_members, cens(members), None, 'file', None, [])
+            self.assertEqual(sorted(evaluated), ["a", "b", "c", "d"])
+        finally:
+            driver.ceval = ceval
+
+
+class W_pages(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="climaf_test_pages_")
+
+    def test_1_png_size(self):
+        filename = os.path.join(self.dir, "b.png")
+        with open(filename, "wb") as f:
+            f.write(png_signature + png_chunk("IHDR", struct.pack(">IIBBBBB", 640, 480, 8, 2, 0, 0, 0)) +
+                    png_chunk("IEND", ""))
+        self.assertEqual(png_size(filename), (640, 480))
+        self.assertEqual(driver.figure_size(filename), ("640", "480"))
+        self.assertEqual(driver.figure_size("xc:None"), ("1", "1"))
+
+    def test_2_page(self):
+        class script(object):
+            flags = operators.scriptFlags()
+
+        figfile = os.path.join(self.dir, "fig.png")
+        with open(figfile, "wb") as f:
+            f.write(png_signature + png_chunk("IHDR", struct.pack(">IIBBBBB", 640, 480, 8, 2, 0, 0, 0)) +
+                    png_chunk("IEND", ""))
+        # Stubs for convert, which logs its arguments, and identify, which must not be needed
+        for command, action in [("convert", 'for out; do :; done; echo page > "$out"'), ("identify", "exit 1")]:
+            with open(os.path.join(self.dir, command), "w") as f:
+                f.write('#!/bin/sh\necho %s "$@" >> %s/commands.log\n%s\n' % (command, self.dir, action))
+            os.chmod(os.path.join(self.dir, command), 0755)
+        cproject("test_page", "simulation")
+        fig = ctree("plot", script, ds(project="test_page", simulation="s", variable="tas", period="1980"))
+        page = cpage([[fig, None]], fig_trim=False, page_trim=False)
+        evaluated = []
+
+        def ceval(cobject, *args, **kwargs):
+            evaluated.append(cobject.crs)
+            return figfile
+
+        path = os.environ["PATH"]
+        os.environ["PATH"] = self.dir + ":" + path
+        cache.stamping = False
+        cache.setNewUniqueCache(self.dir, raz=False)
+        saved = driver.ceval, driver.schedule, driver.page_compositor
+        driver.ceval, driver.schedule, driver.page_compositor = ceval, lambda objects, deep: False, "convert"
+        try:
+            filename = driver.cfilePage(page, None)
+            self.assertEqual(cache.crs2filename[page.crs], filename)
+            self.assertEqual(evaluated, [fig.crs])
+            # Figures sizes are read in their header
+            with open(os.path.join(self.dir, "commands.log")) as f:
+                self.assertEqual([line.split() for line in f],
+                                 [["convert", "-size", "1000x1500", "xc:white",
+                                   figfile, "-geometry", "455x1440+30+30", "-composite",
+                                   "xc:None", "-geometry", "455x1440+515+30", "-composite", filename]])
+        finally:
+            driver.ceval, driver.schedule, driver.page_compositor = saved
+            os.environ["PATH"] = path
+            cache.stamping = True
+            cache.crs2filename.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+class X_time_chunks(unittest.TestCase):
+    def test_1_split_gaps(self):
+        class script(object):
+            flags = operators.scriptFlags(commuteWithTimeConcatenation=True)
+
+        cproject("test_chunks", "simulation")
+        operators.scripts["tscript"] = script
+        time_chunks, driver.time_chunks = driver.time_chunks, 10
+        try:
+            obj = ctree("tscript", script,
+                        ds(project="test_chunks", simulation="s", variable="tas", period="1855-1879"))
+            self.assertEqual([date.year for date in driver.chunk_bounds(obj)], [1860, 1870])
+            self.assertEqual([(repr(p), crs) for p, crs in driver.split_gaps(obj)],
+                             [("1855-1859", None), ("1860-1869", None), ("1870-1879", None)])
+            # Only gaps are split
+            pieces = [(init_period("1855-1864"), "c"), (init_period("1865-1879"), None)]
+            self.assertEqual([(repr(p), crs) for p, crs in driver.split_gaps(obj, pieces)],
+                             [("1855-1864", "c"), ("1865-1869", None), ("1870-1879", None)])
+            obj = ctree("tscript", script,
+                        ds(project="test_chunks", simulation="s", variable="tas", period="1861-1869"))
+            self.assertEqual(driver.split_gaps(obj), None)
+        finally:
+            driver.time_chunks = time_chunks
+            del operators.scripts["tscript"]
+
+
+class Y_tiles(unittest.TestCase):
+    def test_1_tiles(self):
+        class script(object):
+            flags = operators.scriptFlags(commuteWithSpaceConcatenation=True)
+            outputs = {'': '%s'}
+
+        class ccdo(object):
+            flags = operators.scriptFlags()
+            outputs = {'': '%s'}
+
+        cproject("test_tiles", "simulation")
+        scripts = operators.scripts.copy()
+        operators.scripts.update(tscript=script, ccdo=ccdo)
+        saved = driver.tile_size, driver.data_size, driver.grid_shape
+        driver.tile_size, driver.data_size, driver.grid_shape = 100, lambda obj: 250, lambda dataset: (10, 20)
+        try:
+            tas = ds(project="test_tiles", simulation="s", variable="tas", period="1980")
+            tiles = driver.tiles_of(ctree("tscript", script, tas))
+            self.assertEqual([tile.operands[0].parameters["operator"] for tile in tiles],
+                             ["selindexbox,1,20,1,3", "selindexbox,1,20,4,6", "selindexbox,1,20,7,10"])
+            self.assertEqual(tiles[0].operands[0].operands[0].crs, tas.crs)
+            # Tiles are not tiled again
+            self.assertEqual(driver.tiles_of(tiles[0]), [])
+            driver.data_size = lambda obj: 100
+            self.assertEqual(driver.tiles_of(ctree("tscript", script, tas)), [])
+        finally:
+            driver.tile_size, driver.data_size, driver.grid_shape = saved
+            operators.scripts.clear()
+            operators.scripts.update(scripts)
+
+    def test_2_grid_shape(self):
+        class variable(object):
+            def __init__(self, dimensions, **attributes):
+                self.dimensions = dimensions
+                self.shape = tuple([sizes[name] or 12 for name in dimensions])
+                self.__dict__.update(attributes)
+
+        class ncf(object):
+            # Unlimited dimensions have length None, as with scipy.io.netcdf
+            def __init__(self, filename, mode):
+                self.dimensions = sizes
+                self.variables = variables
+
+            def close(self):
+                pass
+
+        sizes = dict(time=None, t=None, lat=10, lon=20, y=10, x=20, ncells=200, lev=5)
+        variables = dict(lev=variable(("lev",), positive="down"))
+        directory = tempfile.mkdtemp(prefix="climaf_test_grid_")
+        with open(os.path.join(directory, "s.nc"), "w") as f:
+            f.write("1234")
+        cproject("test_grid", "simulation")
+        dataloc(project="test_grid", organization="generic", url=[os.path.join(directory, "${simulation}.nc")])
+        tas = ds(project="test_grid", simulation="s", variable="tas", period="1980")
+        anynetcdf = sys.modules.get("climaf.anynetcdf")
+        sys.modules["climaf.anynetcdf"] = type(sys)("anynetcdf")
+        sys.modules["climaf.anynetcdf"].ncf = ncf
+        try:
+            for dimensions, shape in [(("time", "lat", "lon"), (10, 20)), (("t", "y", "x"), (10, 20)),
+                                      (("time", "ncells"), None), (("time", "lev", "ncells"), None),
+                                      (("lat", "time"), None), (("ncells",), None)]:
+                variables["tas"] = variable(dimensions)
+                self.assertEqual(driver.grid_shape(tas), shape)
+        finally:
+            if anynetcdf is None:
+                del sys.modules["climaf.anynetcdf"]
+            else:
+                sys.modules["climaf.anynetcdf"] = anynetcdf
+            shutil.rmtree(directory)
+
+    def test_3_collage(self):
+        directory = tempfile.mkdtemp(prefix="climaf_test_collage_")
+        # A stub for 'cdo -O collgrid,1 TILES... OUTPUT', which logs its arguments
+        with open(os.path.join(directory, "cdo"), "w") as f:
+            f.write('#!/bin/sh\necho "$@" >> %s/cdo.log\nfor out; do :; done\necho collage > "$out"\n' % directory)
+        os.chmod(os.path.join(directory, "cdo"), 0755)
+        path = os.environ["PATH"]
+        os.environ["PATH"] = directory + ":" + path
+        cache.stamping = False
+        cache.setNewUniqueCache(directory, raz=False)
+        tiles = ["tscript(ccdo(ds('P|a'),operator='selindexbox,1,20,%d,%d'))" % (i, i + 4) for i in [1, 6]]
+        dependencies = [("file", "/data/a.nc", 4, 0.), ("file", "/data/b.nc", 4, 0.), ("file", "/data/c.nc", 4, 0.)]
+        try:
+            files = []
+            for i, tile in enumerate(tiles):
+                files.append(cache.generateUniqueFileName(tile))
+                with open(files[-1], "w") as f:
+                    f.write(tile)
+                cache.register(files[-1], tile)
+                cache.crs2filename.set_dependencies(tile, [dependencies[0], dependencies[i + 1]])
+            filename = cache.collage(tiles, "tscript(ds('P|a'))", keep=False)
+            self.assertEqual(cache.crs2filename["tscript(ds('P|a'))"], filename)
+            # Tiles are assembled in row order, and the dependencies of all are carried over
+            with open(os.path.join(directory, "cdo.log")) as f:
+                self.assertEqual(f.read().split()[:-1], ["-O", "collgrid,1"] + files)
+            self.assertEqual(sorted([tuple(dependency) for dependency in
+                                     cache.crs2filename.dependencies("tscript(ds('P|a'))")]), dependencies)
+            self.assertFalse(any([tile in cache.crs2filename for tile in tiles]))
+        finally:
+            os.environ["PATH"] = path
+            cache.stamping = True
+            cache.crs2filename.close()
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()